@@ -0,0 +1,363 @@
+# bench.py
+# Бенчмарки горячих путей бота. Запуск: python bench.py <имя> [параметры]
+# Каждый бенчмарк работает на временной БД и не трогает рабочую bot_data.db.
+
+import argparse
+import asyncio
+import base64
+import json
+import logging
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+from typing import Callable, Dict, List, Tuple
+
+import pytz
+
+from config import SETTINGS
+
+import bot
+
+
+WORDS = (
+    "продам куплю новый б/у телефон iphone samsung ноутбук велосипед диван шкаф стол стул кресло "
+    "коляска детская зимняя летняя куртка пальто обувь кроссовки размер цвет черный белый красный "
+    "синий состояние отличное хорошее торг уместен доставка самовывоз район центр срочно недорого "
+    "гарантия чек коробка зарядка чехол комплект полный память экран батарея оригинал"
+).split()
+
+
+def _random_ad(rng: random.Random, words: int = 40) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(words))
+
+
+def _percentile(samples: List[float], q: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def _report(name: str, samples: List[float]):
+    print(
+        f"{name}: n={len(samples)} "
+        f"p50={_percentile(samples, 0.5) * 1000:.3f} мс "
+        f"p99={_percentile(samples, 0.99) * 1000:.3f} мс "
+        f"max={max(samples) * 1000:.3f} мс"
+    )
+
+
+async def _with_temp_db(body: Callable):
+    with tempfile.TemporaryDirectory() as tmp:
+        SETTINGS.DB_NAME = os.path.join(tmp, "bench.db")
+        await bot.DatabaseManager.init_db()
+        try:
+            await body()
+        finally:
+            await bot.DatabaseManager.close_connection()
+
+
+async def bench_minhash(args):
+    """Поиск похожих объявлений: расчет сигнатуры и LSH-поиск на истории из N объявлений."""
+    rng = random.Random(42)
+
+    async def body():
+        db = await bot.DatabaseManager.get_connection()
+        started = time.perf_counter()
+        batch_signatures, batch_buckets = [], []
+        for ad_id in range(1, args.ads + 1):
+            signature = bot.minhash_signature(_random_ad(rng))
+            batch_signatures.append((ad_id, ad_id, 1, bot._get_datetime_now_utc_str(), signature.tobytes()))
+            batch_buckets.extend((key, ad_id) for key in bot.lsh_band_keys(signature))
+            if len(batch_signatures) >= 5000 or ad_id == args.ads:
+                await db.executemany(
+                    "INSERT INTO ad_signatures (id, message_id, user_id, created_at, signature) VALUES (?, ?, ?, ?, ?)",
+                    batch_signatures)
+                await db.executemany("INSERT OR IGNORE INTO ad_lsh_buckets (bucket_key, ad_id) VALUES (?, ?)",
+                                     batch_buckets)
+                await db.commit()
+                batch_signatures, batch_buckets = [], []
+        print(f"Наполнение: {args.ads} объявлений за {time.perf_counter() - started:.1f} с")
+
+        signature_times, lookup_times, found = [], [], 0
+        for i in range(args.queries):
+            text = _random_ad(rng)
+            if i % 2 == 0:
+                # Половина запросов — заведомые почти-дубликаты уже сохраненного объявления
+                base = _random_ad(rng)
+                await bot.async_db_store_ad_signature(0, 1, bot.minhash_signature(base))
+                text = base.replace(rng.choice(base.split()), rng.choice(WORDS), 1)
+            t0 = time.perf_counter()
+            signature = bot.minhash_signature(text)
+            t1 = time.perf_counter()
+            match = await bot.async_db_find_similar_ad(signature)
+            t2 = time.perf_counter()
+            signature_times.append(t1 - t0)
+            lookup_times.append(t2 - t1)
+            found += match is not None
+
+        _report("Сигнатура", signature_times)
+        _report("LSH-поиск", lookup_times)
+        print(f"Найдено дубликатов: {found} из {args.queries} (ожидается ~{args.queries // 2})")
+
+    await _with_temp_db(body)
+
+
+async def bench_search(args):
+    """Полнотекстовый поиск /search по архиву из N объявлений (словарь с распределением Ципфа, как в живых текстах)."""
+    rng = random.Random(7)
+    vocabulary = WORDS + [f"слово{i}" for i in range(20_000)]
+    cum_weights, total = [], 0.0
+    for rank in range(1, len(vocabulary) + 1):
+        total += 1 / rank
+        cum_weights.append(total)
+
+    def zipf_ad() -> str:
+        return " ".join(rng.choices(vocabulary, cum_weights=cum_weights, k=40))
+
+    async def body():
+        db = await bot.DatabaseManager.get_connection()
+        started = time.perf_counter()
+        now = bot._get_datetime_now_utc_str()
+        rows = [
+            (i, rng.randrange(1, 50_000), f"user{i % 977}", "Имя", zipf_ad(), f"{rng.randrange(100, 100_000)}",
+             "@contact", rng.choice(("pending", "published", "rejected")), now)
+            for i in range(args.ads)
+        ]
+        await db.executemany(
+            "INSERT INTO ads_archive (message_id, user_id, author_username, author_full_name, description, price, "
+            "contact, status, submitted_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        await db.commit()
+        print(f"Наполнение архива: {args.ads} объявлений за {time.perf_counter() - started:.1f} с")
+
+        samples = []
+        for _ in range(args.queries):
+            query = " ".join(rng.choices(vocabulary, cum_weights=cum_weights, k=2))
+            page = rng.randrange(0, 3)
+            t0 = time.perf_counter()
+            await bot.async_db_search_ads(query, page)
+            samples.append(time.perf_counter() - t0)
+        _report("Поиск (2 слова)", samples)
+
+    await _with_temp_db(body)
+
+
+async def bench_user(args):
+    """/user: сводка и страницы подач по ключу на архиве из N объявлений, включая автора с тысячами подач."""
+    rng = random.Random(9)
+    users = max(args.ads // 20, 1)
+    heavy_user = 1  # Автор с долей 5% всех подач — худший случай для сводки и листания
+
+    async def body():
+        db = await bot.DatabaseManager.get_connection()
+        started = time.perf_counter()
+        year_ago = time.time() - 365 * 24 * 3600
+        archive, stats = [], []
+        for i in range(args.ads):
+            user_id = heavy_user if rng.random() < 0.05 else rng.randrange(2, users + 2)
+            submitted = year_ago + rng.random() * 365 * 24 * 3600
+            moderated = datetime.fromtimestamp(submitted + rng.randrange(60, 7200), pytz.utc).isoformat()
+            status = rng.choice(("published", "published", "published", "rejected"))
+            archive.append((i, user_id, f"user{user_id}", "Имя", _random_ad(rng, 20), f"{rng.randrange(100, 100_000)}",
+                            "@contact", status, datetime.fromtimestamp(submitted, pytz.utc).isoformat(), moderated))
+            stats.append((status, archive[-1][8], moderated, moderated[:10], user_id))
+        await db.executemany(
+            "INSERT INTO ads_archive (message_id, user_id, author_username, author_full_name, description, price, "
+            "contact, status, submitted_at, moderated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", archive)
+        await db.executemany("INSERT INTO stats (event_type, created_at, moderated_at, moderated_date_str, user_id) "
+                             "VALUES (?, ?, ?, ?, ?)", stats)
+        # Счетчики, которые бот ведет по ходу подач и решений, — одним запросом, как в миграции
+        await db.execute("INSERT OR REPLACE INTO user_totals (user_id, submitted, published, rejected) "
+                         "SELECT user_id, COUNT(*), SUM(status = 'published'), SUM(status = 'rejected') "
+                         "FROM ads_archive GROUP BY user_id")
+        await db.commit()
+        for _ in range(3):
+            await bot.async_db_ban_user(heavy_user, 0, "спам")
+            await bot.async_db_unban_user(heavy_user, 0)
+        await bot.MemoryCache.warm_up()
+        print(f"Наполнение: {args.ads} подач и решений ({users} авторов) за {time.perf_counter() - started:.1f} с")
+
+        samples = []
+        for _ in range(args.queries):
+            t0 = time.perf_counter()
+            await bot.async_get_user_text(rng.randrange(2, users + 2))
+            samples.append(time.perf_counter() - t0)
+        _report("Сводка, обычный автор", samples)
+
+        samples, before_id = [], None
+        for _ in range(args.queries):
+            t0 = time.perf_counter()
+            _, before_id = await bot.async_get_user_text(heavy_user, before_id)
+            samples.append(time.perf_counter() - t0)
+        _report("Сводка и листание, автор с 5% подач", samples)
+
+    await _with_temp_db(body)
+
+
+def _fake_updates(rng: random.Random, count: int) -> bytes:
+    """Тело ответа getUpdates: текстовые сообщения и нажатия кнопок под постами предложки."""
+    now = int(time.time())
+    updates = []
+    for update_id in range(count):
+        user = {'id': rng.randrange(10 ** 9), 'is_bot': False, 'first_name': "Иван", 'username': "ivan", 'language_code': "ru"}
+        if update_id % 3:
+            text = _random_ad(rng, 30)
+            updates.append({'update_id': update_id, 'message': {
+                'message_id': update_id, 'date': now, 'from': user, 'chat': {**user, 'type': "private"}, 'text': text,
+                'entities': [{'type': "bold", 'offset': 0, 'length': 5}],
+            }})
+        else:
+            markup = {'inline_keyboard': [[{'text': "✅ Опубликовать", 'callback_data': f"mod_pub:{user['id']}"},
+                                           {'text': "❌ Отклонить", 'callback_data': f"mod_rej:{user['id']}"}]]}
+            updates.append({'update_id': update_id, 'callback_query': {
+                'id': str(update_id), 'from': user, 'chat_instance': "1", 'data': f"mod_pub:{user['id']}",
+                'message': {'message_id': update_id, 'date': now, 'chat': {'id': -100, 'type': "channel", 'title': "t"},
+                            'caption': _random_ad(rng, 60), 'reply_markup': markup},
+            }})
+    return json.dumps({'ok': True, 'result': updates}, ensure_ascii=False).encode()
+
+
+async def _runtime_round(fast: bool, body: bytes, rounds: int) -> Tuple[float, float, int]:
+    """Разбор getUpdates, валидация Update, диспетчеризация и сборка ответного sendMessage. -> (стена, CPU, апдейтов)."""
+    from aiogram import Bot, Dispatcher
+    from aiogram.methods import SendMessage
+    from aiogram.types import Update
+
+    session = bot.create_bot_session(fast)
+    tg_bot = Bot("123456:BENCH", session=session)
+    dp = Dispatcher()
+
+    async def reply(event):
+        chat_id = event.chat.id if hasattr(event, 'chat') else event.from_user.id
+        method = SendMessage(chat_id=chat_id, text="Принято", reply_markup=bot.kb_moderation_main(chat_id))
+        session.build_form_data(tg_bot, method)
+
+    dp.message.register(reply)
+    dp.callback_query.register(reply)
+
+    wall, cpu, processed = time.perf_counter(), time.process_time(), 0
+    for _ in range(rounds):
+        for raw in session.json_loads(body.decode())['result']:
+            await dp.feed_update(tg_bot, Update.model_validate(raw, context={'bot': tg_bot}))
+            processed += 1
+    wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+    await session.close()
+    return wall, cpu, processed
+
+
+def bench_runtime(args):
+    """Пропускная способность и CPU на апдейт: стандартный режим против FAST_RUNTIME (uvloop + orjson)."""
+    # Построчный лог aiogram о каждом апдейте в файл перекрыл бы разницу кодеков
+    logging.getLogger("aiogram.event").setLevel(logging.WARNING)
+    body = _fake_updates(random.Random(3), 100)
+    rounds = max(args.queries // 100, 1)
+    results = {}
+    for fast in (False, True):
+        with asyncio.Runner(loop_factory=bot.event_loop_factory(fast)) as runner:
+            runner.run(_runtime_round(fast, body, 1))  # Прогрев: импорты, кэши pydantic
+            wall, cpu, processed = runner.run(_runtime_round(fast, body, rounds))
+        results[fast] = processed / wall
+        print(f"{bot.describe_runtime(fast)}: {processed / wall:.0f} апд/с, CPU {cpu / processed * 1e6:.1f} мкс/апд")
+    print(f"Ускорение: x{results[True] / results[False]:.2f}")
+
+
+def bench_prefilter(args):
+    """Стоимость префильтра на одну подачу при росте числа правил (ключевые слова + регулярки с якорями)."""
+    rng = random.Random(11)
+    submissions = [
+        {'description': _random_ad(rng, 60), 'price': f"{rng.randrange(100, 100_000)} руб", 'contact': "@seller"}
+        for _ in range(args.queries)
+    ]
+    for rules_count in (10, 100, 1_000, 5_000):
+        rules = [{'action': rng.choice(("reject", "flag")), 'keyword': f"стоп{i}слово"} for i in range(rules_count)]
+        rules += [{'action': "flag", 'regex': rf"{word}\s+\d+", 'anchors': [word]} for word in rng.sample(WORDS, 20)]
+        started = time.perf_counter()
+        bot.ContentPrefilter.compile(rules)
+        compiled = time.perf_counter() - started
+
+        samples = []
+        for fields in submissions:
+            t0 = time.perf_counter()
+            bot.ContentPrefilter.check(fields)
+            samples.append(time.perf_counter() - t0)
+        print(f"Правил {len(rules)} (компиляция {compiled * 1000:.0f} мс):", end=" ")
+        _report("проверка", samples)
+
+
+def _random_draft_fields(rng: random.Random) -> Dict:
+    """Поля черновика как у живой подачи: альбом из 1-4 фото, описание, цена, контакт и ID сообщений."""
+    def file_id(length: int) -> str:
+        return base64.urlsafe_b64encode(rng.randbytes(length * 3 // 4)).decode()  # file_id — base64url
+
+    photos = rng.randint(1, 4)
+    return {
+        'description': _random_ad(rng, rng.randint(15, 60)),
+        'price': f"{rng.randrange(100, 100_000)} руб",
+        'contact': f"@seller{rng.randrange(100_000)}",
+        'photo_ids': [file_id(84) for _ in range(photos)],
+        'photo_refs': [[file_id(20), file_id(84)] for _ in range(photos)],
+        'instruction_message_id': rng.randrange(1, 10**7),
+        'draft_message_id': rng.randrange(1, 10**7),
+        'draft_album_ids': [rng.randrange(1, 10**7) for _ in range(photos)] if photos > 1 else [],
+    }
+
+
+def _sessions_footprint(raws: List[bytes], make: Callable) -> float:
+    """Байт на сессию: прирост памяти после создания данных FSM функцией make из каждого черновика raws."""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    sessions = [make(bot.AdDraft.from_bytes(raw)) for raw in raws]
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del sessions
+    return used / len(raws)
+
+
+def bench_drafts(args):
+    """Память на сессию при N одновременных черновиках: словарь полей в FSM против AdDraft и его байтов."""
+    rng = random.Random(5)
+    # Исходные черновики генерируются до замера; каждый вариант строит из них свои (новые) объекты
+    raws = [bot.AdDraft(**_random_draft_fields(rng)).to_bytes() for _ in range(args.sessions)]
+    variants = (
+        ("dict (как было)", lambda draft: {name: getattr(draft, name) for name in bot.AdDraft.__slots__}),
+        ("AdDraft", lambda draft: draft),
+        ("{'draft': bytes} (FSM)", lambda draft: {'draft': draft.to_bytes()}),
+    )
+    for name, make in variants:
+        per_session = _sessions_footprint(raws, make)
+        print(f"{name}: {per_session:.0f} Б/сессию, {per_session * args.sessions / 2**20:.1f} МБ на {args.sessions}")
+
+    # Цена хранения в байтах: каждый шаг хендлера распаковывает и упаковывает черновик заново
+    samples = []
+    for raw in raws[:args.queries]:
+        t0 = time.perf_counter()
+        bot.AdDraft.from_bytes(raw).to_bytes()
+        samples.append(time.perf_counter() - t0)
+    _report("распаковка + упаковка", samples)
+
+
+BENCHMARKS: Dict[str, Callable] = {
+    "minhash": bench_minhash,
+    "search": bench_search,
+    "runtime": bench_runtime,
+    "prefilter": bench_prefilter,
+    "drafts": bench_drafts,
+    "user": bench_user,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарки бота")
+    parser.add_argument("name", choices=sorted(BENCHMARKS))
+    parser.add_argument("--ads", type=int, default=100_000, help="Размер истории объявлений")
+    parser.add_argument("--queries", type=int, default=1000, help="Количество замеряемых запросов")
+    parser.add_argument("--sessions", type=int, default=100_000, help="Одновременных черновиков (drafts)")
+    args = parser.parse_args()
+    result = BENCHMARKS[args.name](args)
+    if asyncio.iscoroutine(result):
+        asyncio.run(result)
+
+
+if __name__ == "__main__":
+    main()
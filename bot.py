@@ -1,28 +1,72 @@
 # bot.py
 
 import asyncio
+import csv
+import gzip
+import hashlib
+import hmac
+import io
+import json
 import logging
+import marshal
+import cProfile
+import pstats
+import random
 import re
 import os
+import signal
+import sqlite3
+import struct
 import sys
-from datetime import datetime
+import threading
+import time
+import traceback
+import tracemalloc
+import zipfile
+import zlib
+from bisect import bisect_left
+from contextlib import asynccontextmanager, contextmanager, suppress
+from contextvars import ContextVar
+from collections import Counter, deque
+from datetime import datetime, timedelta
+from urllib.parse import quote
 import pytz
-from typing import Optional, Dict, Any, Tuple, List, Union
+from typing import Optional, Dict, Any, Tuple, List, Union, Set, Callable, Awaitable, Deque
 # Используем aiosqlite
 import aiosqlite
-
-from aiogram import Bot, Dispatcher, types, F
+import numpy as np
+
+# Необязательные зависимости быстрого режима (SETTINGS.FAST_RUNTIME): без них бот работает на стандартных asyncio и json
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+# Необязательная зависимость поиска похожих фото: без Pillow ищутся только точные повторы (по file_unique_id)
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+from aiogram import Bot, Dispatcher, BaseMiddleware, types, F
 from aiogram.enums import ParseMode, ChatType
 from aiogram.filters import Command, CommandStart, StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.client.default import DefaultBotProperties
-from aiogram.exceptions import TelegramBadRequest, TelegramAPIError
-from aiogram.types import Message, CallbackQuery, InputMediaPhoto, InputMedia
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.methods import TelegramMethod
+from aiogram.exceptions import TelegramBadRequest, TelegramAPIError, TelegramRetryAfter
+from aiogram.types import Message, CallbackQuery, InputMediaPhoto, InputMedia, TelegramObject, Update
+from pydantic import ValidationError
 
 # Импорт настроек
-from config import SETTINGS, RENDER_PORT
+from config import SETTINGS, BASE_SETTINGS, CURRENT_SETTINGS, Config, RENDER_PORT
 
 # ! ВАЖНО: Добавляем aiohttp для заглушки Web-сервера Render
 from aiohttp import web 
@@ -30,84 +74,549 @@ from aiohttp import web
 
 TIMEZONE = pytz.timezone(SETTINGS.TIMEZONE_NAME)
 
+
+# --- ТЕНАНТЫ (НЕСКОЛЬКО БОТОВ В ОДНОМ ПРОЦЕССЕ) ---
+# Тенант — бот со своими каналами, владельцем и файлом БД. Все тенанты работают на одном event loop и одном
+# веб-сервере. Код бота один: SETTINGS и синглтоны-TenantLocal (кэш, метрики, планировщик, ...) отдают данные
+# тенанта из контекста (ContextVar). Контекст задает tenant_scope(): задачи, созданные внутри, наследуют его,
+# поэтому polling тенанта, его хендлеры и фоновые задачи работают со своими данными.
+
+# Поля, которые читаются один раз на процесс и не переопределяются тенантом
+TENANT_PROCESS_SETTINGS = {
+    'TIMEZONE_NAME', 'LOG_FILE', 'MEDIA_GROUP_DEBOUNCE', 'FAST_RUNTIME', 'TENANTS_PATH',
+    'LOOP_LAG_INTERVAL', 'LOOP_STALL_THRESHOLD', 'LOOP_REPORT_INTERVAL', 'LOOP_ALERT_COOLDOWN',
+}
+# Поля, которые у разных тенантов обязаны различаться (пустые значения не сравниваются)
+TENANT_UNIQUE_SETTINGS = ('BOT_TOKEN', 'DB_NAME', 'RECORD_UPDATES_PATH')
+TENANT_NAME_PATTERN = re.compile(r'^[a-z0-9_-]{1,32}$')
+
+
+class Tenant:
+    """Настройки тенанта, его экземпляры TenantLocal и объекты запуска (bot, запись апдейтов)."""
+
+    def __init__(self, name: str, settings: Config):
+        self.name = name
+        self.settings = settings
+        self.locals: Dict['TenantLocal', Any] = {}
+        self.bot: Optional[Bot] = None
+        self.recorder: Optional['UpdateRecorder'] = None
+
+
+DEFAULT_TENANT = Tenant('default', BASE_SETTINGS)
+CURRENT_TENANT: ContextVar[Tenant] = ContextVar('current_tenant', default=DEFAULT_TENANT)
+# Запущенные тенанты по имени (заполняет main)
+TENANTS: Dict[str, Tenant] = {}
+
+
+@contextmanager
+def tenant_scope(tenant: Tenant):
+    """Код внутри блока (и задачи, созданные в нем) работает с настройками и данными тенанта."""
+    tenant_token = CURRENT_TENANT.set(tenant)
+    settings_token = CURRENT_SETTINGS.set(tenant.settings)
+    try:
+        yield
+    finally:
+        CURRENT_SETTINGS.reset(settings_token)
+        CURRENT_TENANT.reset(tenant_token)
+
+
+class TenantLocal:
+    """
+    Синглтон на тенанта: атрибуты и индексация проксируются в экземпляр factory() текущего тенанта,
+    который создается при первом обращении в его контексте. resolve() — сам экземпляр.
+    """
+    __slots__ = ('_factory',)
+
+    def __init__(self, factory: Callable[[], Any]):
+        object.__setattr__(self, '_factory', factory)
+
+    def resolve(self) -> Any:
+        tenant = CURRENT_TENANT.get()
+        instance = tenant.locals.get(self)
+        if instance is None:
+            instance = tenant.locals[self] = self._factory()
+        return instance
+
+    def __getattr__(self, name: str):
+        return getattr(self.resolve(), name)
+
+    def __setattr__(self, name: str, value: Any):
+        setattr(self.resolve(), name, value)
+
+    def __getitem__(self, key):
+        return self.resolve()[key]
+
+    def __setitem__(self, key, value):
+        self.resolve()[key] = value
+
+    def __iter__(self):
+        return iter(self.resolve())
+
+    def __len__(self) -> int:
+        return len(self.resolve())
+
+
+def load_tenants(path: str) -> List[Tenant]:
+    """
+    Реестр тенантов из JSON: {"tenants": [{"name": "...", <поля Config>}, ...]}.
+    Не заданные у тенанта поля берутся из config.py. При ошибке бросает ValueError.
+    """
+    with open(path, encoding='utf-8') as f:
+        entries = json.load(f).get('tenants', [])
+    if not entries:
+        raise ValueError("в реестре нет ни одного тенанта")
+
+    base = BASE_SETTINGS.model_dump()
+    tenants: List[Tenant] = []
+    seen: Dict[str, Set[Any]] = {key: set() for key in ('name', *TENANT_UNIQUE_SETTINGS)}
+    for index, entry in enumerate(entries, start=1):
+        overrides = dict(entry)
+        name = str(overrides.pop('name', ''))
+        if not TENANT_NAME_PATTERN.match(name):
+            raise ValueError(f"тенант {index}: name — латиница в нижнем регистре, цифры, _ и -, до 32 символов")
+        unknown = set(overrides) - set(base)
+        if unknown:
+            raise ValueError(f"тенант {name}: неизвестные поля {', '.join(sorted(unknown))}")
+        shared = set(overrides) & TENANT_PROCESS_SETTINGS
+        if shared:
+            raise ValueError(f"тенант {name}: поля {', '.join(sorted(shared))} общие для процесса, задаются в config.py")
+        try:
+            settings = Config(**{**base, **overrides})
+        except ValidationError as e:
+            raise ValueError(f"тенант {name}: {e}")
+
+        for key, values in seen.items():
+            value = name if key == 'name' else getattr(settings, key)
+            if value in values:
+                raise ValueError(f"тенант {name}: {key} совпадает с другим тенантом")
+            if value:
+                values.add(value)
+        tenants.append(Tenant(name, settings))
+    return tenants
+
+
+class TenantLogFilter(logging.Filter):
+    """Добавляет к записям лога префикс тенанта (в режиме одного бота — пусто)."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        tenant = CURRENT_TENANT.get()
+        record.tenant_prefix = "" if tenant is DEFAULT_TENANT else f"[{tenant.name}] "
+        return True
+
+
 # Логирование
 logging.basicConfig(
     level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
+    format='%(asctime)s - %(levelname)s - %(tenant_prefix)s%(message)s',
     handlers=[
         logging.FileHandler(SETTINGS.LOG_FILE, encoding='utf-8'),
         logging.StreamHandler(sys.stdout) # Используем sys.stdout для логов Render
     ]
 )
+for _handler in logging.getLogger().handlers:
+    _handler.addFilter(TenantLogFilter())
 
-# Шаблон для удаления служебной информации
+# Шаблон для удаления служебной информации (только для постов, отправленных до сохранения body_html)
 AUTHOR_SIG_PATTERN = re.compile(r'\n+— ID Автора:.*?—\s*$', re.DOTALL)
 
 
+# --- БЫСТРЫЙ РЕЖИМ (uvloop + orjson) ---
+
+def json_codec(fast: bool) -> Tuple[Callable[[Union[str, bytes]], Any], Callable[[Any], str]]:
+    """Пара loads/dumps для сессии Bot: orjson в быстром режиме (если установлен), иначе стандартный json."""
+    if fast and orjson is not None:
+        return orjson.loads, lambda obj: orjson.dumps(obj).decode()
+    return json.loads, json.dumps
+
+
+def create_bot_session(fast: bool, **kwargs) -> AiohttpSession:
+    """
+    Сессия Bot API: ответы (включая getUpdates) разбираются и запросы собираются выбранным JSON-кодеком,
+    отправка идет через планировщик OUTBOUND тенанта, в контексте которого создана сессия (лимиты Telegram — на бота).
+    """
+    json_loads, json_dumps = json_codec(fast)
+    session = AiohttpSession(json_loads=json_loads, json_dumps=json_dumps, **kwargs)
+    session.middleware(OUTBOUND.resolve())
+    return session
+
+
+def event_loop_factory(fast: bool) -> Optional[Callable[[], asyncio.AbstractEventLoop]]:
+    """uvloop в быстром режиме (если установлен), иначе None — стандартный цикл asyncio."""
+    return uvloop.new_event_loop if fast and uvloop is not None else None
+
+
+def describe_runtime(fast: bool) -> str:
+    if not fast:
+        return "стандартный (asyncio + json)"
+    missing = [name for name, module in (("uvloop", uvloop), ("orjson", orjson)) if module is None]
+    loop_name = "uvloop" if uvloop is not None else "asyncio"
+    codec_name = "orjson" if orjson is not None else "json"
+    note = f"; не установлены: {', '.join(missing)}" if missing else ""
+    return f"быстрый ({loop_name} + {codec_name}{note})"
+
+
+# Счетчики событий тенанта (с момента запуска): имя -> значение
+METRICS = TenantLocal(Counter)
+# Счетчики процесса в целом (event loop общий для всех тенантов)
+PROCESS_METRICS: Counter = Counter()
+
+
 # --- АСИНХРОННЫЙ МЕНЕДЖЕР БАЗЫ ДАННЫХ (СИНГЛТОН) ---
 
 class DatabaseManager:
-    """Управляет единственным асинхронным подключением к aiosqlite."""
-    _connection: Optional[aiosqlite.Connection] = None
+    """Управляет асинхронными подключениями к aiosqlite: по одному на файл БД (SETTINGS.DB_NAME текущего тенанта)."""
+    _connections: Dict[str, aiosqlite.Connection] = {}
 
     @classmethod
     async def get_connection(cls) -> aiosqlite.Connection:
-        """Получает или создает одно подключение к БД."""
-        if cls._connection is None:
+        """Получает или создает подключение к БД текущего тенанта."""
+        connection = cls._connections.get(SETTINGS.DB_NAME)
+        if connection is None:
             # Установим более длительный таймаут для предотвращения блокировок
-            cls._connection = await aiosqlite.connect(SETTINGS.DB_NAME, timeout=10)
-            cls._connection.row_factory = aiosqlite.Row  # Удобно для именованных столбцов
-        return cls._connection
+            connection = await aiosqlite.connect(SETTINGS.DB_NAME, timeout=10)
+            connection.row_factory = aiosqlite.Row  # Удобно для именованных столбцов
+            # WAL: чтение (в т.ч. резервное копирование) не блокирует запись; режим сохраняется в файле БД
+            async with connection.execute("PRAGMA journal_mode=WAL") as cursor:
+                await cursor.fetchone()  # Незавершенный запрос помешал бы COMMIT в executescript
+            cls._connections[SETTINGS.DB_NAME] = connection
+        return connection
+
+    @classmethod
+    def read_only_connection(cls) -> aiosqlite.Connection:
+        """
+        Отдельное подключение только для чтения (открывается и закрывается через async with) — для долгих выгрузок:
+        открытый запрос не держит общее подключение, а WAL дает ему снимок БД на момент начала чтения.
+        """
+        return aiosqlite.connect(f"file:{quote(SETTINGS.DB_NAME)}?mode=ro", uri=True, timeout=10)
 
     @classmethod
     async def close_connection(cls):
-        """Закрывает подключение."""
-        if cls._connection:
-            await cls._connection.close()
-            cls._connection = None
+        """Закрывает подключение текущего тенанта."""
+        connection = cls._connections.pop(SETTINGS.DB_NAME, None)
+        if connection:
+            await connection.close()
 
     @classmethod
     async def init_db(cls):
-        """Создает таблицы, если их нет."""
+        """Применяет недостающие миграции схемы (по PRAGMA user_version)."""
         db = await cls.get_connection()
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS stats (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                event_type TEXT,
-                created_at DATETIME, -- UTC ISO
-                moderated_at DATETIME, -- UTC ISO
-                moderated_date_str TEXT -- YYYY-MM-DD в локальной TZ
-            )
-        ''')
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS user_limits (
-                user_id INTEGER,
-                date_str TEXT, -- YYYY-MM-DD в локальной TZ
-                count INTEGER,
-                PRIMARY KEY (user_id, date_str)
-            )
-        ''')
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS banned_users (
-                user_id INTEGER PRIMARY KEY,
-                banned_by INTEGER,
-                banned_at DATETIME, -- UTC ISO
-                reason TEXT
-            )
-        ''')
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS pending_posts (
-                message_id INTEGER PRIMARY KEY,
-                user_id INTEGER,
-                submitted_at DATETIME -- UTC ISO
-            )
-        ''')
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS broadcast_users (
-                user_id INTEGER PRIMARY KEY
-            )
-        ''')
-        await db.commit()
+        async with db.execute("PRAGMA user_version") as cursor:
+            current_version = (await cursor.fetchone())[0]
+
+        if current_version >= len(MIGRATIONS):
+            logging.info(f"🗄️ Схема БД актуальна (версия {current_version}).")
+            return
+
+        for version, script in enumerate(MIGRATIONS[current_version:], start=current_version + 1):
+            # Каждая миграция и смена версии выполняются одной транзакцией
+            await db.executescript(f"BEGIN;\n{script}\nPRAGMA user_version = {version};\nCOMMIT;")
+            logging.info(f"🗄️ Применена миграция схемы БД до версии {version}.")
+
+
+# Верхние границы (сек) корзин гистограммы времени модерации; последняя корзина (индекс len) — все, что дольше
+LATENCY_BUCKETS: List[int] = [
+    30, 60, 120, 300, 600, 900, 1800, 3600, 7200, 14400, 28800, 43200, 86400, 172800, 604800
+]
+
+
+def _latency_bucket_sql(seconds_expr: str) -> str:
+    """SQL-выражение: индекс корзины LATENCY_BUCKETS для задержки seconds_expr (для бэкфилла в миграции)."""
+    cases = " ".join(f"WHEN {seconds_expr} <= {bound} THEN {index}" for index, bound in enumerate(LATENCY_BUCKETS))
+    return f"CASE {cases} ELSE {len(LATENCY_BUCKETS)} END"
+
+
+def _local_date_sql(utc_expr: str) -> str:
+    """SQL-выражение: дата YYYY-MM-DD в TIMEZONE для UTC-времени utc_expr (смещение берется на момент запуска)."""
+    offset = int(datetime.now(TIMEZONE).utcoffset().total_seconds())
+    return f"date({utc_expr}, '{offset:+d} seconds')"
+
+
+# --- МИГРАЦИИ СХЕМЫ ---
+# Порядковый номер миграции (с 1) соответствует PRAGMA user_version после её применения.
+# Уже выпущенные миграции не меняем — только добавляем новые в конец списка.
+
+MIGRATIONS: List[str] = [
+    # 1: Базовые таблицы
+    '''
+    CREATE TABLE IF NOT EXISTS stats (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        event_type TEXT,
+        created_at DATETIME, -- UTC ISO
+        moderated_at DATETIME, -- UTC ISO
+        moderated_date_str TEXT -- YYYY-MM-DD в локальной TZ
+    );
+    CREATE TABLE IF NOT EXISTS user_limits (
+        user_id INTEGER,
+        date_str TEXT, -- YYYY-MM-DD в локальной TZ
+        count INTEGER,
+        PRIMARY KEY (user_id, date_str)
+    );
+    CREATE TABLE IF NOT EXISTS banned_users (
+        user_id INTEGER PRIMARY KEY,
+        banned_by INTEGER,
+        banned_at DATETIME, -- UTC ISO
+        reason TEXT
+    );
+    CREATE TABLE IF NOT EXISTS pending_posts (
+        message_id INTEGER PRIMARY KEY,
+        user_id INTEGER,
+        submitted_at DATETIME -- UTC ISO
+    );
+    CREATE TABLE IF NOT EXISTS broadcast_users (
+        user_id INTEGER PRIMARY KEY
+    );
+    ''',
+    # 2: Вторичные индексы для статистики и предложки
+    '''
+    CREATE INDEX IF NOT EXISTS idx_stats_date_type ON stats (moderated_date_str, event_type);
+    CREATE INDEX IF NOT EXISTS idx_stats_type ON stats (event_type);
+    CREATE INDEX IF NOT EXISTS idx_pending_user ON pending_posts (user_id);
+    CREATE INDEX IF NOT EXISTS idx_pending_submitted ON pending_posts (submitted_at);
+    ''',
+    # 3: Фото поста в предложке (JSON-список file_id, для альбомов — несколько)
+    '''
+    ALTER TABLE pending_posts ADD COLUMN photo_ids TEXT;
+    ''',
+    # 4: Готовый к публикации пост (HTML) и данные автора — публикация без разбора подписи
+    '''
+    ALTER TABLE pending_posts ADD COLUMN body_html TEXT;
+    ALTER TABLE pending_posts ADD COLUMN author_username TEXT;
+    ALTER TABLE pending_posts ADD COLUMN author_full_name TEXT;
+    ''',
+    # 5: MinHash-сигнатуры объявлений и LSH-корзины для поиска похожих; пометки для модератора
+    '''
+    CREATE TABLE IF NOT EXISTS ad_signatures (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        message_id INTEGER, -- ID сообщения в предложке
+        user_id INTEGER,
+        created_at DATETIME, -- UTC ISO
+        signature BLOB -- MINHASH_PERMUTATIONS x uint32
+    );
+    CREATE TABLE IF NOT EXISTS ad_lsh_buckets (
+        bucket_key INTEGER, -- (номер полосы << 32) | хэш полосы
+        ad_id INTEGER,
+        PRIMARY KEY (bucket_key, ad_id)
+    ) WITHOUT ROWID;
+    ALTER TABLE pending_posts ADD COLUMN mod_notes TEXT;
+    ''',
+    # 6: Архив поданных объявлений и полнотекстовый индекс FTS5 по нему (обновляется триггерами)
+    '''
+    CREATE TABLE IF NOT EXISTS ads_archive (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        message_id INTEGER, -- ID сообщения в предложке
+        user_id INTEGER,
+        author_username TEXT,
+        author_full_name TEXT,
+        description TEXT,
+        price TEXT,
+        contact TEXT,
+        status TEXT, -- pending / published / rejected
+        submitted_at DATETIME, -- UTC ISO
+        moderated_at DATETIME -- UTC ISO
+    );
+    CREATE INDEX IF NOT EXISTS idx_archive_message ON ads_archive (message_id);
+    CREATE VIRTUAL TABLE IF NOT EXISTS ads_fts USING fts5(
+        description, price, contact, author_username, author_full_name,
+        content='ads_archive', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+    );
+    CREATE TRIGGER IF NOT EXISTS ads_archive_ai AFTER INSERT ON ads_archive BEGIN
+        INSERT INTO ads_fts (rowid, description, price, contact, author_username, author_full_name)
+        VALUES (new.id, new.description, new.price, new.contact, new.author_username, new.author_full_name);
+    END;
+    CREATE TRIGGER IF NOT EXISTS ads_archive_ad AFTER DELETE ON ads_archive BEGIN
+        INSERT INTO ads_fts (ads_fts, rowid, description, price, contact, author_username, author_full_name)
+        VALUES ('delete', old.id, old.description, old.price, old.contact, old.author_username, old.author_full_name);
+    END;
+    CREATE TRIGGER IF NOT EXISTS ads_archive_au
+    AFTER UPDATE OF description, price, contact, author_username, author_full_name ON ads_archive BEGIN
+        INSERT INTO ads_fts (ads_fts, rowid, description, price, contact, author_username, author_full_name)
+        VALUES ('delete', old.id, old.description, old.price, old.contact, old.author_username, old.author_full_name);
+        INSERT INTO ads_fts (rowid, description, price, contact, author_username, author_full_name)
+        VALUES (new.id, new.description, new.price, new.contact, new.author_username, new.author_full_name);
+    END;
+    ''',
+    # 7: Дата последнего визита пользователя (YYYY-MM-DD в локальной TZ) для выборок аудитории
+    '''
+    ALTER TABLE broadcast_users ADD COLUMN last_seen TEXT;
+    CREATE INDEX IF NOT EXISTS idx_broadcast_last_seen ON broadcast_users (last_seen);
+    ''',
+    # 8: Пул модераторов, назначение постов и захват поста на обработку (не более одного раза)
+    '''
+    CREATE TABLE IF NOT EXISTS moderators (
+        user_id INTEGER PRIMARY KEY,
+        added_by INTEGER,
+        added_at DATETIME, -- UTC ISO
+        is_online INTEGER DEFAULT 0
+    );
+    ALTER TABLE pending_posts ADD COLUMN assigned_to INTEGER;
+    ALTER TABLE pending_posts ADD COLUMN assigned_at DATETIME; -- UTC ISO
+    ALTER TABLE pending_posts ADD COLUMN claimed_by INTEGER;
+    CREATE INDEX IF NOT EXISTS idx_pending_assigned ON pending_posts (assigned_at);
+    ''',
+    # 9: Гистограммы времени модерации по дням (обновляются в async_db_add_stat), бэкфилл из stats
+    f'''
+    CREATE TABLE IF NOT EXISTS moderation_latency_hist (
+        day TEXT, -- YYYY-MM-DD в локальной TZ (как moderated_date_str)
+        bucket INTEGER, -- индекс корзины в LATENCY_BUCKETS
+        count INTEGER,
+        PRIMARY KEY (day, bucket)
+    ) WITHOUT ROWID;
+    INSERT OR IGNORE INTO moderation_latency_hist (day, bucket, count)
+    SELECT moderated_date_str,
+           {_latency_bucket_sql("(julianday(moderated_at) - julianday(created_at)) * 86400")} AS bucket,
+           COUNT(*)
+    FROM stats
+    WHERE created_at IS NOT NULL AND moderated_at IS NOT NULL
+    GROUP BY moderated_date_str, bucket;
+    ''',
+    # 10: История подач пользователя по времени (HTTP API и /user)
+    '''
+    CREATE INDEX IF NOT EXISTS idx_archive_user_time ON ads_archive (user_id, submitted_at);
+    ''',
+    # 11: Скользящее окно 24 ч вместо суточных счетчиков: одна строка на пользователя, отметки подач (epoch, сек)
+    # через запятую, от старых к новым. Окно заполняется по архиву подач за последние сутки (отклоненные не в счет);
+    # если сегодняшний счетчик user_limits больше, чем подач за сегодня в архиве, недостающие отметки ставятся
+    # временем миграции — иначе после обновления лимит на сегодня обнулился бы
+    f'''
+    CREATE TABLE IF NOT EXISTS user_windows (
+        user_id INTEGER PRIMARY KEY,
+        stamps TEXT NOT NULL
+    );
+    WITH archived AS (
+        SELECT user_id, submitted_at, CAST(strftime('%s', submitted_at) AS INTEGER) AS stamp FROM ads_archive
+        WHERE status != 'rejected' AND CAST(strftime('%s', submitted_at) AS INTEGER) > CAST(strftime('%s', 'now', '-1 day') AS INTEGER)
+    ), missing(user_id, n) AS (
+        SELECT user_id, count - (SELECT COUNT(*) FROM archived
+                                 WHERE archived.user_id = user_limits.user_id
+                                   AND {_local_date_sql('archived.submitted_at')} = user_limits.date_str)
+        FROM user_limits WHERE date_str = {_local_date_sql("'now'")}
+        UNION ALL
+        SELECT user_id, n - 1 FROM missing WHERE n > 1
+    )
+    INSERT OR REPLACE INTO user_windows (user_id, stamps)
+        SELECT user_id, group_concat(stamp, ',') FROM (
+            SELECT user_id, stamp FROM archived
+            UNION ALL
+            SELECT user_id, CAST(strftime('%s', 'now') AS INTEGER) FROM missing WHERE n > 0
+            ORDER BY user_id, stamp
+        ) GROUP BY user_id;
+    DROP TABLE IF EXISTS user_limits;
+    ''',
+    # 12: фото поданных объявлений — для поиска повторов (точных и перцептивно похожих)
+    '''
+    CREATE TABLE IF NOT EXISTS photo_hashes (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        message_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        created_at TEXT NOT NULL,
+        file_unique_id TEXT NOT NULL,
+        phash INTEGER
+    );
+    CREATE INDEX IF NOT EXISTS idx_photo_hashes_unique_id ON photo_hashes(file_unique_id);
+    ''',
+    # 13: Репутация авторов — счетчики решений модераторов; начальные значения — по архиву подач без автопубликаций.
+    # Прежние автопубликации (fast-track префильтра) узнаются по stats: время подачи там равно времени решения
+    '''
+    CREATE TABLE IF NOT EXISTS author_reputation (
+        user_id INTEGER PRIMARY KEY,
+        published INTEGER NOT NULL DEFAULT 0,
+        rejected INTEGER NOT NULL DEFAULT 0
+    );
+    ALTER TABLE ads_archive ADD COLUMN auto_published INTEGER NOT NULL DEFAULT 0;
+    UPDATE ads_archive SET auto_published = 1
+        WHERE status = 'published' AND moderated_at IN (
+            SELECT moderated_at FROM stats
+            WHERE event_type = 'published' AND (julianday(moderated_at) - julianday(created_at)) * 86400 < 1
+        );
+    INSERT OR REPLACE INTO author_reputation (user_id, published, rejected)
+        SELECT user_id, SUM(status = 'published'), SUM(status = 'rejected') FROM ads_archive
+        WHERE status IN ('published', 'rejected') AND NOT auto_published GROUP BY user_id;
+    ''',
+    # 14: История пользователя для /user: автор решения в stats, журнал банов, индексы (user_id, время) и счетчики
+    # подач и решений (user_totals, ведутся в async_db_archive_ad и async_db_add_stat, начальные — по архиву).
+    # В старых строках stats автор восстанавливается по архиву: решение пишется в обе таблицы с одним moderated_at
+    '''
+    ALTER TABLE stats ADD COLUMN user_id INTEGER;
+    CREATE INDEX IF NOT EXISTS idx_archive_moderated_tmp ON ads_archive (moderated_at);
+    UPDATE stats SET user_id = (SELECT user_id FROM ads_archive WHERE ads_archive.moderated_at = stats.moderated_at
+                                LIMIT 1)
+        WHERE moderated_at IS NOT NULL;
+    DROP INDEX idx_archive_moderated_tmp;
+    CREATE INDEX IF NOT EXISTS idx_stats_user_time ON stats (user_id, moderated_at, event_type);
+    CREATE TABLE IF NOT EXISTS ban_history (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        action TEXT NOT NULL, -- ban / unban
+        moderator_id INTEGER,
+        reason TEXT,
+        created_at DATETIME NOT NULL -- UTC ISO
+    );
+    CREATE INDEX IF NOT EXISTS idx_ban_history_user_time ON ban_history (user_id, created_at);
+    INSERT INTO ban_history (user_id, action, moderator_id, reason, created_at)
+        SELECT user_id, 'ban', banned_by, reason, banned_at FROM banned_users;
+    CREATE TABLE IF NOT EXISTS user_totals (
+        user_id INTEGER PRIMARY KEY,
+        submitted INTEGER NOT NULL DEFAULT 0,
+        published INTEGER NOT NULL DEFAULT 0,
+        rejected INTEGER NOT NULL DEFAULT 0
+    );
+    INSERT OR REPLACE INTO user_totals (user_id, submitted, published, rejected)
+        SELECT user_id, COUNT(*), SUM(status = 'published'), SUM(status = 'rejected') FROM ads_archive
+        GROUP BY user_id;
+    ''',
+]
+
+
+# --- КЭШ ГОРЯЧИХ ДАННЫХ В ПАМЯТИ ---
+
+class TenantMemoryCache:
+    """Горячие данные, которые нужны почти на каждый апдейт: баны, окна подач, аудитория рассылки."""
+
+    def __init__(self):
+        self.warmed = False
+        self.banned_ids: Set[int] = set()
+        # Скользящее окно подач: user_id -> отметки времени (epoch, сек) подач за последние 24 часа, от старых к новым
+        self.submission_windows: Dict[int, Deque[int]] = {}
+        # Все известные пользователи рассылки: user_id -> last_seen; и еще не записанные в БД визиты
+        self.broadcast_last_seen: Dict[int, Optional[str]] = {}
+        self.broadcast_pending: Dict[int, str] = {}
+        # Модераторы (кроме владельца), кто из модераторов сейчас на смене и сколько постов на каждом
+        self.moderators: Set[int] = set()
+        self.online_moderators: Set[int] = set()
+        self.moderator_load: Dict[int, int] = {}
+        # Перцептивные хэши фото прошлых объявлений -> (message_id, user_id, created_at)
+        self.photo_hashes = MultiIndexHashTable()
+        # Репутация авторов: user_id -> (одобрено, отклонено) модераторами
+        self.reputation: Dict[int, Tuple[int, int]] = {}
+
+    async def warm_up(self):
+        """Загружает кэш из БД. Вызывается один раз до старта polling."""
+        db = await DatabaseManager.get_connection()
+        async with db.execute("SELECT user_id FROM banned_users") as cursor:
+            self.banned_ids = {row[0] for row in await cursor.fetchall()}
+        async with db.execute("SELECT user_id, stamps FROM user_windows") as cursor:
+            self.submission_windows = {row[0]: _parse_submission_window(row[1]) for row in await cursor.fetchall()}
+        async with db.execute("SELECT user_id, last_seen FROM broadcast_users") as cursor:
+            self.broadcast_last_seen = {row[0]: row[1] for row in await cursor.fetchall()}
+        async with db.execute("SELECT user_id, is_online FROM moderators") as cursor:
+            rows = await cursor.fetchall()
+            self.moderators = {row[0] for row in rows}
+            self.online_moderators = {row[0] for row in rows if row[1]}
+        async with db.execute("SELECT assigned_to, COUNT(*) FROM pending_posts WHERE assigned_to IS NOT NULL "
+                              "GROUP BY assigned_to") as cursor:
+            self.moderator_load = {row[0]: row[1] for row in await cursor.fetchall()}
+        self.photo_hashes = MultiIndexHashTable()
+        async with db.execute("SELECT phash, message_id, user_id, created_at FROM photo_hashes "
+                              "WHERE phash IS NOT NULL") as cursor:
+            async for row in cursor:
+                self.photo_hashes.add(_phash_from_sqlite(row[0]), (row[1], row[2], row[3]))
+        async with db.execute("SELECT user_id, published, rejected FROM author_reputation") as cursor:
+            self.reputation = {row[0]: (row[1], row[2]) for row in await cursor.fetchall()}
+        self.warmed = True
+
+
+# Кэш текущего тенанта
+MemoryCache = TenantLocal(TenantMemoryCache)
 
 
 # --- Вспомогательные функции для работы со временем ---
@@ -118,7 +627,7 @@ def _get_datetime_now_utc_str() -> str:
 
 
 def _get_limit_date_str() -> str:
-    """Получает строку с датой для лимита (по настроенной TIMEZONE)."""
+    """Получает строку с текущей датой (по настроенной TIMEZONE): день статистики и визитов."""
     return datetime.now(TIMEZONE).strftime("%Y-%m-%d")
 
 
@@ -128,10 +637,26 @@ def _to_tz_datetime(iso_utc_str: str) -> datetime:
     return dt_utc.astimezone(TIMEZONE)
 
 
+def format_slot_time(slot: Optional[datetime]) -> str:
+    """Время освобождения слота для пользователя: 'сегодня в 14:05' / 'завтра в 09:30' / 'сейчас'."""
+    if slot is None:
+        return "сейчас"
+    today = datetime.now(TIMEZONE).date()
+    if slot.date() == today:
+        day = "сегодня"
+    elif slot.date() == today + timedelta(days=1):
+        day = "завтра"
+    else:
+        day = slot.strftime('%d.%m.%Y')
+    return f"{day} в {slot.strftime('%H:%M')}"
+
+
 # --- Функции для бана/лимитов/статистики (Асинхронные, используем DatabaseManager) ---
 
 async def async_db_is_banned(user_id: int) -> bool:
     """Проверяет, забанен ли пользователь (асинхронно)."""
+    if MemoryCache.warmed:
+        return user_id in MemoryCache.banned_ids
     db = await DatabaseManager.get_connection()
     async with db.execute("SELECT 1 FROM banned_users WHERE user_id = ?", (user_id,)) as cursor:
         return await cursor.fetchone() is not None
@@ -145,92 +670,243 @@ async def async_db_ban_user(user_id: int, moderator_id: int, reason: str = "Не
         "INSERT OR REPLACE INTO banned_users (user_id, banned_by, banned_at, reason) VALUES (?, ?, ?, ?)",
         (user_id, moderator_id, now_utc_str, reason)
     )
+    await db.execute(
+        "INSERT INTO ban_history (user_id, action, moderator_id, reason, created_at) VALUES (?, 'ban', ?, ?, ?)",
+        (user_id, moderator_id, reason, now_utc_str)
+    )
     await db.commit()
+    MemoryCache.banned_ids.add(user_id)
 
 
-async def async_db_unban_user(user_id: int):
+async def async_db_unban_user(user_id: int, moderator_id: Optional[int] = None):
     """Разбанивает пользователя (асинхронно)."""
     db = await DatabaseManager.get_connection()
     await db.execute("DELETE FROM banned_users WHERE user_id = ?", (user_id,))
+    await db.execute(
+        "INSERT INTO ban_history (user_id, action, moderator_id, created_at) VALUES (?, 'unban', ?, ?)",
+        (user_id, moderator_id, _get_datetime_now_utc_str())
+    )
     await db.commit()
+    MemoryCache.banned_ids.discard(user_id)
 
 
-async def async_db_get_current_limit_count(user_id: int) -> int:
-    """Получает текущее количество поданных постов за сегодня (асинхронно)."""
-    if user_id == SETTINGS.OWNER_ID: return 0
-    today_str = _get_limit_date_str()
+async def async_db_ban_users(entries: Dict[int, str], moderator_id: int) -> int:
+    """
+    Банит пачку пользователей {user_id: причина} одной транзакцией (асинхронно).
+    Возвращает, сколько из них не были забанены раньше.
+    """
+    now_utc_str = _get_datetime_now_utc_str()
     db = await DatabaseManager.get_connection()
-    async with db.execute("SELECT COALESCE(count, 0) FROM user_limits WHERE user_id = ? AND date_str = ?",
-                          (user_id, today_str)) as cursor:
-        result = await cursor.fetchone()
-        return result[0] if result else 0
+    await db.executemany(
+        "INSERT OR REPLACE INTO banned_users (user_id, banned_by, banned_at, reason) VALUES (?, ?, ?, ?)",
+        [(user_id, moderator_id, now_utc_str, reason) for user_id, reason in entries.items()]
+    )
+    await db.executemany(
+        "INSERT INTO ban_history (user_id, action, moderator_id, reason, created_at) VALUES (?, 'ban', ?, ?, ?)",
+        [(user_id, moderator_id, reason, now_utc_str) for user_id, reason in entries.items()]
+    )
+    await db.commit()
+    # Кэш меняется одним действием после коммита: хендлеры не увидят половину пачки
+    newly_banned = len(entries.keys() - MemoryCache.banned_ids)
+    MemoryCache.banned_ids |= entries.keys()
+    return newly_banned
 
 
-async def async_db_increment_limit(user_id: int):
-    """Увеличивает счетчик лимита на сегодня (асинхронно)."""
-    if user_id == SETTINGS.OWNER_ID: return
-    today_str = _get_limit_date_str()
+async def async_db_unban_users(user_ids: Set[int], moderator_id: Optional[int] = None) -> int:
+    """Разбанивает пачку пользователей одной транзакцией (асинхронно). Возвращает, сколько были забанены."""
+    was_banned = user_ids & MemoryCache.banned_ids
+    now_utc_str = _get_datetime_now_utc_str()
     db = await DatabaseManager.get_connection()
-    await db.execute(
-        "INSERT INTO user_limits (user_id, date_str, count) VALUES (?, ?, 1) "
-        "ON CONFLICT(user_id, date_str) DO UPDATE SET count = count + 1",
-        (user_id, today_str)
+    await db.executemany("DELETE FROM banned_users WHERE user_id = ?", [(user_id,) for user_id in user_ids])
+    await db.executemany(
+        "INSERT INTO ban_history (user_id, action, moderator_id, created_at) VALUES (?, 'unban', ?, ?)",
+        [(user_id, moderator_id, now_utc_str) for user_id in was_banned]
     )
     await db.commit()
+    MemoryCache.banned_ids -= user_ids
+    return len(was_banned)
 
 
-async def async_db_decrement_limit(user_id: int):
-    """Уменьшает счетчик лимита на сегодня (асинхронно)."""
-    if user_id == SETTINGS.OWNER_ID: return
-    today_str = _get_limit_date_str()
+# --- СКОЛЬЗЯЩЕЕ ОКНО ПОДАЧ (24 ЧАСА) ---
+# В окне не больше MAX_POSTS_PER_DAY отметок, поэтому deque(maxlen) работает как кольцевой буфер.
+# Проверка лимита выбрасывает устаревшие отметки с головы — амортизированно O(1).
+
+SUBMISSION_WINDOW_SECONDS = 24 * 60 * 60
+# Допуск (сек) между отметкой подачи и submitted_at поста: отметка ставится непосредственно перед записью в предложку
+SUBMISSION_REFUND_TOLERANCE = 2
+
+
+def _parse_submission_window(stamps: str) -> Deque[int]:
+    return deque((int(stamp) for stamp in stamps.split(',') if stamp), maxlen=SETTINGS.MAX_POSTS_PER_DAY)
+
+
+def _prune_submission_window(window: Deque[int]) -> Deque[int]:
+    """Убирает отметки старше 24 часов."""
+    expired_before = time.time() - SUBMISSION_WINDOW_SECONDS
+    while window and window[0] <= expired_before:
+        window.popleft()
+    return window
+
+
+async def _get_submission_window(user_id: int) -> Deque[int]:
+    """Актуальное окно подач пользователя (из кэша или из БД до прогрева)."""
+    window = MemoryCache.submission_windows.get(user_id)
+    if window is None and not MemoryCache.warmed:
+        db = await DatabaseManager.get_connection()
+        async with db.execute("SELECT stamps FROM user_windows WHERE user_id = ?", (user_id,)) as cursor:
+            row = await cursor.fetchone()
+        window = _parse_submission_window(row[0]) if row else None
+    if window is None:
+        return deque(maxlen=SETTINGS.MAX_POSTS_PER_DAY)
+    return _prune_submission_window(window)
+
+
+async def _save_submission_window(user_id: int, window: Deque[int]):
     db = await DatabaseManager.get_connection()
-    await db.execute(
-        "UPDATE user_limits SET count = count - 1 WHERE user_id = ? AND date_str = ? AND count > 0",
-        (user_id, today_str)
-    )
+    if window:
+        MemoryCache.submission_windows[user_id] = window
+        await db.execute("INSERT OR REPLACE INTO user_windows (user_id, stamps) VALUES (?, ?)",
+                         (user_id, ",".join(map(str, window))))
+    else:
+        MemoryCache.submission_windows.pop(user_id, None)
+        await db.execute("DELETE FROM user_windows WHERE user_id = ?", (user_id,))
     await db.commit()
 
 
+async def async_db_get_current_limit_count(user_id: int) -> int:
+    """Получает количество поданных постов за последние 24 часа (асинхронно)."""
+    if user_id == SETTINGS.OWNER_ID: return 0
+    return len(await _get_submission_window(user_id))
+
+
+async def async_db_get_next_slot_time(user_id: int) -> Optional[datetime]:
+    """Когда освободится ближайший слот: самая старая подача выйдет из окна (в TIMEZONE). None — окно пусто."""
+    window = await _get_submission_window(user_id)
+    if not window:
+        return None
+    return datetime.fromtimestamp(window[0] + SUBMISSION_WINDOW_SECONDS, TIMEZONE)
+
+
+async def async_db_increment_limit(user_id: int):
+    """Отмечает подачу в окне пользователя (асинхронно)."""
+    if user_id == SETTINGS.OWNER_ID: return
+    window = await _get_submission_window(user_id)
+    window.append(int(time.time()))
+    await _save_submission_window(user_id, window)
+
+
+async def async_db_decrement_limit(user_id: int, submitted_at: Optional[datetime] = None):
+    """
+    Возвращает слот (асинхронно): убирает из окна отметку этой подачи (в пределах SUBMISSION_REFUND_TOLERANCE
+    от submitted_at), а без submitted_at — самую свежую (откат неудачной отправки). Если подача уже вышла
+    из окна, возвращать нечего — чужие, более новые отметки не трогаем.
+    """
+    if user_id == SETTINGS.OWNER_ID: return
+    if submitted_at is not None and submitted_at.timestamp() <= time.time() - SUBMISSION_WINDOW_SECONDS:
+        return
+    window = await _get_submission_window(user_id)
+    if not window:
+        return
+    if submitted_at is None:
+        window.pop()
+    else:
+        target = submitted_at.timestamp()
+        closest = min(window, key=lambda stamp: abs(stamp - target))
+        if abs(closest - target) > SUBMISSION_REFUND_TOLERANCE:
+            return
+        window.remove(closest)
+    await _save_submission_window(user_id, window)
+
+
 # --- ФУНКЦИИ PENDING POSTS/BROADCAST ---
-async def async_db_record_pending_post(message_id: int, user_id: int):
-    """Записывает ID сообщения предложки и ID пользователя (асинхронно)."""
+async def async_db_record_pending_post(message_id: int, user_id: int, photo_ids: List[str], body_html: str,
+                                       author_username: Optional[str], author_full_name: str,
+                                       mod_notes: Optional[List[str]] = None, assigned_to: Optional[int] = None):
+    """
+    Записывает пост в предложке: ID сообщения, автора, готовый к публикации контент, пометки
+    и назначенного модератора (асинхронно).
+    """
     submitted_at_utc_str = _get_datetime_now_utc_str()
     db = await DatabaseManager.get_connection()
     await db.execute(
-        "INSERT INTO pending_posts (message_id, user_id, submitted_at) VALUES (?, ?, ?)",
-        (message_id, user_id, submitted_at_utc_str)
+        "INSERT INTO pending_posts (message_id, user_id, submitted_at, photo_ids, body_html, author_username, "
+        "author_full_name, mod_notes, assigned_to, assigned_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (message_id, user_id, submitted_at_utc_str, json.dumps(photo_ids), body_html, author_username,
+         author_full_name, json.dumps(mod_notes or []), assigned_to, submitted_at_utc_str if assigned_to else None)
     )
     await db.commit()
 
 
 async def async_db_add_broadcast_user(user_id: int):
-    """Добавляет пользователя в список для рассылки (асинхронно)."""
-    db = await DatabaseManager.get_connection()
-    await db.execute(
-        "INSERT OR IGNORE INTO broadcast_users (user_id) VALUES (?)",
-        (user_id,)
-    )
-    await db.commit()
+    """
+    Добавляет пользователя в список для рассылки и отмечает день визита (асинхронно).
+    Уже отмеченные сегодня пользователи не трогают БД; новые и сменившие день копятся и пишутся пачкой.
+    """
+    today_str = _get_limit_date_str()
+    if MemoryCache.broadcast_last_seen.get(user_id, "") == today_str:
+        return
+    MemoryCache.broadcast_last_seen[user_id] = today_str
+    MemoryCache.broadcast_pending[user_id] = today_str
+    if len(MemoryCache.broadcast_pending) >= SETTINGS.BROADCAST_FLUSH_BATCH:
+        await async_db_flush_broadcast_users()
+
+
+async def async_db_flush_broadcast_users():
+    """Записывает накопленных пользователей рассылки одной пачкой (асинхронно)."""
+    pending = MemoryCache.broadcast_pending
+    if not pending:
+        return
+    MemoryCache.broadcast_pending = {}
+    try:
+        db = await DatabaseManager.get_connection()
+        await db.executemany(
+            "INSERT INTO broadcast_users (user_id, last_seen) VALUES (?, ?) "
+            "ON CONFLICT(user_id) DO UPDATE SET last_seen = excluded.last_seen",
+            pending.items()
+        )
+        await db.commit()
+    except Exception:
+        # Возвращаем пачку в очередь до следующего сброса; отметки, пришедшие за время записи, новее
+        MemoryCache.broadcast_pending = {**pending, **MemoryCache.broadcast_pending}
+        raise
+
+
+async def broadcast_flush_loop():
+    """Фоновая задача: периодически сбрасывает накопленных пользователей рассылки в БД."""
+    while True:
+        await asyncio.sleep(SETTINGS.BROADCAST_FLUSH_INTERVAL)
+        try:
+            await async_db_flush_broadcast_users()
+        except Exception as e:
+            logging.error(f"Failed to flush broadcast users: {e}")
 
 
 async def async_db_get_all_broadcast_users() -> List[int]:
     """Возвращает список ID всех пользователей для рассылки (асинхронно)."""
+    await async_db_flush_broadcast_users()
     db = await DatabaseManager.get_connection()
     async with db.execute("SELECT user_id FROM broadcast_users") as cursor:
         return [row[0] for row in await cursor.fetchall()]
 
 
-async def async_db_get_pending_post_data(message_id: int) -> Optional[Tuple[int, datetime]]:
-    """Получает ID пользователя и время подачи (локализованное) (асинхронно)."""
+async def async_db_get_pending_post_data(message_id: int) -> Optional[Dict[str, Any]]:
+    """
+    Получает сохраненный пост из предложки (асинхронно):
+    user_id, submitted_at (локализованное), photo_ids, body_html, author_username, author_full_name, mod_notes,
+    assigned_to, assigned_at (UTC ISO), claimed_by.
+    У постов, отправленных до миграции 4, body_html равен None.
+    """
     db = await DatabaseManager.get_connection()
-    async with db.execute("SELECT user_id, submitted_at FROM pending_posts WHERE message_id = ?",
+    async with db.execute("SELECT user_id, submitted_at, photo_ids, body_html, author_username, author_full_name, "
+                          "mod_notes, assigned_to, assigned_at, claimed_by FROM pending_posts WHERE message_id = ?",
                           (message_id,)) as cursor:
         result = await cursor.fetchone()
         if result:
-            user_id = result['user_id']
-            submitted_at_utc_str = result['submitted_at']
-            submitted_at_tz = _to_tz_datetime(submitted_at_utc_str)
-            return user_id, submitted_at_tz
+            post = dict(result)
+            post['submitted_at'] = _to_tz_datetime(result['submitted_at'])
+            post['photo_ids'] = json.loads(result['photo_ids']) if result['photo_ids'] else []
+            post['mod_notes'] = json.loads(result['mod_notes']) if result['mod_notes'] else []
+            return post
         return None
 
 
@@ -241,60 +917,976 @@ async def async_db_delete_pending_post(message_id: int):
     await db.commit()
 
 
-async def async_db_add_stat(event_type: str, submitted_at_tz: Optional[datetime], message_id: Optional[int] = None):
-    """Добавление записи о модерации и удаление из pending_posts (асинхронно)."""
+async def async_db_add_stat(event_type: str, submitted_at_tz: Optional[datetime], message_id: Optional[int] = None,
+                            author_id: Optional[int] = None, manual: bool = True):
+    """
+    Добавление записи о модерации и удаление из pending_posts (асинхронно).
+    author_id — автор поста (история /user); решение модератора (manual) засчитывается в его репутацию
+    и в гистограмму времени модерации — автопубликации ее бы занижали.
+    """
     now_utc_str = _get_datetime_now_utc_str()
     now_tz = datetime.now(TIMEZONE)
     moderated_date_str = now_tz.strftime("%Y-%m-%d")
 
-    submitted_utc_str = submitted_at_tz.astimezone(pytz.utc).isoformat() if submitted_at_tz else now_utc_str
+    submitted_utc_str = submitted_at_tz.astimezone(pytz.utc).isoformat() if submitted_at_tz else now_utc_str
+
+    latency_seconds = (now_tz - submitted_at_tz).total_seconds() if submitted_at_tz else 0.0
+
+    db = await DatabaseManager.get_connection()
+
+    await db.execute(
+        "INSERT INTO stats (event_type, created_at, moderated_at, moderated_date_str, user_id) VALUES (?, ?, ?, ?, ?)",
+        (event_type, submitted_utc_str, now_utc_str, moderated_date_str, author_id))
+    if manual:
+        await db.execute(
+            "INSERT INTO moderation_latency_hist (day, bucket, count) VALUES (?, ?, 1) "
+            "ON CONFLICT(day, bucket) DO UPDATE SET count = count + 1",
+            (moderated_date_str, bisect_left(LATENCY_BUCKETS, latency_seconds)))
+
+    if message_id:
+        await db.execute("DELETE FROM pending_posts WHERE message_id = ?", (message_id,))
+        await db.execute("UPDATE ads_archive SET status = ?, moderated_at = ?, auto_published = ? WHERE message_id = ?",
+                         (event_type, now_utc_str, int(not manual), message_id))
+
+    is_published, is_rejected = int(event_type == 'published'), int(event_type == 'rejected')
+    if author_id is not None:
+        await db.execute(
+            "INSERT INTO user_totals (user_id, published, rejected) VALUES (?, ?, ?) "
+            "ON CONFLICT(user_id) DO UPDATE SET published = published + excluded.published, "
+            "rejected = rejected + excluded.rejected",
+            (author_id, is_published, is_rejected))
+    count_reputation = author_id is not None and manual
+    if count_reputation:
+        await db.execute(
+            "INSERT INTO author_reputation (user_id, published, rejected) VALUES (?, ?, ?) "
+            "ON CONFLICT(user_id) DO UPDATE SET published = published + excluded.published, "
+            "rejected = rejected + excluded.rejected",
+            (author_id, is_published, is_rejected))
+
+    await db.commit()
+    if count_reputation:
+        published, rejected = MemoryCache.reputation.get(author_id, (0, 0))
+        MemoryCache.reputation[author_id] = (published + is_published, rejected + is_rejected)
+
+
+# --- РЕПУТАЦИЯ АВТОРОВ ---
+# Счетчики решений модераторов ведутся в async_db_add_stat. Доверенный автор (is_trusted_author) публикуется без
+# очереди через fast_track_publish; автопубликации в репутацию не идут, а случайная доля REPUTATION_AUDIT_RATE
+# его постов все равно уходит модераторам — так репутация опирается только на ручные решения и не устаревает.
+
+async def async_db_get_reputation(user_id: int) -> Tuple[int, int]:
+    """(одобрено, отклонено) модераторами постов автора (асинхронно)."""
+    if MemoryCache.warmed:
+        return MemoryCache.reputation.get(user_id, (0, 0))
+    db = await DatabaseManager.get_connection()
+    async with db.execute("SELECT published, rejected FROM author_reputation WHERE user_id = ?",
+                          (user_id,)) as cursor:
+        row = await cursor.fetchone()
+    return (row[0], row[1]) if row else (0, 0)
+
+
+def is_trusted_author(published: int, rejected: int) -> bool:
+    """Не меньше REPUTATION_MIN_PUBLISHED одобренных постов и доля отклоненных не выше REPUTATION_MAX_REJECT_RATE."""
+    return (0 < SETTINGS.REPUTATION_MIN_PUBLISHED <= published
+            and rejected <= (published + rejected) * SETTINGS.REPUTATION_MAX_REJECT_RATE)
+
+
+# --- ПУЛ МОДЕРАТОРОВ ---
+# Роли и нагрузка держатся в MemoryCache; новый пост назначается модератору на смене с наименьшей нагрузкой.
+# Нажать кнопки поста может назначенный модератор, владелец, или любой модератор, если назначение устарело.
+# Захват поста (claimed_by) — атомарный UPDATE, поэтому пост обрабатывается не более одного раза.
+
+def is_moderator(user_id: int) -> bool:
+    """Владелец или модератор из пула."""
+    return user_id == SETTINGS.OWNER_ID or user_id in MemoryCache.moderators
+
+
+def pick_moderator(exclude: Optional[int] = None) -> int:
+    """Модератор на смене с наименьшей текущей нагрузкой; если на смене никого — владелец."""
+    candidates = [m for m in MemoryCache.online_moderators if m != exclude]
+    if not candidates:
+        return SETTINGS.OWNER_ID
+    return min(candidates, key=lambda m: (MemoryCache.moderator_load.get(m, 0), m))
+
+
+def _change_moderator_load(moderator_id: Optional[int], delta: int):
+    if moderator_id is None:
+        return
+    load = MemoryCache.moderator_load.get(moderator_id, 0) + delta
+    if load > 0:
+        MemoryCache.moderator_load[moderator_id] = load
+    else:
+        MemoryCache.moderator_load.pop(moderator_id, None)
+
+
+def is_assignment_stale(assigned_at_utc_str: Optional[str]) -> bool:
+    """Назначение старше MODERATION_ASSIGN_TIMEOUT секунд может забрать любой модератор."""
+    if not assigned_at_utc_str:
+        return True
+    assigned_at = datetime.fromisoformat(assigned_at_utc_str)
+    return datetime.now(pytz.utc) - assigned_at > timedelta(seconds=SETTINGS.MODERATION_ASSIGN_TIMEOUT)
+
+
+async def async_db_add_moderator(user_id: int, added_by: int):
+    """Добавляет модератора в пул (асинхронно)."""
+    db = await DatabaseManager.get_connection()
+    await db.execute(
+        "INSERT OR IGNORE INTO moderators (user_id, added_by, added_at, is_online) VALUES (?, ?, ?, 0)",
+        (user_id, added_by, _get_datetime_now_utc_str())
+    )
+    await db.commit()
+    MemoryCache.moderators.add(user_id)
+
+
+async def async_db_remove_moderator(user_id: int):
+    """Удаляет модератора из пула (асинхронно)."""
+    db = await DatabaseManager.get_connection()
+    await db.execute("DELETE FROM moderators WHERE user_id = ?", (user_id,))
+    await db.commit()
+    MemoryCache.moderators.discard(user_id)
+    MemoryCache.online_moderators.discard(user_id)
+
+
+async def async_db_set_moderator_online(user_id: int, is_online: bool):
+    """Отмечает начало/конец смены модератора (асинхронно). Смена владельца хранится только в памяти."""
+    if user_id != SETTINGS.OWNER_ID:
+        db = await DatabaseManager.get_connection()
+        await db.execute("UPDATE moderators SET is_online = ? WHERE user_id = ?", (int(is_online), user_id))
+        await db.commit()
+    if is_online:
+        MemoryCache.online_moderators.add(user_id)
+    else:
+        MemoryCache.online_moderators.discard(user_id)
+
+
+class PostLockRegistry:
+    """Блокировки сообщений предложки по message_id; запись удаляется, когда блокировку никто не держит и не ждет."""
+
+    def __init__(self):
+        self._locks: Dict[int, asyncio.Lock] = {}
+        self._holders: Counter = Counter()
+
+    @asynccontextmanager
+    async def hold(self, message_id: int):
+        lock = self._locks.setdefault(message_id, asyncio.Lock())
+        self._holders[message_id] += 1
+        try:
+            async with lock:
+                yield
+        finally:
+            self._holders[message_id] -= 1
+            if not self._holders[message_id]:
+                del self._holders[message_id]
+                del self._locks[message_id]
+
+
+# Захват поста и фоновая дописка пометок (check_photo_repeats) идут под блокировкой поста: иначе пометки с кнопками
+# модерации могли бы лечь в сообщение поверх финального статуса, выставленного уже после захвата
+PendingPostLocks = TenantLocal(PostLockRegistry)
+
+
+async def async_db_claim_pending_post(message_id: int, moderator_id: int) -> bool:
+    """Атомарно захватывает пост на обработку. False — пост уже обрабатывает кто-то другой (асинхронно)."""
+    async with PendingPostLocks.hold(message_id):
+        db = await DatabaseManager.get_connection()
+        cursor = await db.execute(
+            "UPDATE pending_posts SET claimed_by = ? WHERE message_id = ? AND claimed_by IS NULL",
+            (moderator_id, message_id)
+        )
+        await db.commit()
+        return cursor.rowcount == 1
+
+
+async def async_db_release_pending_post(message_id: int):
+    """Снимает захват поста, если обработка не удалась (асинхронно)."""
+    db = await DatabaseManager.get_connection()
+    await db.execute("UPDATE pending_posts SET claimed_by = NULL WHERE message_id = ?", (message_id,))
+    await db.commit()
+
+
+async def async_db_reassign_pending_post(message_id: int, old_moderator_id: Optional[int], new_moderator_id: int):
+    """Переназначает незахваченный пост другому модератору (асинхронно)."""
+    db = await DatabaseManager.get_connection()
+    cursor = await db.execute(
+        "UPDATE pending_posts SET assigned_to = ?, assigned_at = ? WHERE message_id = ? AND claimed_by IS NULL",
+        (new_moderator_id, _get_datetime_now_utc_str(), message_id)
+    )
+    await db.commit()
+    if cursor.rowcount == 1:
+        _change_moderator_load(old_moderator_id, -1)
+        _change_moderator_load(new_moderator_id, +1)
+
+
+async def async_db_get_reassignable_posts(moderator_id: Optional[int] = None) -> List[Tuple[int, Optional[int]]]:
+    """
+    Незахваченные посты, которые пора переназначить: с устаревшим назначением,
+    либо (если указан moderator_id) все посты этого модератора. Возвращает (message_id, assigned_to).
+    """
+    db = await DatabaseManager.get_connection()
+    if moderator_id is not None:
+        query = "SELECT message_id, assigned_to FROM pending_posts WHERE claimed_by IS NULL AND assigned_to = ?"
+        params = (moderator_id,)
+    else:
+        cutoff = datetime.now(pytz.utc) - timedelta(seconds=SETTINGS.MODERATION_ASSIGN_TIMEOUT)
+        query = ("SELECT message_id, assigned_to FROM pending_posts "
+                 "WHERE claimed_by IS NULL AND (assigned_at IS NULL OR assigned_at < ?)")
+        params = (cutoff.isoformat(),)
+    async with db.execute(query, params) as cursor:
+        return [(row[0], row[1]) for row in await cursor.fetchall()]
+
+
+async def notify_moderator_assignment(bot: Bot, moderator_id: int, message_id: int):
+    """Личное уведомление модератору о назначенном посте."""
+    link = moderation_message_link(message_id)
+    post_ref = f'<a href="{link}">пост</a>' if link else f"пост (ID {message_id})"
+    try:
+        with outbound_lane('notifications'):
+            await bot.send_message(moderator_id, f"📥 Вам назначен {post_ref} на модерацию.")
+    except Exception as e:
+        logging.warning(f"Could not notify moderator {moderator_id}: {e}")
+
+
+async def reassign_posts(bot: Bot, moderator_id: Optional[int] = None):
+    """Переназначает устаревшие посты (или все посты ушедшего со смены модератора) на других модераторов."""
+    for message_id, old_moderator_id in await async_db_get_reassignable_posts(moderator_id):
+        new_moderator_id = pick_moderator(exclude=old_moderator_id)
+        if new_moderator_id == old_moderator_id:
+            continue
+        await async_db_reassign_pending_post(message_id, old_moderator_id, new_moderator_id)
+        await notify_moderator_assignment(bot, new_moderator_id, message_id)
+        logging.info(f"Post {message_id} reassigned from {old_moderator_id} to {new_moderator_id}.")
+
+
+async def moderation_reassign_loop(bot: Bot):
+    """Фоновая задача: раз в минуту переназначает посты, которые слишком долго ждут назначенного модератора."""
+    while True:
+        await asyncio.sleep(60)
+        try:
+            await reassign_posts(bot)
+        except Exception as e:
+            logging.error(f"Failed to reassign stale moderation posts: {e}")
+
+
+# --- АРХИВ ОБЪЯВЛЕНИЙ И ПОЛНОТЕКСТОВЫЙ ПОИСК ---
+
+SEARCH_PAGE_SIZE = 5
+# /user: подач на странице, записей журнала банов и окно "недавних" подач и решений (дней)
+USER_HISTORY_PAGE_SIZE = 10
+USER_BAN_HISTORY_LIMIT = 5
+USER_RECENT_DAYS = 30
+_SEARCH_TOKEN_PATTERN = re.compile(r'\w+')
+
+
+async def async_db_archive_ad(message_id: int, user_id: int, author_username: Optional[str], author_full_name: str,
+                              draft: 'AdDraft'):
+    """Добавляет поданное объявление в архив со статусом pending (асинхронно)."""
+    db = await DatabaseManager.get_connection()
+    await db.execute(
+        "INSERT INTO ads_archive (message_id, user_id, author_username, author_full_name, description, price, "
+        "contact, status, submitted_at) VALUES (?, ?, ?, ?, ?, ?, ?, 'pending', ?)",
+        (message_id, user_id, author_username, author_full_name, draft.description, draft.price, draft.contact,
+         _get_datetime_now_utc_str())
+    )
+    await db.execute("INSERT INTO user_totals (user_id, submitted) VALUES (?, 1) "
+                     "ON CONFLICT(user_id) DO UPDATE SET submitted = submitted + 1", (user_id,))
+    await db.commit()
+
+
+async def async_db_get_user_submissions(user_id: int, limit: int,
+                                        before_id: Optional[int] = None) -> List[Dict[str, Any]]:
+    """
+    Подачи пользователя из архива, от новых к старым (асинхронно).
+    Постраничность по ключу: before_id — ID последней записи предыдущей страницы.
+    """
+    db = await DatabaseManager.get_connection()
+    if before_id is None:
+        query = ("SELECT id, message_id, description, price, contact, status, submitted_at, moderated_at "
+                 "FROM ads_archive WHERE user_id = ? ORDER BY submitted_at DESC, id DESC LIMIT ?")
+        params = (user_id, limit)
+    else:
+        query = ("SELECT id, message_id, description, price, contact, status, submitted_at, moderated_at "
+                 "FROM ads_archive WHERE user_id = ? AND (submitted_at, id) < "
+                 "(SELECT submitted_at, id FROM ads_archive WHERE id = ?) "
+                 "ORDER BY submitted_at DESC, id DESC LIMIT ?")
+        params = (user_id, before_id, limit)
+    async with db.execute(query, params) as cursor:
+        return [dict(row) for row in await cursor.fetchall()]
+
+
+async def async_db_get_user_summary(user_id: int, since_utc_str: str) -> Dict[str, Any]:
+    """
+    Сводка по пользователю для /user (асинхронно): имя из последней подачи, счетчики подач и решений за все время,
+    подачи и решения с since, последние записи журнала банов. Итоги берутся из user_totals, остальное — диапазоны
+    индексов (user_id, время): время не зависит ни от размера таблиц, ни от длины истории пользователя.
+    """
+    db = await DatabaseManager.get_connection()
+    async with db.execute("SELECT author_username, author_full_name FROM ads_archive WHERE user_id = ? "
+                          "ORDER BY submitted_at DESC LIMIT 1", (user_id,)) as cursor:
+        author = await cursor.fetchone()
+    async with db.execute("SELECT submitted, published, rejected FROM user_totals WHERE user_id = ?",
+                          (user_id,)) as cursor:
+        totals = await cursor.fetchone()
+    async with db.execute("SELECT COUNT(*) FROM ads_archive WHERE user_id = ? AND submitted_at >= ?",
+                          (user_id, since_utc_str)) as cursor:
+        recent_submissions = (await cursor.fetchone())[0]
+    async with db.execute("SELECT event_type, COUNT(*) FROM stats WHERE user_id = ? AND moderated_at >= ? "
+                          "GROUP BY event_type", (user_id, since_utc_str)) as cursor:
+        recent_outcomes = {row[0]: row[1] for row in await cursor.fetchall()}
+    async with db.execute("SELECT action, moderator_id, reason, created_at FROM ban_history WHERE user_id = ? "
+                          "ORDER BY created_at DESC LIMIT ?", (user_id, USER_BAN_HISTORY_LIMIT)) as cursor:
+        bans = [dict(row) for row in await cursor.fetchall()]
+    return {
+        'username': author['author_username'] if author else None,
+        'full_name': author['author_full_name'] if author else None,
+        'totals': dict(totals) if totals else {'submitted': 0, 'published': 0, 'rejected': 0},
+        'recent_submissions': recent_submissions,
+        'recent_outcomes': recent_outcomes,
+        'bans': bans,
+    }
+
+
+def build_fts_query(text: str) -> Optional[str]:
+    """
+    Превращает произвольный ввод в безопасный запрос FTS5: все слова обязательны.
+    По префиксу ищется только последнее слово — префиксы частых слов раздувают выборку для ранжирования.
+    """
+    tokens = _SEARCH_TOKEN_PATTERN.findall(text.lower())[:10]
+    if not tokens:
+        return None
+    return " ".join(f'"{token}"' for token in tokens) + "*"
+
+
+async def async_db_search_ads(query: str, page: int) -> Tuple[List[Dict[str, Any]], bool]:
+    """
+    Полнотекстовый поиск по архиву, отсортированный по релевантности (bm25) (асинхронно).
+    Возвращает записи страницы и признак наличия следующей страницы.
+    """
+    fts_query = build_fts_query(query)
+    if fts_query is None:
+        return [], False
+
+    db = await DatabaseManager.get_connection()
+    async with db.execute(
+        "SELECT a.id, a.message_id, a.user_id, a.author_username, a.description, a.price, a.status, a.submitted_at "
+        "FROM ads_fts JOIN ads_archive a ON a.id = ads_fts.rowid "
+        "WHERE ads_fts MATCH ? ORDER BY ads_fts.rank LIMIT ? OFFSET ?",
+        (fts_query, SEARCH_PAGE_SIZE + 1, page * SEARCH_PAGE_SIZE)
+    ) as cursor:
+        rows = [dict(row) for row in await cursor.fetchall()]
+
+    return rows[:SEARCH_PAGE_SIZE], len(rows) > SEARCH_PAGE_SIZE
+
+
+# --- АНАЛИТИКА ВРЕМЕНИ МОДЕРАЦИИ ---
+
+def histogram_percentiles(counts: List[int], quantiles: List[float]) -> List[Optional[float]]:
+    """
+    Перцентили (сек) по гистограмме LATENCY_BUCKETS с линейной интерполяцией внутри корзины.
+    Для последней (открытой) корзины возвращается ее нижняя граница; для пустой гистограммы — None.
+    """
+    total = sum(counts)
+    if total == 0:
+        return [None] * len(quantiles)
+
+    results = []
+    for q in quantiles:
+        target = q * total
+        cumulative = 0
+        for index, count in enumerate(counts):
+            if count and cumulative + count >= target:
+                lower = LATENCY_BUCKETS[index - 1] if index > 0 else 0
+                if index >= len(LATENCY_BUCKETS):
+                    results.append(float(lower))
+                else:
+                    fraction = (target - cumulative) / count
+                    results.append(lower + (LATENCY_BUCKETS[index] - lower) * fraction)
+                break
+            cumulative += count
+    return results
+
+
+async def async_db_get_latency_histogram(period: str = 'all') -> List[int]:
+    """Счетчики корзин LATENCY_BUCKETS за сегодня ('today') или за все время (асинхронно)."""
+    db = await DatabaseManager.get_connection()
+    if period == 'today':
+        query = "SELECT bucket, count FROM moderation_latency_hist WHERE day = ?"
+        params = [_get_limit_date_str()]
+    else:
+        query = "SELECT bucket, SUM(count) FROM moderation_latency_hist GROUP BY bucket"
+        params = []
+
+    counts = [0] * (len(LATENCY_BUCKETS) + 1)
+    async with db.execute(query, params) as cursor:
+        for bucket, count in await cursor.fetchall():
+            counts[bucket] += count
+    return counts
+
+
+async def async_db_get_queue_state() -> Tuple[int, Optional[datetime]]:
+    """Глубина очереди предложки и время подачи самого старого поста (локализованное) (асинхронно)."""
+    db = await DatabaseManager.get_connection()
+    async with db.execute("SELECT COUNT(*), MIN(submitted_at) FROM pending_posts") as cursor:
+        depth, oldest = await cursor.fetchone()
+    return depth, _to_tz_datetime(oldest) if oldest else None
+
+
+def format_duration(seconds: float) -> str:
+    """Короткая запись длительности: 45 с, 12 мин, 3 ч 5 мин, 2 д 4 ч."""
+    seconds = int(seconds)
+    if seconds < 60:
+        return f"{seconds} с"
+    minutes = seconds // 60
+    if minutes < 60:
+        return f"{minutes} мин"
+    hours, minutes = divmod(minutes, 60)
+    if hours < 24:
+        return f"{hours} ч {minutes} мин"
+    days, hours = divmod(hours, 24)
+    return f"{days} д {hours} ч"
+
+
+async def async_db_get_stats_counts(period: str = 'all') -> Tuple[int, int]:
+    """Получает количество опубликованных и отклоненных постов (асинхронно)."""
+    db = await DatabaseManager.get_connection()
+
+    params = []
+
+    if period == 'today':
+        today_str = _get_limit_date_str()
+        condition = "WHERE moderated_date_str = ?"
+        params = [today_str]
+    else:
+        condition = ""
+
+    query_pub = f"SELECT COUNT(*) FROM stats {condition} AND event_type = 'published'"
+    query_rej = f"SELECT COUNT(*) FROM stats {condition} AND event_type = 'rejected'"
+
+    # Убираем "AND" если нет condition
+    if not condition:
+        query_pub = query_pub.replace("AND ", "WHERE ", 1)
+        query_rej = query_rej.replace("AND ", "WHERE ", 1)
+
+    # Обработка случая, когда нет where (для 'all')
+    if period == 'all':
+        query_pub = "SELECT COUNT(*) FROM stats WHERE event_type = 'published'"
+        query_rej = "SELECT COUNT(*) FROM stats WHERE event_type = 'rejected'"
+        params = []
+
+    async with db.execute(query_pub, params) as cursor_pub:
+        pub_count = (await cursor_pub.fetchone())[0]
+
+    async with db.execute(query_rej, params) as cursor_rej:
+        rej_count = (await cursor_rej.fetchone())[0]
+
+    return pub_count, rej_count
+
+
+# --- ПОИСК ПОХОЖИХ ОБЪЯВЛЕНИЙ (MinHash + LSH) ---
+# Текст режется на символьные шинглы, по ним считается MinHash-сигнатура (оценка сходства Жаккара).
+# Сигнатура делится на LSH-полосы; объявления с совпавшей хотя бы одной полосой — кандидаты.
+# Поиск кандидатов идет по индексу корзин и не зависит от размера истории линейно.
+
+SHINGLE_SIZE = 5
+MINHASH_PERMUTATIONS = 64
+LSH_BANDS = 16
+LSH_ROWS = MINHASH_PERMUTATIONS // LSH_BANDS
+LSH_MAX_CANDIDATES = 200
+
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_minhash_rng = np.random.default_rng(1_000_003)  # Фиксированное зерно: сигнатуры должны совпадать между запусками
+_MINHASH_A = _minhash_rng.integers(1, _MERSENNE_PRIME, size=MINHASH_PERMUTATIONS, dtype=np.uint64)
+_MINHASH_B = _minhash_rng.integers(0, _MERSENNE_PRIME, size=MINHASH_PERMUTATIONS, dtype=np.uint64)
+_NON_WORD_PATTERN = re.compile(r'[\W_]+')
+
+
+def _normalize_for_shingles(text: str) -> str:
+    """Нижний регистр, ё -> е, все кроме букв и цифр схлопывается в один пробел."""
+    return _NON_WORD_PATTERN.sub(' ', text.lower().replace('ё', 'е')).strip()
+
+
+def minhash_signature(text: str) -> np.ndarray:
+    """MinHash-сигнатура текста: вектор из MINHASH_PERMUTATIONS значений uint32."""
+    normalized = _normalize_for_shingles(text)
+    shingles = {normalized[i:i + SHINGLE_SIZE] for i in range(max(1, len(normalized) - SHINGLE_SIZE + 1))}
+    hashes = np.fromiter((zlib.crc32(sh.encode('utf-8')) for sh in shingles), dtype=np.uint64, count=len(shingles))
+    # Все перестановки сразу: матрица (перестановки x шинглы), минимум по строкам.
+    # Переполнение uint64 при умножении допустимо: это все равно универсальное хэширование.
+    permuted = (np.outer(_MINHASH_A, hashes) + _MINHASH_B[:, None]) % _MERSENNE_PRIME
+    return permuted.min(axis=1).astype(np.uint32)
+
+
+def lsh_band_keys(signature: np.ndarray) -> List[int]:
+    """Ключи LSH-корзин сигнатуры: по одному на полосу."""
+    return [
+        (band << 32) | zlib.crc32(signature[band * LSH_ROWS:(band + 1) * LSH_ROWS].tobytes())
+        for band in range(LSH_BANDS)
+    ]
+
+
+async def async_db_store_ad_signature(message_id: int, user_id: int, signature: np.ndarray):
+    """Сохраняет сигнатуру объявления и его LSH-корзины (асинхронно)."""
+    db = await DatabaseManager.get_connection()
+    cursor = await db.execute(
+        "INSERT INTO ad_signatures (message_id, user_id, created_at, signature) VALUES (?, ?, ?, ?)",
+        (message_id, user_id, _get_datetime_now_utc_str(), signature.tobytes())
+    )
+    ad_id = cursor.lastrowid
+    await db.executemany(
+        "INSERT OR IGNORE INTO ad_lsh_buckets (bucket_key, ad_id) VALUES (?, ?)",
+        [(key, ad_id) for key in lsh_band_keys(signature)]
+    )
+    await db.commit()
+
+
+async def async_db_find_similar_ad(signature: np.ndarray) -> Optional[Dict[str, Any]]:
+    """
+    Ищет самое похожее из ранее поданных объявлений (асинхронно).
+    Возвращает message_id, user_id, created_at и similarity, если сходство не ниже SETTINGS.DUPLICATE_THRESHOLD.
+    """
+    keys = lsh_band_keys(signature)
+    db = await DatabaseManager.get_connection()
+    async with db.execute(
+        f"SELECT id, message_id, user_id, created_at, signature FROM ad_signatures WHERE id IN ("
+        f"SELECT ad_id FROM ad_lsh_buckets WHERE bucket_key IN ({', '.join('?' * len(keys))})"
+        f") ORDER BY id DESC LIMIT {LSH_MAX_CANDIDATES}",
+        keys
+    ) as cursor:
+        candidates = await cursor.fetchall()
+
+    if not candidates:
+        return None
+
+    matrix = np.frombuffer(b''.join(row['signature'] for row in candidates), dtype=np.uint32)
+    similarities = (matrix.reshape(len(candidates), MINHASH_PERMUTATIONS) == signature).mean(axis=1)
+    best = int(similarities.argmax())
+    if similarities[best] < SETTINGS.DUPLICATE_THRESHOLD:
+        return None
+
+    row = candidates[best]
+    return {
+        'message_id': row['message_id'],
+        'user_id': row['user_id'],
+        'created_at': _to_tz_datetime(row['created_at']),
+        'similarity': float(similarities[best]),
+    }
+
+
+def moderation_message_link(message_id: int) -> Optional[str]:
+    """Ссылка на сообщение в канале предложки (только для числовых ID вида -100...)."""
+    channel_id = str(SETTINGS.CHANNEL_PREDLOZHKA_ID)
+    if not channel_id.startswith('-100'):
+        return None
+    return f"https://t.me/c/{channel_id[4:]}/{message_id}"
+
+
+def format_duplicate_note(match: Dict[str, Any]) -> str:
+    """Пометка для модератора о возможном дубликате."""
+    link = moderation_message_link(match['message_id'])
+    target = f'<a href="{link}">объявления</a>' if link else "объявления"
+    return (
+        f"⚠️ Возможный дубликат {target} от <code>{match['user_id']}</code> "
+        f"({match['created_at'].strftime('%d.%m.%Y %H:%M')}), сходство {match['similarity'] * 100:.0f}%"
+    )
+
+
+# --- ПОВТОРЫ ФОТО (file_unique_id + перцептивный хэш) ---
+# Точный повтор — то же фото (file_unique_id наибольшего размера), например пересланное с другого аккаунта.
+# Похожее — перезалитое, пережатое или слегка обрезанное: наименьший размер фото (миниатюра ~90 px) скачивается,
+# по нему считается 64-битный pHash (DCT яркости 32x32, NumPy), ближайшие ищутся мульти-индексной хэш-таблицей.
+# Проверка идет фоном после отправки в предложку: найденное дописывается в пометки поста и в его сообщение.
+
+PHASH_SIZE = 32
+PHASH_LOW_FREQ = 8
+PHOTO_NOTES_LIMIT = 3
+# Матрица DCT-II (строка — частота): DCT изображения X — это D @ X @ D.T
+_DCT_MATRIX = np.cos(np.pi / PHASH_SIZE * np.arange(PHASH_SIZE)[:, None] * (np.arange(PHASH_SIZE)[None, :] + 0.5))
+
+
+class MultiIndexHashTable:
+    """
+    Поиск 64-битных хэшей по расстоянию Хэмминга: хэш разбит на 4 куска по 16 бит, по таблице на кусок.
+    Если расстояние не больше radius, хотя бы один кусок отличается не больше чем на radius // 4 бит (принцип
+    Дирихле), поэтому кандидаты берутся только из соседних по куску корзин и затем проверяются точно.
+    """
+    CHUNKS = 4
+    CHUNK_BITS = 16
+    _masks: Dict[int, List[int]] = {}  # Радиус куска -> все маски CHUNK_BITS бит с не более чем радиусом единиц
+
+    def __init__(self):
+        self._tables: List[Dict[int, List[int]]] = [{} for _ in range(self.CHUNKS)]
+        self._items: Dict[int, List[Any]] = {}  # Хэш -> значения
+        self.size = 0
+
+    def _chunks(self, value: int) -> List[int]:
+        mask = (1 << self.CHUNK_BITS) - 1
+        return [(value >> (index * self.CHUNK_BITS)) & mask for index in range(self.CHUNKS)]
+
+    @classmethod
+    def _chunk_masks(cls, radius: int) -> List[int]:
+        if radius not in cls._masks:
+            cls._masks[radius] = [mask for mask in range(1 << cls.CHUNK_BITS) if mask.bit_count() <= radius]
+        return cls._masks[radius]
+
+    def add(self, value: int, item: Any):
+        self.size += 1
+        items = self._items.get(value)
+        if items is not None:
+            items.append(item)
+            return
+        self._items[value] = [item]
+        for table, chunk in zip(self._tables, self._chunks(value)):
+            table.setdefault(chunk, []).append(value)
+
+    def search(self, value: int, radius: int) -> List[Tuple[int, Any]]:
+        """Все значения с хэшем на расстоянии не больше radius: [(расстояние, значение)], от ближних."""
+        masks = self._chunk_masks(radius // self.CHUNKS)
+        candidates: Set[int] = set()
+        for table, chunk in zip(self._tables, self._chunks(value)):
+            for mask in masks:
+                bucket = table.get(chunk ^ mask)
+                if bucket:
+                    candidates.update(bucket)
+        found = []
+        for candidate in candidates:
+            distance = (candidate ^ value).bit_count()
+            if distance <= radius:
+                found.extend((distance, item) for item in self._items[candidate])
+        found.sort(key=lambda match: match[0])
+        return found
+
+
+def perceptual_hash(pixels: np.ndarray) -> int:
+    """pHash матрицы яркости PHASH_SIZE x PHASH_SIZE: биты низких частот DCT выше их медианы (без постоянной)."""
+    low = (_DCT_MATRIX @ pixels @ _DCT_MATRIX.T)[:PHASH_LOW_FREQ, :PHASH_LOW_FREQ].ravel()
+    return int.from_bytes(np.packbits(low > np.median(low[1:])).tobytes(), 'big')
+
+
+def image_phash(data: bytes) -> int:
+    """pHash изображения (нужен Pillow). Синхронная: вызывается через asyncio.to_thread."""
+    with Image.open(io.BytesIO(data)) as image:
+        pixels = np.asarray(image.convert('L').resize((PHASH_SIZE, PHASH_SIZE), Image.BILINEAR), dtype=np.float64)
+    return perceptual_hash(pixels)
+
+
+def _phash_to_sqlite(value: int) -> int:
+    """INTEGER в SQLite — знаковый 64-битный."""
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def _phash_from_sqlite(value: int) -> int:
+    return value & ((1 << 64) - 1)
+
+
+def extract_photo_refs(messages: List[Message]) -> List[List[str]]:
+    """Для каждого фото альбома: [file_unique_id наибольшего размера, file_id наименьшего] — для поиска повторов."""
+    return [[m.photo[-1].file_unique_id, m.photo[0].file_id] for m in messages if m.photo][:MAX_ALBUM_PHOTOS]
+
+
+async def async_db_find_photo_repeats(unique_ids: List[str], exclude_message_id: int = 0) -> List[Dict[str, Any]]:
+    """Прошлые объявления с теми же фото (по file_unique_id), от новых к старым (асинхронно)."""
+    if not unique_ids:
+        return []
+    db = await DatabaseManager.get_connection()
+    async with db.execute(
+        f"SELECT DISTINCT message_id, user_id, created_at FROM photo_hashes "
+        f"WHERE file_unique_id IN ({', '.join('?' * len(unique_ids))}) AND message_id != ? ORDER BY id DESC",
+        (*unique_ids, exclude_message_id)
+    ) as cursor:
+        return [dict(row) for row in await cursor.fetchall()]
+
+
+async def async_db_store_photo_hashes(message_id: int, user_id: int, hashes: List[Tuple[str, Optional[int]]]):
+    """Сохраняет фото объявления: (file_unique_id, pHash или None) (асинхронно)."""
+    created_at = _get_datetime_now_utc_str()
+    db = await DatabaseManager.get_connection()
+    await db.executemany(
+        "INSERT INTO photo_hashes (message_id, user_id, created_at, file_unique_id, phash) VALUES (?, ?, ?, ?, ?)",
+        [(message_id, user_id, created_at, unique_id, None if phash is None else _phash_to_sqlite(phash))
+         for unique_id, phash in hashes]
+    )
+    await db.commit()
+    for _, phash in hashes:
+        if phash is not None:
+            MemoryCache.photo_hashes.add(phash, (message_id, user_id, created_at))
+
+
+async def async_db_set_mod_notes(message_id: int, notes: List[str]) -> bool:
+    """Обновляет пометки поста, пока его не взяли в работу. Возвращает False, если поста нет или он уже захвачен."""
+    db = await DatabaseManager.get_connection()
+    cursor = await db.execute("UPDATE pending_posts SET mod_notes = ? WHERE message_id = ? AND claimed_by IS NULL",
+                              (json.dumps(notes), message_id))
+    await db.commit()
+    return cursor.rowcount > 0
+
+
+async def download_phash(bot: Bot, file_id: str) -> Optional[int]:
+    """Скачивает фото и считает pHash; None без Pillow или при ошибке."""
+    if Image is None:
+        return None
+    try:
+        buffer = await bot.download(file_id)
+        return await asyncio.to_thread(image_phash, buffer.getvalue())
+    except Exception as e:
+        logging.warning(f"Could not hash photo {file_id}: {e}")
+        return None
+
+
+def format_photo_repeat_note(match: Dict[str, Any]) -> str:
+    """Пометка для модератора о повторе фото."""
+    link = moderation_message_link(match['message_id'])
+    target = f'<a href="{link}">объявлении</a>' if link else "объявлении"
+    created_at = _to_tz_datetime(match['created_at']).strftime('%d.%m.%Y %H:%M')
+    kind = "То же фото" if match['distance'] == 0 else f"Похожее фото (отличие {match['distance']} из 64 бит)"
+    return f"🖼️ {kind} уже было в {target} от <code>{match['user_id']}</code> ({created_at})"
+
+
+async def check_photo_repeats(bot: Bot, message_id: int, user_id: int, photo_refs: List[List[str]]):
+    """
+    Фоновая проверка нового поста предложки: ищет повторы его фото, сохраняет их хэши и,
+    если пост еще не взят в работу, дописывает пометки в БД и в сообщение предложки.
+    """
+    matches: Dict[int, Dict[str, Any]] = {}  # message_id прошлого поста -> лучшее совпадение
+    for row in await async_db_find_photo_repeats([unique_id for unique_id, _ in photo_refs], message_id):
+        matches.setdefault(row['message_id'], {**row, 'distance': 0})
+
+    hashes = []
+    for unique_id, small_file_id in photo_refs:
+        phash = await download_phash(bot, small_file_id)
+        hashes.append((unique_id, phash))
+        if phash is None:
+            continue
+        for distance, (past_message_id, past_user_id, created_at) in MemoryCache.photo_hashes.search(
+                phash, SETTINGS.PHOTO_HASH_DISTANCE):
+            if past_message_id != message_id and distance < matches.get(past_message_id, {}).get('distance', 65):
+                matches[past_message_id] = {'message_id': past_message_id, 'user_id': past_user_id,
+                                            'created_at': created_at, 'distance': distance}
+    await async_db_store_photo_hashes(message_id, user_id, hashes)
+    if not matches:
+        return
 
-    db = await DatabaseManager.get_connection()
+    METRICS['photo_repeats'] += 1
+    best = sorted(matches.values(), key=lambda match: (match['distance'], -match['message_id']))[:PHOTO_NOTES_LIMIT]
+    # Под блокировкой поста: модератор не захватит его, пока сообщение с кнопками не отредактировано
+    async with PendingPostLocks.hold(message_id):
+        post = await async_db_get_pending_post_data(message_id)
+        if not post or post['claimed_by'] is not None or post['body_html'] is None:
+            return
+        notes = post['mod_notes'] + [format_photo_repeat_note(match) for match in best]
+        if not await async_db_set_mod_notes(message_id, notes):
+            return
 
-    await db.execute(
-        "INSERT INTO stats (event_type, created_at, moderated_at, moderated_date_str) VALUES (?, ?, ?, ?)",
-        (event_type, submitted_utc_str, now_utc_str, moderated_date_str))
+        caption = build_moderation_caption(post['body_html'], post['user_id'], post['author_username'], notes)
+        try:
+            # Одно фото — пост в предложке отправлен фото с подписью, иначе — текстом (см. send_ad_post)
+            if len(post['photo_ids']) == 1:
+                await bot.edit_message_caption(chat_id=SETTINGS.CHANNEL_PREDLOZHKA_ID, message_id=message_id,
+                                               caption=caption, reply_markup=kb_moderation_main(user_id))
+            else:
+                await bot.edit_message_text(text=caption, chat_id=SETTINGS.CHANNEL_PREDLOZHKA_ID,
+                                            message_id=message_id, reply_markup=kb_moderation_main(user_id))
+        except TelegramAPIError as e:
+            logging.warning(f"Could not add photo repeat notes to post {message_id}: {e}")
 
-    if message_id:
-        await db.execute("DELETE FROM pending_posts WHERE message_id = ?", (message_id,))
 
-    await db.commit()
+# Ссылки на фоновые проверки, чтобы задачи не собрал GC до завершения
+PHOTO_CHECKS: Set[asyncio.Task] = set()
 
 
-async def async_db_get_stats_counts(period: str = 'all') -> Tuple[int, int]:
-    """Получает количество опубликованных и отклоненных постов (асинхронно)."""
-    db = await DatabaseManager.get_connection()
+def schedule_photo_check(bot: Bot, message_id: int, user_id: int, photo_refs: List[List[str]]):
+    """Запускает check_photo_repeats фоном, не задерживая ответ пользователю."""
+    if not photo_refs:
+        return
 
-    params = []
+    async def run():
+        try:
+            await check_photo_repeats(bot, message_id, user_id, photo_refs)
+        except Exception as e:
+            logging.error(f"Photo repeat check failed for post {message_id}: {e}")
+
+    task = asyncio.create_task(run())
+    PHOTO_CHECKS.add(task)
+    task.add_done_callback(PHOTO_CHECKS.discard)
+
+
+# --- ПРЕФИЛЬТР СОДЕРЖИМОГО (Aho-Corasick) ---
+# Правила из SETTINGS.CONTENT_RULES_PATH (JSON, см. content_rules.example.json): ключевые слова/фразы и регулярные
+# выражения с действием reject (автоотклонение), flag (пометка модератору) или fasttrack (публикация без очереди).
+# Все ключевые слова и якоря регулярок собраны в один автомат: поля объявления проходятся один раз, и стоимость
+# не растет с числом слов. Регулярка с якорями ("anchors") запускается, только если автомат нашел один из якорей;
+# регулярки без якорей объединены в одно выражение и проверяются всегда — их лучше держать немного.
+
+CONTENT_ACTIONS = ('reject', 'flag', 'fasttrack')
+CONTENT_FIELDS = ('description', 'price', 'contact')
+
+
+def normalize_content(text: str) -> str:
+    return text.casefold().replace('ё', 'е')
+
+
+class AhoCorasick:
+    """Автомат Ахо — Корасик: находит вхождения всех строк словаря за один проход по тексту."""
+
+    def __init__(self, words: List[str]):
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._out: List[List[int]] = [[]]
+        for index, word in enumerate(words):
+            state = 0
+            for char in word:
+                next_state = self._goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self._goto)
+                    self._goto[state][char] = next_state
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append([])
+                state = next_state
+            self._out[state].append(index)
+
+        # Суффиксные ссылки обходом в ширину; выходы состояния дополняются выходами его суффикса
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(char, 0)
+                self._out[next_state] = self._out[next_state] + self._out[self._fail[next_state]]
+
+    def __len__(self) -> int:
+        return len(self._goto)
+
+    def find(self, text: str):
+        """Генерирует (позиция конца вхождения, индекс слова)."""
+        goto, fail, out = self._goto, self._fail, self._out
+        state = 0
+        for position, char in enumerate(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            for index in out[state]:
+                yield position, index
+
+
+class ContentRuleSet:
+    """Скомпилированный набор правил тенанта. load() подменяет набор целиком, поэтому проверка всегда видит согласованный."""
+
+    def __init__(self):
+        self.rules: List[Dict[str, Any]] = []
+        self._automaton: Optional[AhoCorasick] = None
+        self._words: List[Tuple[int, str, bool]] = []   # (индекс правила, слово, только целое слово)
+        self._always: List[Tuple[int, re.Pattern]] = []  # Регулярки без якорей: (индекс правила, регулярка)
+        self._anchored: Dict[int, re.Pattern] = {}       # Индекс правила -> его регулярка (проверяется по якорю)
+
+    def compile(self, rules: List[Dict[str, Any]]):
+        """Проверяет и компилирует правила; при ошибке бросает ValueError, текущий набор не меняется."""
+        words, anchored, always = [], {}, []
+        for index, rule in enumerate(rules):
+            if rule.get('action') not in CONTENT_ACTIONS:
+                raise ValueError(f"правило {index + 1}: action должно быть одним из {', '.join(CONTENT_ACTIONS)}")
+            if not set(rule.get('fields', CONTENT_FIELDS)) <= set(CONTENT_FIELDS):
+                raise ValueError(f"правило {index + 1}: fields — подмножество {', '.join(CONTENT_FIELDS)}")
+            if 'keyword' in rule:
+                keyword = normalize_content(str(rule['keyword']).strip())
+                if not keyword:
+                    raise ValueError(f"правило {index + 1}: пустое ключевое слово")
+                words.append((index, keyword, rule.get('whole_word', True)))
+            elif 'regex' in rule:
+                try:
+                    pattern = re.compile(rule['regex'], re.IGNORECASE)
+                except re.error as e:
+                    raise ValueError(f"правило {index + 1}: некорректная регулярка: {e}")
+                anchors = [normalize_content(anchor) for anchor in rule.get('anchors', []) if anchor]
+                if anchors:
+                    anchored[index] = pattern
+                    words.extend((index, anchor, False) for anchor in anchors)
+                else:
+                    always.append((index, pattern))
+            else:
+                raise ValueError(f"правило {index + 1}: нужен keyword или regex")
+
+        self._automaton = AhoCorasick([word for _, word, _ in words])
+        self._words = words
+        self._anchored = anchored
+        self._always = always
+        self.rules = rules
+
+    def load(self, path: str) -> int:
+        """Загружает правила из JSON-файла (нет файла — правил нет). Возвращает число правил."""
+        if not os.path.exists(path):
+            self.compile([])
+            return 0
+        with open(path, encoding='utf-8') as f:
+            rules = json.load(f).get('rules', [])
+        self.compile(rules)
+        return len(rules)
+
+    def check(self, fields: Dict[str, str]) -> List[Dict[str, Any]]:
+        """Сработавшие правила для полей объявления (каждое — один раз, в порядке файла)."""
+        if not self.rules:
+            return []
+        # Поля склеиваются через \x00 и проходятся автоматом один раз; позиция вхождения -> поле
+        names = [name for name in CONTENT_FIELDS if fields.get(name)]
+        originals = [fields[name] for name in names]
+        parts = [normalize_content(text) for text in originals]
+        text = "\x00".join(parts)
+        ends, offset = [], -1
+        for part in parts:
+            offset += len(part) + 1
+            ends.append(offset)
+
+        matched: Set[int] = set()
+        anchored_fields: Dict[int, Set[str]] = {}
+        for position, word_index in self._automaton.find(text):
+            rule_index, word, whole_word = self._words[word_index]
+            field = names[bisect_left(ends, position)]
+            if field not in self.rules[rule_index].get('fields', CONTENT_FIELDS):
+                continue
+            start = position - len(word) + 1
+            if whole_word and ((start > 0 and text[start - 1].isalnum())
+                               or (position + 1 < len(text) and text[position + 1].isalnum())):
+                continue
+            if rule_index in self._anchored:
+                anchored_fields.setdefault(rule_index, set()).add(field)
+            else:
+                matched.add(rule_index)
 
-    if period == 'today':
-        today_str = _get_limit_date_str()
-        condition = "WHERE moderated_date_str = ?"
-        params = [today_str]
-    else:
-        condition = ""
+        for rule_index, rule_fields in anchored_fields.items():
+            pattern = self._anchored[rule_index]
+            if any(pattern.search(original) for name, original in zip(names, originals) if name in rule_fields):
+                matched.add(rule_index)
 
-    query_pub = f"SELECT COUNT(*) FROM stats {condition} AND event_type = 'published'"
-    query_rej = f"SELECT COUNT(*) FROM stats {condition} AND event_type = 'rejected'"
+        # Каждая регулярка ищется отдельно: в общей альтернации первое совпадение в позиции скрывало бы остальные правила
+        for rule_index, pattern in self._always:
+            rule_fields = self.rules[rule_index].get('fields', CONTENT_FIELDS)
+            if any(pattern.search(original) for name, original in zip(names, originals) if name in rule_fields):
+                matched.add(rule_index)
+        return [self.rules[index] for index in sorted(matched)]
 
-    # Убираем "AND" если нет condition
-    if not condition:
-        query_pub = query_pub.replace("AND ", "WHERE ", 1)
-        query_rej = query_rej.replace("AND ", "WHERE ", 1)
 
-    # Обработка случая, когда нет where (для 'all')
-    if period == 'all':
-        query_pub = "SELECT COUNT(*) FROM stats WHERE event_type = 'published'"
-        query_rej = "SELECT COUNT(*) FROM stats WHERE event_type = 'rejected'"
-        params = []
+# Правила текущего тенанта
+ContentPrefilter = TenantLocal(ContentRuleSet)
 
-    async with db.execute(query_pub, params) as cursor_pub:
-        pub_count = (await cursor_pub.fetchone())[0]
 
-    async with db.execute(query_rej, params) as cursor_rej:
-        rej_count = (await cursor_rej.fetchone())[0]
+def prefilter_decision(matches: List[Dict[str, Any]]) -> Tuple[Optional[str], List[str]]:
+    """
+    Итог префильтра: ('reject' | 'fasttrack' | None, пометки для модератора).
+    Отклонение важнее всего; fast-track — только если не сработало ни одно reject/flag.
+    """
+    def describe(rule: Dict[str, Any]) -> str:
+        return rule.get('note') or rule.get('keyword') or rule.get('regex')
 
-    return pub_count, rej_count
+    actions = {rule['action'] for rule in matches}
+    if 'reject' in actions:
+        return 'reject', [describe(rule) for rule in matches if rule['action'] == 'reject']
+    flags = [f"🚩 Фильтр: {escape_html(describe(rule))}" for rule in matches if rule['action'] == 'flag']
+    if flags:
+        return None, flags
+    if 'fasttrack' in actions:
+        return 'fasttrack', [describe(rule) for rule in matches]
+    return None, []
 
 
 # --- FSM СОСТОЯНИЯ, ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ, КЛАВИАТУРЫ ---
@@ -319,6 +1911,96 @@ class Stats(StatesGroup):
     initial = State()
 
 
+class AdDraft:
+    """
+    Черновик объявления пользователя. В FSM storage хранится одним значением — байтами to_bytes() под ключом
+    'draft', а не словарем из восьми ключей со списками: на сессию уходит один объект bytes вместо десятков
+    мелких объектов (см. python bench.py drafts). Формат: заголовок _HEADER, ID сообщений альбома (int64),
+    затем строки (UTF-8 с длиной uint16, NONE_LENGTH — None) — описание, цена, контакт, photo_ids, photo_refs.
+    """
+    __slots__ = ('description', 'price', 'contact', 'photo_ids', 'photo_refs',
+                 'instruction_message_id', 'draft_message_id', 'draft_album_ids')
+
+    VERSION = 1
+    # Версия, instruction_message_id, draft_message_id (0 — нет), количество photo_ids, photo_refs, draft_album_ids
+    _HEADER = struct.Struct('<BqqBBB')
+    _LENGTH = struct.Struct('<H')
+    NONE_LENGTH = 0xFFFF
+
+    def __init__(self, description: Optional[str] = None, price: Optional[str] = None,
+                 contact: Optional[str] = None, photo_ids: Optional[List[str]] = None,
+                 photo_refs: Optional[List[List[str]]] = None, instruction_message_id: Optional[int] = None,
+                 draft_message_id: Optional[int] = None, draft_album_ids: Optional[List[int]] = None):
+        self.description = description
+        self.price = price
+        self.contact = contact
+        self.photo_ids = photo_ids or []
+        self.photo_refs = photo_refs or []
+        self.instruction_message_id = instruction_message_id
+        self.draft_message_id = draft_message_id
+        self.draft_album_ids = draft_album_ids or []
+
+    def to_bytes(self) -> bytes:
+        album_ids = self.draft_album_ids
+        parts = [
+            self._HEADER.pack(self.VERSION, self.instruction_message_id or 0, self.draft_message_id or 0,
+                              len(self.photo_ids), len(self.photo_refs), len(album_ids)),
+            struct.pack(f'<{len(album_ids)}q', *album_ids),
+        ]
+        for value in (self.description, self.price, self.contact, *self.photo_ids,
+                      *(part for ref in self.photo_refs for part in ref)):
+            if value is None:
+                parts.append(self._LENGTH.pack(self.NONE_LENGTH))
+            else:
+                encoded = value.encode()
+                parts.append(self._LENGTH.pack(len(encoded)))  # Лимиты Telegram на текст — меньше 64 КБ
+                parts.append(encoded)
+        return b''.join(parts)
+
+    @classmethod
+    def from_bytes(cls, raw: bytes) -> 'AdDraft':
+        version, instruction_id, draft_id, photos, refs, albums = cls._HEADER.unpack_from(raw)
+        if version != cls.VERSION:
+            raise ValueError(f"unknown draft version {version}")
+        offset = cls._HEADER.size
+        album_ids = list(struct.unpack_from(f'<{albums}q', raw, offset))
+        offset += 8 * albums
+
+        strings: List[Optional[str]] = []
+        for _ in range(3 + photos + 2 * refs):
+            (length,) = cls._LENGTH.unpack_from(raw, offset)
+            offset += cls._LENGTH.size
+            if length == cls.NONE_LENGTH:
+                strings.append(None)
+            else:
+                strings.append(raw[offset:offset + length].decode())
+                offset += length
+
+        ref_parts = strings[3 + photos:]
+        return cls(strings[0], strings[1], strings[2], strings[3:3 + photos],
+                   [[ref_parts[i], ref_parts[i + 1]] for i in range(0, len(ref_parts), 2)],
+                   instruction_id or None, draft_id or None, album_ids)
+
+    def content_fields(self) -> Dict[str, str]:
+        """Поля для префильтра (CONTENT_FIELDS)."""
+        return {field: getattr(self, field) or "" for field in CONTENT_FIELDS}
+
+
+async def load_draft(state: FSMContext) -> AdDraft:
+    """Черновик из FSM (пустой, если его еще нет)."""
+    raw = (await state.get_data()).get('draft')
+    return AdDraft.from_bytes(raw) if raw else AdDraft()
+
+
+async def update_draft_data(state: FSMContext, **changes) -> AdDraft:
+    """Меняет поля черновика в FSM (аналог state.update_data) и возвращает обновленный черновик."""
+    draft = await load_draft(state)
+    for name, value in changes.items():
+        setattr(draft, name, value)
+    await state.update_data(draft=draft.to_bytes())
+    return draft
+
+
 def escape_html(text: Optional[str]) -> str:
     """Экранирование HTML-спецсимволов."""
     if text is None:
@@ -326,11 +2008,11 @@ def escape_html(text: Optional[str]) -> str:
     return str(text).replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
 
 
-def format_ad_text(data: Dict[str, Any], parse_mode: ParseMode = ParseMode.HTML) -> str:
+def format_ad_text(draft: AdDraft, parse_mode: ParseMode = ParseMode.HTML) -> str:
     """Форматирование текста объявления для превью и отправки (минималистичный стиль)."""
-    description = escape_html(data.get('description', 'Описание не указано'))
-    price = escape_html(data.get('price', 'Цена не указана'))
-    contact = escape_html(data.get('contact', 'Контакт не указан'))
+    description = escape_html(draft.description or 'Описание не указано')
+    price = escape_html(draft.price or 'Цена не указана')
+    contact = escape_html(draft.contact or 'Контакт не указан')
 
     if parse_mode == ParseMode.HTML:
         return (
@@ -346,6 +2028,20 @@ def format_ad_text(data: Dict[str, Any], parse_mode: ParseMode = ParseMode.HTML)
         )
 
 
+def format_author_signature(user_id: int, username: Optional[str]) -> str:
+    """Служебная подпись автора для сообщения в предложке."""
+    username_text = f"@{username}" if username else "Нет юзернейма"
+    return f"\n\n— ID Автора: {user_id} ({escape_html(username_text)}) —"
+
+
+def build_moderation_caption(body_html: str, user_id: int, username: Optional[str], notes: List[str]) -> str:
+    """Текст сообщения в предложке: пост, подпись автора и пометки для модератора."""
+    caption = body_html + format_author_signature(user_id, username)
+    if notes:
+        caption += "\n\n" + "\n".join(notes)
+    return caption
+
+
 async def send_log(bot: Bot, message: str):
     """Отправка сообщения в лог-канал."""
     try:
@@ -354,32 +2050,153 @@ async def send_log(bot: Bot, message: str):
         logging.error(f"Failed to send log message to channel: {e}")
 
 
-async def safe_delete_message(bot: Bot, chat_id: int, message_id: Optional[int]):
-    """Безопасное удаление сообщения."""
-    if message_id is None:
-        return
-    try:
-        await bot.delete_message(chat_id, message_id)
-    except TelegramBadRequest:
-        pass
+# --- ПАКЕТНОЕ УДАЛЕНИЕ СООБЩЕНИЙ ---
+# Служебные сообщения (инструкции, ввод пользователя, старые черновики) удаляются не в хендлере, а фоном:
+# ID копятся по чатам и уходят одним deleteMessages на чат (до 100 ID за вызов), чтобы ответ не ждал удалений.
+
+MAX_DELETE_BATCH = 100  # Ограничение Bot API на deleteMessages
+
+
+class DeletionQueue:
+    """Очередь удалений: chat_id -> ID сообщений; сброс через delay секунд после первого ID в чате."""
+
+    def __init__(self, delay: float):
+        self.delay = delay
+        self._pending: Dict[int, Set[int]] = {}
+        self._tasks: Dict[int, asyncio.Task] = {}
+
+    def schedule(self, bot: Bot, chat_id: int, message_ids: List[Optional[int]]):
+        ids = {message_id for message_id in message_ids if message_id is not None}
+        if not ids:
+            return
+        self._pending.setdefault(chat_id, set()).update(ids)
+        if chat_id not in self._tasks:
+            self._tasks[chat_id] = asyncio.create_task(self._flush_later(bot, chat_id))
+
+    async def _flush_later(self, bot: Bot, chat_id: int):
+        await asyncio.sleep(self.delay)
+        self._tasks.pop(chat_id, None)
+        await self._flush_chat(bot, chat_id)
+
+    async def _flush_chat(self, bot: Bot, chat_id: int):
+        ids = sorted(self._pending.pop(chat_id, ()))
+        for start in range(0, len(ids), MAX_DELETE_BATCH):
+            batch = ids[start:start + MAX_DELETE_BATCH]
+            try:
+                # Ненайденные и уже удаленные сообщения Telegram пропускает сам
+                await bot.delete_messages(chat_id, batch)
+                METRICS['deleted_messages'] += len(batch)
+            except TelegramAPIError as e:
+                logging.warning(f"Failed to delete messages {batch} in chat {chat_id}: {e}")
+
+    async def flush_all(self, bot: Bot):
+        """Немедленно удаляет все накопленное (при остановке бота)."""
+        for task in self._tasks.values():
+            task.cancel()
+        self._tasks.clear()
+        for chat_id in list(self._pending):
+            await self._flush_chat(bot, chat_id)
+
+
+DELETIONS = TenantLocal(lambda: DeletionQueue(SETTINGS.DELETE_BATCH_DELAY))
 
 
 async def delete_instruction_message(bot: Bot, chat_id: int, state: FSMContext):
-    """Удаление сообщения-инструкции и сброс его ID в FSM."""
-    data = await state.get_data()
-    message_id = data.get('instruction_message_id')
-    await safe_delete_message(bot, chat_id, message_id)
-    if message_id is not None:
-        await state.update_data(instruction_message_id=None)
+    """Удаление сообщения-инструкции (фоном) и сброс его ID в черновике."""
+    draft = await load_draft(state)
+    if draft.instruction_message_id is not None:
+        DELETIONS.schedule(bot, chat_id, [draft.instruction_message_id])
+        await update_draft_data(state, instruction_message_id=None)
 
 
 async def delete_user_draft(bot: Bot, chat_id: int, state: FSMContext):
-    """Удаление сообщения-черновика и сброс его ID в FSM."""
-    data = await state.get_data()
-    message_id = data.get('draft_message_id')
-    await safe_delete_message(bot, chat_id, message_id)
-    if message_id is not None:
-        await state.update_data(draft_message_id=None)
+    """Удаление сообщения-черновика и альбома при нем (фоном) и сброс их ID в черновике."""
+    draft = await load_draft(state)
+    if draft.draft_message_id is not None or draft.draft_album_ids:
+        DELETIONS.schedule(bot, chat_id, [draft.draft_message_id, *draft.draft_album_ids])
+        await update_draft_data(state, draft_message_id=None, draft_album_ids=[])
+
+
+# --- АЛЬБОМЫ (MEDIA GROUP) ---
+
+MAX_ALBUM_PHOTOS = 10  # Ограничение Telegram на размер альбома
+
+
+class MediaGroupCollector:
+    """
+    Собирает апдейты одного альбома (общий media_group_id) в один список.
+    Первый апдейт альбома ждет, пока новые части не перестанут приходить дольше delay секунд,
+    и возвращает все сообщения; остальные апдейты альбома получают None и ничего не делают.
+    """
+
+    def __init__(self, delay: float):
+        self.delay = delay
+        self._groups: Dict[Tuple[int, str], List[Message]] = {}
+
+    async def collect(self, message: Message) -> Optional[List[Message]]:
+        if not message.media_group_id:
+            return [message]
+
+        key = (message.chat.id, message.media_group_id)
+        bucket = self._groups.get(key)
+        if bucket is not None:
+            bucket.append(message)
+            return None
+
+        bucket = self._groups[key] = [message]
+        seen = 0
+        try:
+            while seen != len(bucket):
+                seen = len(bucket)
+                await asyncio.sleep(self.delay)
+        finally:
+            del self._groups[key]
+        return sorted(bucket, key=lambda m: m.message_id)
+
+
+MEDIA_GROUPS = MediaGroupCollector(SETTINGS.MEDIA_GROUP_DEBOUNCE)
+
+
+def extract_photo_ids(messages: List[Message]) -> List[str]:
+    """ID фото (в наибольшем размере) из сообщений альбома, в порядке отправки."""
+    return [m.photo[-1].file_id for m in messages if m.photo][:MAX_ALBUM_PHOTOS]
+
+
+async def send_ad_post(bot: Bot, chat_id: Union[int, str], photo_ids: List[str], text: str,
+                       reply_markup=None) -> Tuple[Message, List[int]]:
+    """
+    Отправляет объявление с любым количеством фото.
+    Возвращает сообщение с текстом (к нему крепятся кнопки) и ID сообщений альбома, если он отправлялся отдельно.
+    Альбом не поддерживает кнопки, поэтому при reply_markup текст уходит отдельным сообщением-ответом на альбом.
+    """
+    if not photo_ids:
+        message = await bot.send_message(chat_id, text, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
+        return message, []
+
+    if len(photo_ids) == 1:
+        message = await bot.send_photo(chat_id, photo=photo_ids[0], caption=text, reply_markup=reply_markup,
+                                       parse_mode=ParseMode.HTML)
+        return message, []
+
+    if reply_markup is None:
+        media = [InputMediaPhoto(media=photo_ids[0], caption=text, parse_mode=ParseMode.HTML)]
+        media += [InputMediaPhoto(media=photo_id) for photo_id in photo_ids[1:]]
+        album = await bot.send_media_group(chat_id, media=media)
+        return album[0], [m.message_id for m in album]
+
+    album = await bot.send_media_group(chat_id, media=[InputMediaPhoto(media=photo_id) for photo_id in photo_ids])
+    message = await bot.send_message(chat_id, text, reply_markup=reply_markup, parse_mode=ParseMode.HTML,
+                                     reply_to_message_id=album[0].message_id)
+    return message, [m.message_id for m in album]
+
+
+async def send_draft_preview(bot: Bot, chat_id: int, state: FSMContext, caption: str):
+    """Отправляет черновик заново (старый удаляется) и запоминает его ID в FSM."""
+    await delete_user_draft(bot, chat_id, state)
+    draft = await load_draft(state)
+    preview_message, album_ids = await send_ad_post(bot, chat_id, draft.photo_ids, caption,
+                                                    reply_markup=kb_ad_submission_edit())
+    await update_draft_data(state, draft_message_id=preview_message.message_id, draft_album_ids=album_ids)
 
 
 def kb_start_submit():
@@ -422,12 +2239,804 @@ def kb_stats_options():
     return builder.as_markup()
 
 
+def kb_user_history(user_id: int, before_id: Optional[int], next_before_id: Optional[int]):
+    """Листание подач /user по ключу: в начало и к более старым (от ID последней показанной подачи)."""
+    builder = InlineKeyboardBuilder()
+    if before_id is not None:
+        builder.button(text="⏮ В начало", callback_data=f"user:{user_id}")
+    if next_before_id is not None:
+        builder.button(text="Старее ➡️", callback_data=f"user:{user_id}:{next_before_id}")
+    if before_id is None and next_before_id is None:
+        return None
+    builder.adjust(2)
+    return builder.as_markup()
+
+
+def kb_search_pages(page: int, has_next: bool):
+    builder = InlineKeyboardBuilder()
+    if page > 0:
+        builder.button(text="⬅️ Назад", callback_data=f"search:{page - 1}")
+    if has_next:
+        builder.button(text="Вперед ➡️", callback_data=f"search:{page + 1}")
+    if not page and not has_next:
+        return None
+    builder.adjust(2)
+    return builder.as_markup()
+
+
 def kb_stats_back_only():
     builder = InlineKeyboardBuilder()
     builder.button(text="🔙 Назад к меню статистики", callback_data="stats_show_menu")
     return builder.as_markup()
 
 
+# --- АНТИФЛУД ---
+
+class TokenBucketLimiter:
+    """
+    Token bucket на каждого пользователя: rate токенов в секунду, не больше burst в запасе.
+    Ведра лежат в обычном dict в порядке последнего обращения (user_id -> (tokens, last_ts)),
+    поэтому самые старые записи всегда в начале: простаивающие дольше idle_ttl и сверх max_entries вытесняются оттуда.
+    """
+
+    def __init__(self, rate: float, burst: int, max_entries: int = 50_000, idle_ttl: float = 600.0):
+        self.rate = rate
+        self.burst = burst
+        self.max_entries = max_entries
+        # Простаивающее дольше этого ведро все равно было бы полным, так что выбросить его безопасно
+        self.idle_ttl = max(idle_ttl, burst / rate)
+        self._buckets: Dict[Any, Tuple[float, float]] = {}
+
+    def allow(self, key: Any) -> bool:
+        now = time.monotonic()
+        entry = self._buckets.pop(key, None)
+        tokens = self.burst if entry is None else min(self.burst, entry[0] + (now - entry[1]) * self.rate)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        self._buckets[key] = (tokens, now)
+        self._evict(now)
+        return allowed
+
+    def delay(self, key: Any) -> float:
+        """Через сколько секунд у key появится токен (0 — уже есть). Токен не тратится."""
+        entry = self._buckets.get(key)
+        if entry is None:
+            return 0.0
+        tokens = min(self.burst, entry[0] + (time.monotonic() - entry[1]) * self.rate)
+        return 0.0 if tokens >= 1 else (1 - tokens) / self.rate
+
+    def _evict(self, now: float):
+        buckets = self._buckets
+        while buckets:
+            oldest_key = next(iter(buckets))
+            if len(buckets) <= self.max_entries and now - buckets[oldest_key][1] < self.idle_ttl:
+                break
+            del buckets[oldest_key]
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """
+    Внешний middleware: отбрасывает апдейты пользователя сверх лимита до фильтров и хендлеров.
+    Владелец и модераторы не ограничиваются.
+    Альбом тратит один токен на всю группу, остальные его части пропускаются без списания.
+    """
+
+    def __init__(self, kind: str, limiter: TokenBucketLimiter):
+        self.kind = kind
+        self.limiter = limiter
+        self._recent_groups: Dict[str, None] = {}
+
+    async def __call__(self, handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+                       event: TelegramObject, data: Dict[str, Any]) -> Any:
+        user = data.get('event_from_user')
+        if user is None or is_moderator(user.id):
+            return await handler(event, data)
+
+        media_group_id = getattr(event, 'media_group_id', None)
+        if media_group_id and media_group_id in self._recent_groups:
+            return await handler(event, data)
+
+        if not self.limiter.allow(user.id):
+            METRICS[f'throttled_{self.kind}'] += 1
+            if self.kind == 'callbacks':
+                # Без ответа у пользователя крутится индикатор на кнопке, пока клиент не сдастся по таймауту
+                with suppress(TelegramBadRequest):
+                    await event.answer("⏳ Слишком часто, подождите немного.")
+            return None
+
+        if media_group_id:
+            self._recent_groups[media_group_id] = None
+            if len(self._recent_groups) > 1000:
+                del self._recent_groups[next(iter(self._recent_groups))]
+        return await handler(event, data)
+
+
+# --- ПЛАНИРОВЩИК ИСХОДЯЩИХ ЗАПРОСОВ ---
+# Все запросы к Bot API с chat_id проходят через middleware сессии и ждут разрешения планировщика.
+# Разрешения выдаются строго по приоритету полос, внутри полосы — по кругу между чатами (fair queuing),
+# с общим бюджетом бота и бюджетом на чат. Сам запрос выполняется в задаче вызывающего, поэтому
+# ошибки и отмена работают как обычно. Полоса определяется чатом или задается явно через outbound_lane().
+
+OUTBOUND_LANES: Tuple[str, ...] = ('interactive', 'moderation', 'notifications', 'logs', 'broadcast')
+OUTBOUND_LANE: ContextVar[Optional[str]] = ContextVar('outbound_lane', default=None)
+# Методы, создающие сообщения: только они тратят бюджет чата (лимиты Telegram на число сообщений в чат)
+OUTBOUND_MESSAGE_METHODS_PREFIXES = ('send', 'copyMessage', 'forwardMessage')
+OUTBOUND_MAX_RETRIES = 3
+
+
+@contextmanager
+def outbound_lane(lane: str):
+    """Все запросы внутри блока (и в созданных в нем задачах) идут в полосу lane."""
+    token = OUTBOUND_LANE.set(lane)
+    try:
+        yield
+    finally:
+        OUTBOUND_LANE.reset(token)
+
+
+def outbound_lane_for(chat_id: Union[int, str]) -> str:
+    lane = OUTBOUND_LANE.get()
+    if lane is not None:
+        return lane
+    if chat_id == SETTINGS.CHANNEL_LOG_ID:
+        return 'logs'
+    if chat_id in (SETTINGS.CHANNEL_PREDLOZHKA_ID, SETTINGS.CHANNEL_FINAL_ID):
+        return 'moderation'
+    return 'interactive'
+
+
+class OutboundScheduler(BaseRequestMiddleware):
+    """Middleware сессии Bot: очередь разрешений на отправку с приоритетами, бюджетами и обработкой RetryAfter."""
+
+    def __init__(self):
+        self.global_bucket = TokenBucketLimiter(SETTINGS.OUTBOUND_GLOBAL_RATE, SETTINGS.OUTBOUND_GLOBAL_BURST)
+        self.private_buckets = TokenBucketLimiter(SETTINGS.OUTBOUND_PRIVATE_RATE, SETTINGS.OUTBOUND_PRIVATE_BURST)
+        self.group_buckets = TokenBucketLimiter(SETTINGS.OUTBOUND_GROUP_RATE, SETTINGS.OUTBOUND_GROUP_BURST)
+        # Полоса -> чат -> очередь ожидающих (future, тратит ли бюджет чата); порядок чатов — очередь обхода
+        self._lanes: Dict[str, Dict[Union[int, str], Deque[Tuple[asyncio.Future, bool]]]] = {
+            lane: {} for lane in OUTBOUND_LANES
+        }
+        self._blocked_until: Dict[Union[int, str], float] = {}  # chat_id -> monotonic, после RetryAfter
+        self._wakeup: Optional[asyncio.Event] = None
+        self._worker: Optional[asyncio.Task] = None
+
+    async def __call__(self, make_request: NextRequestMiddlewareType, bot: Bot, method: TelegramMethod):
+        chat_id = getattr(method, 'chat_id', None)
+        if chat_id is None:
+            return await make_request(bot, method)
+
+        lane = outbound_lane_for(chat_id)
+        counts_for_chat = method.__api_method__.startswith(OUTBOUND_MESSAGE_METHODS_PREFIXES)
+        METRICS[f'outbound_{lane}'] += 1
+        for attempt in range(OUTBOUND_MAX_RETRIES + 1):
+            await self.acquire(lane, chat_id, counts_for_chat)
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                METRICS['outbound_retry_after'] += 1
+                self._blocked_until[chat_id] = time.monotonic() + e.retry_after
+                logging.warning(f"RetryAfter {e.retry_after}s for {method.__api_method__} to {chat_id} ({lane})")
+                if attempt == OUTBOUND_MAX_RETRIES:
+                    raise
+
+    async def acquire(self, lane: str, chat_id: Union[int, str], counts_for_chat: bool):
+        """Ждет своей очереди на отправку в чат chat_id по полосе lane."""
+        if self._worker is None or self._worker.done():
+            self._wakeup = asyncio.Event()
+            self._worker = asyncio.create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        self._lanes[lane].setdefault(chat_id, deque()).append((future, counts_for_chat))
+        self._wakeup.set()
+        await future
+
+    def depths(self) -> Dict[str, int]:
+        """Число ожидающих запросов в каждой полосе."""
+        return {
+            lane: sum(1 for queue in chats.values() for future, _ in queue if not future.done())
+            for lane, chats in self._lanes.items()
+        }
+
+    def _chat_buckets(self, chat_id: Union[int, str]) -> TokenBucketLimiter:
+        return self.private_buckets if isinstance(chat_id, int) and chat_id > 0 else self.group_buckets
+
+    def _chat_delay(self, chat_id: Union[int, str], counts_for_chat: bool) -> float:
+        blocked = self._blocked_until.get(chat_id, 0.0) - time.monotonic()
+        if blocked <= 0:
+            self._blocked_until.pop(chat_id, None)
+        budget = self._chat_buckets(chat_id).delay(chat_id) if counts_for_chat else 0.0
+        return max(blocked, budget)
+
+    def _grant_next(self) -> Optional[float]:
+        """Выдает одно разрешение. Возвращает 0, если выдано; иначе сколько ждать до ближайшего (None — очередь пуста)."""
+        global_delay = self.global_bucket.delay(0)
+        earliest: Optional[float] = None
+        for lane in OUTBOUND_LANES:
+            chats = self._lanes[lane]
+            for chat_id in list(chats):
+                queue = chats[chat_id]
+                while queue and queue[0][0].done():  # Вызывающий отменил ожидание
+                    queue.popleft()
+                if not queue:
+                    del chats[chat_id]
+                    continue
+                future, counts_for_chat = queue[0]
+                wait = max(global_delay, self._chat_delay(chat_id, counts_for_chat))
+                if wait > 0:
+                    earliest = wait if earliest is None else min(earliest, wait)
+                    continue
+
+                queue.popleft()
+                # Обслуженный чат уходит в конец круга своей полосы
+                del chats[chat_id]
+                if queue:
+                    chats[chat_id] = queue
+                self.global_bucket.allow(0)
+                if counts_for_chat:
+                    self._chat_buckets(chat_id).allow(chat_id)
+                future.set_result(None)
+                return 0.0
+        return earliest
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            wait = self._grant_next()
+            if wait == 0:
+                continue
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+            except asyncio.TimeoutError:
+                pass
+
+
+# Планировщик текущего тенанта: у каждого бота свой бюджет запросов
+OUTBOUND = TenantLocal(OutboundScheduler)
+
+
+# --- ЗАПИСЬ АПДЕЙТОВ ДЛЯ REPLAY ---
+# Входящие апдейты пишутся в сжатый JSONL ({"t": unix_time, "update": {...}}) с ротацией по размеру.
+# ID пользователей заменяются стабильными в пределах записи псевдонимами, имена и юзернеймы удаляются;
+# владелец всегда становится REPLAY_OWNER_ID, чтобы replay.py воспроизводил и его команды.
+
+REPLAY_OWNER_ID = 1
+_SCRUBBED_IDENTITY_KEYS = {'from', 'from_user', 'chat', 'user', 'sender_chat', 'forward_from', 'via_bot'}
+_SCRUBBED_CALLBACK_PATTERN = re.compile(r'^(mod_pub|mod_rej):(\d+)$')
+
+
+class UpdateRecorder(BaseMiddleware):
+    """Внешний middleware на update: копит обезличенные апдейты в памяти и раз в секунду дописывает их в файл."""
+
+    def __init__(self, path: str, max_bytes: int, backups: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self._salt = os.urandom(16)
+        self._buffer: List[str] = []
+        self._flush_task: Optional[asyncio.Task] = None
+
+    async def __call__(self, handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+                       event: TelegramObject, data: Dict[str, Any]) -> Any:
+        try:
+            payload = self.scrub(event.model_dump(mode='json', exclude_none=True))
+            self._buffer.append(json.dumps({'t': time.time(), 'update': payload}, ensure_ascii=False))
+            if self._flush_task is None:
+                self._flush_task = asyncio.create_task(self._flush_loop())
+        except Exception as e:
+            logging.warning(f"Failed to record update: {e}")
+        return await handler(event, data)
+
+    def pseudonym(self, user_id: int) -> int:
+        if user_id == SETTINGS.OWNER_ID:
+            return REPLAY_OWNER_ID
+        if user_id < 0:  # Каналы и группы не персональные данные, их ID нужны для воспроизведения
+            return user_id
+        digest = hashlib.blake2b(user_id.to_bytes(8, 'big', signed=True), key=self._salt, digest_size=4).digest()
+        return 1_000_000_000 + int.from_bytes(digest, 'big') % 1_000_000_000
+
+    def scrub(self, obj: Any) -> Any:
+        if isinstance(obj, list):
+            return [self.scrub(item) for item in obj]
+        if not isinstance(obj, dict):
+            return obj
+
+        result = {}
+        for key, value in obj.items():
+            if key in _SCRUBBED_IDENTITY_KEYS and isinstance(value, dict) and 'id' in value:
+                identity = {k: v for k, v in value.items() if k in ('type', 'is_bot')}
+                identity['id'] = self.pseudonym(value['id'])
+                identity['first_name' if value.get('type', 'private') == 'private' else 'title'] = "user"
+                result[key] = identity
+            elif key == 'data' and isinstance(value, str) and _SCRUBBED_CALLBACK_PATTERN.match(value):
+                action, user_id = value.split(':')
+                result[key] = f"{action}:{self.pseudonym(int(user_id))}"
+            else:
+                result[key] = self.scrub(value)
+        return result
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(1)
+            await self.flush()
+
+    async def flush(self):
+        if not self._buffer:
+            return
+        lines, self._buffer = self._buffer, []
+        try:
+            await asyncio.to_thread(self._write, lines)
+        except Exception as e:
+            logging.warning(f"Failed to write recorded updates: {e}")
+
+    def _write(self, lines: List[str]):
+        # Каждая порция — отдельный gzip-member; gzip.open читает такие файлы целиком
+        with gzip.open(self.path, 'at', encoding='utf-8') as f:
+            f.write("\n".join(lines) + "\n")
+        if os.path.getsize(self.path) >= self.max_bytes:
+            for index in range(self.backups - 1, 0, -1):
+                if os.path.exists(f"{self.path}.{index}"):
+                    os.replace(f"{self.path}.{index}", f"{self.path}.{index + 1}")
+            os.replace(self.path, f"{self.path}.1")
+
+    async def close(self):
+        if self._flush_task:
+            self._flush_task.cancel()
+        await self.flush()
+
+
+# --- ПРОФИЛИРОВАНИЕ ПО ЗАПРОСУ ---
+# Один прогон на процесс: cProfile потока event loop, сэмплер стеков из отдельного потока (с именем текущей задачи),
+# сэмплер точек ожидания всех asyncio-задач и разница снимков tracemalloc. Результат — zip с отчетом,
+# файлом cProfile (для snakeviz/pstats) и свернутыми стеками (для flamegraph.pl / speedscope).
+
+class ProfileBusyError(Exception):
+    """Профилирование уже идет."""
+
+
+class Profiler:
+    """Синглтон прогона профилировщика."""
+    _lock = asyncio.Lock()
+
+    @classmethod
+    def is_running(cls) -> bool:
+        return cls._lock.locked()
+
+    @classmethod
+    async def run(cls, seconds: int) -> Tuple[bytes, str]:
+        """Профилирует процесс seconds секунд. Возвращает (zip-архив, краткая сводка горячих функций)."""
+        if cls._lock.locked():
+            raise ProfileBusyError()
+        async with cls._lock:
+            return await cls._run(seconds)
+
+    @classmethod
+    async def _run(cls, seconds: int) -> Tuple[bytes, str]:
+        loop = asyncio.get_running_loop()
+        stack_samples: Counter = Counter()
+        task_samples: Counter = Counter()
+        await_samples: Counter = Counter()
+
+        started_tracemalloc = not tracemalloc.is_tracing()
+        if started_tracemalloc:
+            tracemalloc.start(10)
+        snapshot_before = tracemalloc.take_snapshot()
+
+        stop = threading.Event()
+        sampler = threading.Thread(
+            target=cls._sample_stacks, name="profile-sampler", daemon=True,
+            args=(threading.get_ident(), loop, stop, stack_samples, task_samples),
+        )
+        profiler = cProfile.Profile()
+        profiler_error = None
+        try:
+            profiler.enable()
+        except ValueError as e:  # Уже активен другой профилировщик
+            profiler_error = str(e)
+
+        started = time.perf_counter()
+        sampler.start()
+        try:
+            deadline = loop.time() + seconds
+            while loop.time() < deadline:
+                cls._sample_await_points(await_samples)
+                await asyncio.sleep(min(SETTINGS.PROFILE_AWAIT_INTERVAL, max(deadline - loop.time(), 0)))
+        finally:
+            if profiler_error is None:
+                profiler.disable()
+            stop.set()
+            await asyncio.to_thread(sampler.join)
+            snapshot_after = tracemalloc.take_snapshot()
+            if started_tracemalloc:
+                tracemalloc.stop()
+        elapsed = time.perf_counter() - started
+
+        stats = None
+        if profiler_error is None:
+            profiler.create_stats()
+            stats = pstats.Stats(profiler)
+        memory_diff = snapshot_after.compare_to(snapshot_before, 'lineno')
+
+        summary = cls._summary(stats, stack_samples, elapsed)
+        report = cls._report(elapsed, stats, profiler_error, stack_samples, task_samples, await_samples, memory_diff)
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+            archive.writestr("report.txt", report)
+            archive.writestr("stacks.folded", "".join(f"{stack} {count}\n" for stack, count in stack_samples.items()))
+            if stats is not None:
+                archive.writestr("cprofile.prof", marshal.dumps(stats.stats))
+        return buffer.getvalue(), summary
+
+    @staticmethod
+    def _frame_label(frame) -> str:
+        code = frame.f_code
+        return f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+
+    @classmethod
+    def _sample_stacks(cls, thread_id: int, loop: asyncio.AbstractEventLoop, stop: threading.Event,
+                       stack_samples: Counter, task_samples: Counter):
+        """Поток-сэмплер: периодически снимает стек потока event loop и запоминает, какая задача сейчас выполняется."""
+        while not stop.wait(SETTINGS.PROFILE_SAMPLE_INTERVAL):
+            frame = sys._current_frames().get(thread_id)
+            if frame is None:
+                continue
+            labels = []
+            while frame is not None and len(labels) < 64:
+                labels.append(cls._frame_label(frame))
+                frame = frame.f_back
+            task = asyncio.current_task(loop)
+            if task is None:
+                task_name = "<idle>" if labels and labels[0].startswith(("select", "poll", "epoll")) else "<loop>"
+            else:
+                coro = task.get_coro()
+                task_name = getattr(coro, '__qualname__', None) or task.get_name()
+            task_samples[task_name] += 1
+            stack_samples[";".join([task_name] + labels[::-1])] += 1
+
+    @classmethod
+    def _sample_await_points(cls, await_samples: Counter):
+        """Для каждой приостановленной задачи находит самый глубокий await — где задачи проводят время в ожидании."""
+        current = asyncio.current_task()
+        for task in asyncio.all_tasks():
+            if task is current or task.done():
+                continue
+            coro, frame = task.get_coro(), None
+            while coro is not None:
+                frame = getattr(coro, 'cr_frame', None) or getattr(coro, 'gi_frame', None) or frame
+                coro = getattr(coro, 'cr_await', None) or getattr(coro, 'gi_yieldfrom', None)
+            if frame is not None:
+                root = getattr(task.get_coro(), '__qualname__', task.get_name())
+                await_samples[f"{root} -> {cls._frame_label(frame)}"] += 1
+
+    @staticmethod
+    def _hot_functions(stats: Optional[pstats.Stats], limit: int) -> List[Tuple[str, float, int]]:
+        if stats is None:
+            return []
+        rows = [
+            (f"{func} ({os.path.basename(filename)}:{line})", tottime, calls)
+            for (filename, line, func), (_, calls, tottime, _, _) in stats.stats.items()
+        ]
+        rows.sort(key=lambda row: row[1], reverse=True)
+        return rows[:limit]
+
+    @classmethod
+    def _summary(cls, stats: Optional[pstats.Stats], stack_samples: Counter, elapsed: float) -> str:
+        lines = [f"⏱️ <b>Профиль за {elapsed:.1f} с</b>"]
+        hot = cls._hot_functions(stats, 5)
+        if hot:
+            lines.append("\n<b>Горячие функции (собственное время):</b>")
+            lines.extend(f"• <code>{escape_html(name)}</code> — {tottime * 1000:.0f} мс, {calls} выз."
+                         for name, tottime, calls in hot)
+        total = sum(stack_samples.values())
+        if total:
+            busy = sum(count for stack, count in stack_samples.items() if not stack.startswith("<idle>"))
+            lines.append(f"\n🔥 Loop занят: {busy / total * 100:.1f}% сэмплов ({total} всего)")
+        return "\n".join(lines)
+
+    @classmethod
+    def _report(cls, elapsed: float, stats: Optional[pstats.Stats], profiler_error: Optional[str],
+                stack_samples: Counter, task_samples: Counter, await_samples: Counter, memory_diff: list) -> str:
+        out = io.StringIO()
+        out.write(f"Профиль процесса {os.getpid()} за {elapsed:.1f} с, {_get_datetime_now_utc_str()}\n\n")
+
+        out.write("=== cProfile: собственное время (tottime) ===\n")
+        if stats is None:
+            out.write(f"недоступно: {profiler_error}\n")
+        else:
+            for name, tottime, calls in cls._hot_functions(stats, 30):
+                out.write(f"{tottime * 1000:10.1f} мс {calls:10d}  {name}\n")
+            out.write("\n=== cProfile: накопленное время (cumulative) ===\n")
+            stats.stream = out
+            stats.sort_stats('cumulative').print_stats(30)
+
+        total = sum(task_samples.values()) or 1
+        out.write(f"\n=== Сэмплы потока loop по задачам ({sum(task_samples.values())}) ===\n")
+        for name, count in task_samples.most_common(20):
+            out.write(f"{count / total * 100:6.1f}%  {name}\n")
+
+        out.write("\n=== Самые частые стеки ===\n")
+        for stack, count in stack_samples.most_common(15):
+            frames = stack.split(";")
+            out.write(f"{count / total * 100:6.1f}%  {frames[0]}\n")
+            out.writelines(f"          {frame}\n" for frame in frames[1:][-8:])
+
+        await_total = sum(await_samples.values()) or 1
+        out.write("\n=== Где задачи ждут (await) ===\n")
+        for point, count in await_samples.most_common(20):
+            out.write(f"{count / await_total * 100:6.1f}%  {point}\n")
+
+        out.write("\n=== tracemalloc: прирост памяти ===\n")
+        for diff in memory_diff[:25]:
+            out.write(f"{diff}\n")
+        return out.getvalue()
+
+
+# --- МОНИТОРИНГ EVENT LOOP ---
+# Лаг планирования: корутина просыпается каждые LOOP_LAG_INTERVAL и меряет, насколько опоздала.
+# Зависания: поток-сторож видит, что корутина давно не просыпалась, и снимает стек потока loop вместе
+# с именем выполняемой задачи — это и есть виновник (синхронный код, тяжелый логгер, CPU в хендлере).
+
+class LoopMonitor:
+    """Один на процесс. Сводки лага пишутся в PROCESS_METRICS и лог; о зависаниях — в лог-канал, не чаще LOOP_ALERT_COOLDOWN."""
+
+    def __init__(self, interval: float, stall_threshold: float):
+        self.interval = interval
+        self.stall_threshold = stall_threshold
+        self._lags: List[float] = []
+        self._stalls: List[Dict[str, Any]] = []
+        self._stalls_lock = threading.Lock()
+        self._last_tick = time.monotonic()
+        self._stop = threading.Event()
+        self._last_alert = 0.0
+        self._suppressed_stalls = 0
+
+    async def run(self, bot: Bot):
+        loop = asyncio.get_running_loop()
+        watchdog = threading.Thread(target=self._watch, args=(threading.get_ident(), loop),
+                                    name="loop-watchdog", daemon=True)
+        watchdog.start()
+        next_report = time.monotonic() + SETTINGS.LOOP_REPORT_INTERVAL
+        try:
+            while True:
+                expected = loop.time() + self.interval
+                await asyncio.sleep(self.interval)
+                self._last_tick = time.monotonic()
+                self._lags.append(max(loop.time() - expected, 0.0))
+                if self._last_tick >= next_report:
+                    next_report = self._last_tick + SETTINGS.LOOP_REPORT_INTERVAL
+                    await self.report(bot)
+        finally:
+            self._stop.set()
+
+    def _watch(self, thread_id: int, loop: asyncio.AbstractEventLoop):
+        """Поток-сторож: фиксирует зависание, как только корутина опаздывает дольше порога."""
+        stall: Optional[Dict[str, Any]] = None
+        while not self._stop.wait(min(0.1, self.stall_threshold / 4)):
+            overdue = time.monotonic() - self._last_tick - self.interval
+            if overdue > self.stall_threshold:
+                if stall is None:
+                    stall = self._snapshot(thread_id, loop)
+                stall['duration'] = overdue
+            elif stall is not None:
+                PROCESS_METRICS['loop_stalls'] += 1
+                with self._stalls_lock:
+                    self._stalls.append(stall)
+                stall = None
+
+    @staticmethod
+    def _snapshot(thread_id: int, loop: asyncio.AbstractEventLoop) -> Dict[str, Any]:
+        task = asyncio.current_task(loop)
+        frame = sys._current_frames().get(thread_id)
+        return {
+            'at': _get_datetime_now_utc_str(),
+            'task': getattr(task.get_coro(), '__qualname__', task.get_name()) if task else "<callback>",
+            'stack': traceback.format_stack(frame, limit=12) if frame else [],
+            'duration': 0.0,
+        }
+
+    async def report(self, bot: Bot):
+        """Сводка за окно: перцентили лага в PROCESS_METRICS и лог; зависания со стеками — в лог-канал."""
+        lags, self._lags = sorted(self._lags), []
+        with self._stalls_lock:
+            stalls, self._stalls = self._stalls, []
+        if lags:
+            PROCESS_METRICS['loop_lag_p50_ms'] = round(lags[len(lags) // 2] * 1000)
+            PROCESS_METRICS['loop_lag_p99_ms'] = round(lags[min(len(lags) - 1, int(len(lags) * 0.99))] * 1000)
+            PROCESS_METRICS['loop_lag_max_ms'] = round(lags[-1] * 1000)
+            logging.info(
+                f"🩺 Лаг event loop: p50 {PROCESS_METRICS['loop_lag_p50_ms']} мс, "
+                f"p99 {PROCESS_METRICS['loop_lag_p99_ms']} мс, max {PROCESS_METRICS['loop_lag_max_ms']} мс; "
+                f"зависаний {len(stalls)}."
+            )
+        if not stalls:
+            return
+
+        for stall in stalls:
+            logging.warning(
+                f"Event loop stalled for ≥{stall['duration'] * 1000:.0f} ms in {stall['task']}:\n"
+                + "".join(stall['stack'])
+            )
+        if time.monotonic() - self._last_alert < SETTINGS.LOOP_ALERT_COOLDOWN:
+            self._suppressed_stalls += len(stalls)
+            return
+        self._last_alert = time.monotonic()
+
+        worst = max(stalls, key=lambda stall: stall['duration'])
+        suppressed = f" (+{self._suppressed_stalls} ранее без уведомления)" if self._suppressed_stalls else ""
+        self._suppressed_stalls = 0
+        stack = "".join(worst['stack'][-6:]).replace("`", "'")[-2500:]
+        await send_log(
+            bot,
+            f"Зависаний event loop: `{len(stalls)}`{suppressed}. Худшее: `≥{worst['duration'] * 1000:.0f} мс` "
+            f"в задаче `{worst['task']}`\n```\n{stack}```"
+        )
+
+
+# --- РЕЗЕРВНЫЕ КОПИИ БД ---
+# Копия снимается online backup API SQLite в отдельном потоке и через отдельное подключение: event loop и поток
+# aiosqlite не заняты. Подключение копирования держит одну транзакцию чтения на все время копии: в режиме WAL
+# она не мешает записи из хендлеров, а копия получается согласованным снимком и не перезапускается от их записей.
+# Копирование идет шагами по BACKUP_PAGES_PER_STEP страниц с паузой между ними, чтобы не забирать диск целиком.
+# Копия проверяется integrity_check, сжимается gzip и ротируется. Восстановление идет тем же API в обратную
+# сторону — в живой файл БД одним шагом, поэтому подключение бота не закрывается: следующие запросы видят
+# восстановленные данные.
+
+BACKUP_SUFFIX = ".db.gz"
+
+
+class BackupError(Exception):
+    pass
+
+
+def _sqlite_backup(source_path: str, target_path: str, pages: int, sleep: float, deadline: float):
+    """Копирует БД source_path в target_path (выполняется в потоке)."""
+    def progress(status: int, remaining: int, total: int):
+        if time.monotonic() > deadline:
+            raise BackupError("превышено время копирования")
+        time.sleep(sleep)
+
+    source = sqlite3.connect(source_path, timeout=10, isolation_level=None)
+    target = sqlite3.connect(target_path)
+    try:
+        # Снимок источника на все шаги копирования (иначе чужая запись между шагами перезапускает копию)
+        source.execute("BEGIN")
+        source.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+        source.backup(target, pages=pages, progress=progress if pages > 0 else None)
+        source.execute("COMMIT")
+    finally:
+        target.close()
+        source.close()
+
+
+def _sqlite_integrity_check(path: str):
+    connection = sqlite3.connect(path)
+    try:
+        result = connection.execute("PRAGMA integrity_check").fetchone()[0]
+    finally:
+        connection.close()
+    if result != 'ok':
+        raise BackupError(f"integrity_check: {result}")
+
+
+class DatabaseBackup:
+    """Резервные копии БД текущего тенанта: <каталог>/<имя БД>_<дата_время>.db.gz. Одна операция на БД за раз."""
+    _locks: Dict[str, asyncio.Lock] = {}
+
+    @classmethod
+    def _lock(cls) -> asyncio.Lock:
+        return cls._locks.setdefault(SETTINGS.DB_NAME, asyncio.Lock())
+
+    @staticmethod
+    def _prefix() -> str:
+        return os.path.splitext(os.path.basename(SETTINGS.DB_NAME))[0] + "_"
+
+    @classmethod
+    def list(cls) -> List[str]:
+        """Имена копий текущей БД, от новых к старым."""
+        if not os.path.isdir(SETTINGS.BACKUP_DIR):
+            return []
+        prefix = cls._prefix()
+        return sorted((name for name in os.listdir(SETTINGS.BACKUP_DIR)
+                       if name.startswith(prefix) and name.endswith(BACKUP_SUFFIX)), reverse=True)
+
+    @classmethod
+    async def create(cls) -> Dict[str, Any]:
+        """Снимает, проверяет, сжимает копию и удаляет старые сверх BACKUP_KEEP. -> сведения о копии."""
+        async with cls._lock():
+            return await cls._create_locked()
+
+    @classmethod
+    async def _create_locked(cls, keep: Optional[str] = None) -> Dict[str, Any]:
+        """
+        create() без захвата блокировки: вызывающий уже держит cls._lock() (asyncio.Lock не реентерабелен).
+        keep — копия, которую ротация не трогает даже сверх BACKUP_KEEP.
+        """
+        await async_db_flush_broadcast_users()
+        name = f"{cls._prefix()}{datetime.now(TIMEZONE).strftime('%Y%m%d_%H%M%S')}{BACKUP_SUFFIX}"
+        started = time.perf_counter()
+        info = await asyncio.to_thread(
+            cls._create_sync, SETTINGS.DB_NAME, SETTINGS.BACKUP_DIR, name, SETTINGS.BACKUP_PAGES_PER_STEP,
+            SETTINGS.BACKUP_STEP_SLEEP, time.monotonic() + SETTINGS.BACKUP_MAX_SECONDS)
+        for old in cls.list()[SETTINGS.BACKUP_KEEP:]:
+            if old != keep:
+                os.remove(os.path.join(SETTINGS.BACKUP_DIR, old))
+        info.update(name=name, seconds=time.perf_counter() - started)
+        METRICS['backups'] += 1
+        return info
+
+    @staticmethod
+    def _create_sync(db_path: str, backup_dir: str, name: str, pages: int, sleep: float,
+                     deadline: float) -> Dict[str, Any]:
+        os.makedirs(backup_dir, exist_ok=True)
+        raw_path = os.path.join(backup_dir, "." + name.replace(BACKUP_SUFFIX, ".db"))
+        gz_path = os.path.join(backup_dir, name)
+        try:
+            _sqlite_backup(db_path, raw_path, pages, sleep, deadline)
+            _sqlite_integrity_check(raw_path)
+            with open(raw_path, 'rb') as src, gzip.open(f"{gz_path}.part", 'wb', compresslevel=6) as dst:
+                while chunk := src.read(1024 * 1024):
+                    dst.write(chunk)
+            os.replace(f"{gz_path}.part", gz_path)  # Недописанная копия никогда не попадает в список
+            return {'raw_size': os.path.getsize(raw_path), 'size': os.path.getsize(gz_path)}
+        finally:
+            for leftover in (raw_path, f"{gz_path}.part"):
+                if os.path.exists(leftover):
+                    os.remove(leftover)
+
+    @classmethod
+    async def restore(cls, name: str) -> Dict[str, Any]:
+        """
+        Восстанавливает БД из копии name (из list()). Перед этим снимается копия текущего состояния,
+        после — применяются миграции (копия могла быть старше схемы) и перечитывается кэш.
+        """
+        # Страховочная копия и восстановление — под одной блокировкой, чтобы между ними не вклинилась другая операция
+        async with cls._lock():
+            if name not in cls.list():
+                raise BackupError("нет такой копии")
+            safety = await cls._create_locked(keep=name)
+            await asyncio.to_thread(cls._restore_sync, os.path.join(SETTINGS.BACKUP_DIR, name), SETTINGS.DB_NAME)
+            await DatabaseManager.init_db()
+            await MemoryCache.warm_up()
+        return {'safety': safety['name']}
+
+    @staticmethod
+    def _restore_sync(gz_path: str, db_path: str):
+        raw_path = f"{gz_path}.restore"
+        try:
+            with gzip.open(gz_path, 'rb') as src, open(raw_path, 'wb') as dst:
+                while chunk := src.read(1024 * 1024):
+                    dst.write(chunk)
+            _sqlite_integrity_check(raw_path)
+            # pages=-1: одним шагом под эксклюзивной блокировкой — другие подключения видят либо старую БД, либо новую
+            _sqlite_backup(raw_path, db_path, -1, 0.0, float('inf'))
+        finally:
+            if os.path.exists(raw_path):
+                os.remove(raw_path)
+
+
+def format_size(size: int) -> str:
+    for unit in ("Б", "КБ", "МБ"):
+        if size < 1024:
+            return f"{size:.0f} {unit}" if unit == "Б" else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} ГБ"
+
+
+async def backup_loop(bot: Bot):
+    """Фоновая задача: копия БД раз в BACKUP_INTERVAL; об ошибках — в лог-канал."""
+    while True:
+        await asyncio.sleep(SETTINGS.BACKUP_INTERVAL)
+        try:
+            info = await DatabaseBackup.create()
+            logging.info(f"💾 Резервная копия {info['name']}: {format_size(info['size'])} за {info['seconds']:.1f} с.")
+        except Exception as e:
+            METRICS['backup_failures'] += 1
+            logging.error(f"Database backup failed: {e}")
+            await send_log(bot, f"❗ Резервная копия БД не создана: `{e}`")
+
+
 # --- ХЭНДЛЕРЫ: ПОЛЬЗОВАТЕЛЬ (START/CANCEL/SUBMISSION) ---
 
 async def cmd_cancel(entity: Union[Message, CallbackQuery], state: FSMContext):
@@ -462,22 +3071,27 @@ async def cmd_cancel_callback_handler(callback: CallbackQuery, state: FSMContext
 
 
 async def process_item_description(message: Message, state: FSMContext, bot: Bot):
-    """Шаг 1: Описание и Фото."""
+    """Шаг 1: Описание и Фото (одно фото или альбом)."""
+    messages = await MEDIA_GROUPS.collect(message)
+    if messages is None:
+        return
+
     await delete_instruction_message(bot, message.chat.id, state)
-    await safe_delete_message(bot, message.chat.id, message.message_id)
+    DELETIONS.schedule(bot, message.chat.id, [part.message_id for part in messages])
 
-    description = message.caption if message.caption else message.text
-    photo_id = message.photo[-1].file_id if message.photo else None
+    description = next((m.caption for m in messages if m.caption), None) or message.text
+    photo_ids = extract_photo_ids(messages)
+    photo_refs = extract_photo_refs(messages)
 
     if not description or len(description.strip()) < 10:
         instruction_message = await message.answer(
             "❌ <b>Ошибка:</b> Описание должно быть не менее 10 символов.\n\nПопробуйте снова.",
             reply_markup=kb_ad_submission_cancel()
         )
-        await state.update_data(instruction_message_id=instruction_message.message_id)
+        await update_draft_data(state, instruction_message_id=instruction_message.message_id)
         return
 
-    await state.update_data(photo_id=photo_id, description=description.strip())
+    await update_draft_data(state, photo_ids=photo_ids, photo_refs=photo_refs, description=description.strip())
     await state.set_state(AdSubmission.waiting_for_price)
 
     instruction_message = await message.answer(
@@ -487,13 +3101,13 @@ async def process_item_description(message: Message, state: FSMContext, bot: Bot
         "• <code>Договорная</code>",
         reply_markup=kb_ad_submission_cancel()
     )
-    await state.update_data(instruction_message_id=instruction_message.message_id)
+    await update_draft_data(state, instruction_message_id=instruction_message.message_id)
 
 
 async def process_price(message: Message, state: FSMContext, bot: Bot):
     """Шаг 2: Цена."""
     await delete_instruction_message(bot, message.chat.id, state)
-    await safe_delete_message(bot, message.chat.id, message.message_id)
+    DELETIONS.schedule(bot, message.chat.id, [message.message_id])
 
     price_text = message.text.strip()
     if not price_text or len(price_text) < 2:
@@ -501,10 +3115,10 @@ async def process_price(message: Message, state: FSMContext, bot: Bot):
             "❌ <b>Ошибка:</b> Цена не может быть такой короткой или пустой.\n\nПопробуйте снова.",
             reply_markup=kb_ad_submission_cancel()
         )
-        await state.update_data(instruction_message_id=instruction_message.message_id)
+        await update_draft_data(state, instruction_message_id=instruction_message.message_id)
         return
 
-    await state.update_data(price=price_text)
+    await update_draft_data(state, price=price_text)
     await state.set_state(AdSubmission.waiting_for_contact)
 
     instruction_message = await message.answer(
@@ -513,13 +3127,13 @@ async def process_price(message: Message, state: FSMContext, bot: Bot):
         "• Телеграм: <code>@username</code>\n",
         reply_markup=kb_ad_submission_cancel()
     )
-    await state.update_data(instruction_message_id=instruction_message.message_id)
+    await update_draft_data(state, instruction_message_id=instruction_message.message_id)
 
 
 async def process_contact(message: Message, state: FSMContext, bot: Bot):
     """Шаг 3: Контакт (предварительный просмотр)."""
     await delete_instruction_message(bot, message.chat.id, state)
-    await safe_delete_message(bot, message.chat.id, message.message_id)
+    DELETIONS.schedule(bot, message.chat.id, [message.message_id])
 
     contact_text = message.text.strip()
     if not contact_text or len(contact_text) < 3:
@@ -527,135 +3141,126 @@ async def process_contact(message: Message, state: FSMContext, bot: Bot):
             "❌ <b>Ошибка:</b> Контакт не может быть такой короткой или пустой.\n\nПопробуйте снова.",
             reply_markup=kb_ad_submission_cancel()
         )
-        await state.update_data(instruction_message_id=instruction_message.message_id)
+        await update_draft_data(state, instruction_message_id=instruction_message.message_id)
         return
 
-    await state.update_data(contact=contact_text)
-
-    data = await state.get_data()
-    ad_text = format_ad_text(data, parse_mode=ParseMode.HTML)
+    draft = await update_draft_data(state, contact=contact_text)
+    ad_text = format_ad_text(draft, parse_mode=ParseMode.HTML)
 
     await state.set_state(AdSubmission.waiting_for_confirmation)
 
     caption = f"📋 <b>ПРЕДПРОСМОТР:</b>\n\n{ad_text}\n\n✅ <b>Проверьте данные перед отправкой</b>"
 
-    await delete_user_draft(bot, message.chat.id, state)
-
-    if data.get('photo_id'):
-        preview_message = await message.bot.send_photo(
-            chat_id=message.chat.id,
-            photo=data['photo_id'],
-            caption=caption,
-            reply_markup=kb_ad_submission_edit()
-        )
-    else:
-        preview_message = await message.answer(
-            caption,
-            reply_markup=kb_ad_submission_edit()
-        )
-    await state.update_data(draft_message_id=preview_message.message_id)
+    await send_draft_preview(bot, message.chat.id, state, caption)
 
 
 async def process_single_edit(message: Message, state: FSMContext, bot: Bot):
     """Обработчик для редактирования."""
+    messages = await MEDIA_GROUPS.collect(message)
+    if messages is None:
+        return
+
     await delete_instruction_message(bot, message.chat.id, state)
-    await safe_delete_message(bot, message.chat.id, message.message_id)
+    DELETIONS.schedule(bot, message.chat.id, [part.message_id for part in messages])
 
     current_state = await state.get_state()
-    data = await state.get_data()
-    draft_message_id = data.get('draft_message_id')
+    draft = await load_draft(state)
+    draft_message_id = draft.draft_message_id
+    old_photo_ids = draft.photo_ids
     chat_id = message.chat.id
 
-    new_data = {}
+    changes = {}
 
     if current_state == AdSubmission.waiting_for_edit_desc.state:
-        new_desc = message.caption if message.caption else message.text
-        new_photo_id = data.get('photo_id')
-        if message.photo:
-            new_photo_id = message.photo[-1].file_id
+        new_desc = next((m.caption for m in messages if m.caption), None) or message.text
+        new_photo_ids = old_photo_ids
+        new_photo_refs = draft.photo_refs
+        if any(m.photo for m in messages):
+            new_photo_ids = extract_photo_ids(messages)
+            new_photo_refs = extract_photo_refs(messages)
         elif not message.caption and message.text:
-            new_photo_id = None
+            new_photo_ids = []
+            new_photo_refs = []
 
         if not new_desc or len(new_desc.strip()) < 10:
             instruction_message = await message.answer(
                 "❌ <b>Ошибка:</b> Описание должно быть не менее 10 символов.",
                 reply_markup=kb_ad_submission_cancel()
             )
-            await state.update_data(instruction_message_id=instruction_message.message_id)
+            await update_draft_data(state, instruction_message_id=instruction_message.message_id)
             return
 
-        new_data['description'] = new_desc.strip()
-        new_data['photo_id'] = new_photo_id
+        changes['description'] = new_desc.strip()
+        changes['photo_ids'] = new_photo_ids
+        changes['photo_refs'] = new_photo_refs
 
     elif current_state == AdSubmission.waiting_for_edit_price.state:
-        new_price = message.text.strip()
+        new_price = (message.text or "").strip()
         if not new_price or len(new_price) < 2:
             instruction_message = await message.answer(
                 "❌ <b>Ошибка:</b> Цена не может быть такой короткой или пустой.",
                 reply_markup=kb_ad_submission_cancel()
             )
-            await state.update_data(instruction_message_id=instruction_message.message_id)
+            await update_draft_data(state, instruction_message_id=instruction_message.message_id)
             return
-        new_data['price'] = new_price
+        changes['price'] = new_price
 
     elif current_state == AdSubmission.waiting_for_edit_contact.state:
-        new_contact = message.text.strip()
+        new_contact = (message.text or "").strip()
         if not new_contact or len(new_contact) < 3:
             instruction_message = await message.answer(
                 "❌ <b>Ошибка:</b> Контакт не может быть такой короткой или пустой.",
                 reply_markup=kb_ad_submission_cancel()
             )
-            await state.update_data(instruction_message_id=instruction_message.message_id)
+            await update_draft_data(state, instruction_message_id=instruction_message.message_id)
             return
-        new_data['contact'] = new_contact
+        changes['contact'] = new_contact
 
-    await state.update_data(**new_data)
-    data.update(new_data)
+    draft = await update_draft_data(state, **changes)
 
-    ad_text = format_ad_text(data, parse_mode=ParseMode.HTML)
+    ad_text = format_ad_text(draft, parse_mode=ParseMode.HTML)
     caption_text = f"📋 <b>ПРЕДПРОСМОТР:</b>\n\n{ad_text}\n\n✅ <b>Проверьте данные перед отправкой</b>"
 
-    new_draft_message_id = draft_message_id
-    is_photo_in_data = bool(data.get('photo_id'))
+    photo_ids = draft.photo_ids
+    photos_changed = photo_ids != old_photo_ids
+    # Черновик с альбомом — это альбом + отдельное текстовое сообщение с кнопками
+    is_album_draft = bool(draft.draft_album_ids) or len(photo_ids) > 1
 
-    if draft_message_id:
-        try:
-            if is_photo_in_data:
-                input_media = InputMediaPhoto(media=data['photo_id'], caption=caption_text, parse_mode=ParseMode.HTML)
-                await bot.edit_message_media(
-                    chat_id=chat_id,
-                    message_id=draft_message_id,
-                    media=input_media,
-                    reply_markup=kb_ad_submission_edit()
-                )
-            else:
-                await bot.edit_message_text(
-                    chat_id=chat_id,
-                    message_id=draft_message_id,
-                    text=caption_text,
-                    reply_markup=kb_ad_submission_edit()
-                )
-        except TelegramBadRequest as e:
-            logging.warning(f"Failed to edit draft message {draft_message_id}: {e}. Retrying with send_... and delete.")
-            await safe_delete_message(bot, chat_id, draft_message_id)
-
-            if is_photo_in_data:
-                new_draft = await message.bot.send_photo(
-                    chat_id=chat_id,
-                    photo=data['photo_id'],
-                    caption=caption_text,
-                    reply_markup=kb_ad_submission_edit()
-                )
-            else:
-                new_draft = await message.answer(
-                    caption_text,
-                    reply_markup=kb_ad_submission_edit()
-                )
-            new_draft_message_id = new_draft.message_id
+    async def update_draft():
+        if draft_message_id and is_album_draft and photos_changed:
+            await send_draft_preview(bot, chat_id, state, caption_text)
+        elif draft_message_id:
+            try:
+                if is_album_draft:
+                    await bot.edit_message_text(
+                        chat_id=chat_id,
+                        message_id=draft_message_id,
+                        text=caption_text,
+                        reply_markup=kb_ad_submission_edit()
+                    )
+                elif photo_ids:
+                    input_media = InputMediaPhoto(media=photo_ids[0], caption=caption_text, parse_mode=ParseMode.HTML)
+                    await bot.edit_message_media(
+                        chat_id=chat_id,
+                        message_id=draft_message_id,
+                        media=input_media,
+                        reply_markup=kb_ad_submission_edit()
+                    )
+                else:
+                    await bot.edit_message_text(
+                        chat_id=chat_id,
+                        message_id=draft_message_id,
+                        text=caption_text,
+                        reply_markup=kb_ad_submission_edit()
+                    )
+            except TelegramBadRequest as e:
+                logging.warning(f"Failed to edit draft message {draft_message_id}: {e}. Retrying with send_... and delete.")
+                await send_draft_preview(bot, chat_id, state, caption_text)
 
-    await state.update_data(draft_message_id=new_draft_message_id)
     await state.set_state(AdSubmission.waiting_for_confirmation)
 
+    # Подтверждение — только после черновика: при неудачной правке он отправляется заново и должен оказаться «выше»
+    await update_draft()
     await message.answer("✅ <b>Редактирование завершено.</b>\n\nПроверьте обновленный черновик выше.",
                          reply_markup=types.ReplyKeyboardRemove())
 
@@ -687,7 +3292,11 @@ async def command_start(message: Message, state: FSMContext):
         limit_info = "<b>Безлимит</b> (Владелец)"
     else:
         remaining = max(0, SETTINGS.MAX_POSTS_PER_DAY - current_count)
-        limit_info = f"<b>Лимит:</b> {SETTINGS.MAX_POSTS_PER_DAY} <b>постов в сутки.</b> <b>Осталось:</b> {remaining}"
+        limit_info = (f"<b>Лимит:</b> {SETTINGS.MAX_POSTS_PER_DAY} <b>постов за 24 часа.</b> "
+                      f"<b>Осталось:</b> {remaining}")
+        next_slot = await async_db_get_next_slot_time(user_id)
+        if next_slot:
+            limit_info += f"\n• <b>Следующий слот освободится:</b> {format_slot_time(next_slot)}"
 
     welcome_text = (
         f"<b>Здравствуйте, {escape_html(message.from_user.full_name)}!</b>\n\n"
@@ -707,10 +3316,11 @@ async def callback_start_submit(callback: CallbackQuery, state: FSMContext):
 
     current_count = await async_db_get_current_limit_count(user_id)
     if user_id != SETTINGS.OWNER_ID and current_count >= SETTINGS.MAX_POSTS_PER_DAY:
+        next_slot = await async_db_get_next_slot_time(user_id)
         await callback.message.edit_text(
             f"🚫 <b>Превышен лимит постов</b>\n\n"
-            f"На сегодня вы уже использовали {SETTINGS.MAX_POSTS_PER_DAY} постов.\n"
-            f"Попробуйте завтра!",
+            f"За последние 24 часа вы уже использовали {SETTINGS.MAX_POSTS_PER_DAY} постов.\n"
+            f"Следующая подача будет доступна {format_slot_time(next_slot)}.",
             reply_markup=None
         )
         await state.clear()
@@ -720,7 +3330,7 @@ async def callback_start_submit(callback: CallbackQuery, state: FSMContext):
 
     step1_text = (
         "📝 <b>Шаг 1 из 3: Описание и фото</b>\n\n"
-        "Пришлите <b>одно фото</b> (по желанию) и подробное описание вашего товара.\n\n"
+        "Пришлите <b>фото или альбом до 10 фото</b> (по желанию) и подробное описание вашего товара.\n\n"
         "📌 <b>Требования:</b>\n"
         "• Описание должно быть полным и понятным\n"
         "• Минимум 10 символов\n"
@@ -728,12 +3338,12 @@ async def callback_start_submit(callback: CallbackQuery, state: FSMContext):
     )
 
     instruction_message = await callback.message.edit_text(step1_text, reply_markup=kb_ad_submission_cancel())
-    await state.update_data(instruction_message_id=instruction_message.message_id)
+    await update_draft_data(state, instruction_message_id=instruction_message.message_id)
 
 
 async def callback_final_send(callback: CallbackQuery, state: FSMContext, bot: Bot):
     """Хендлер финальной отправки."""
-    data = await state.get_data()
+    draft = await load_draft(state)
     user_id = callback.from_user.id
 
     await callback.answer("📤 Отправка на модерацию...")
@@ -758,35 +3368,78 @@ async def callback_final_send(callback: CallbackQuery, state: FSMContext, bot: B
         return
 
     try:
-        ad_text = format_ad_text(data, parse_mode=ParseMode.HTML)
-        photo_id = data.get('photo_id')
-
-        username = f"@{callback.from_user.username}" if callback.from_user.username else "Нет юзернейма"
-        author_sig = f"\n\n— ID Автора: {user_id} ({escape_html(username)}) —"
-        caption_for_mod = ad_text + author_sig
-
-        message_info: Message
-        if photo_id:
-            message_info = await bot.send_photo(
-                chat_id=SETTINGS.CHANNEL_PREDLOZHKA_ID,
-                photo=photo_id,
-                caption=caption_for_mod,
-                reply_markup=kb_moderation_main(user_id),
-                parse_mode=ParseMode.HTML
+        ad_text = format_ad_text(draft, parse_mode=ParseMode.HTML)
+        photo_ids = draft.photo_ids
+
+        decision, filter_notes = prefilter_decision(ContentPrefilter.check(draft.content_fields()))
+        if decision == 'reject':
+            METRICS['prefilter_rejected'] += 1
+            await delete_user_draft(bot, callback.message.chat.id, state)
+            await bot.send_message(
+                user_id,
+                "❌ <b>Объявление отклонено автоматически.</b>\n\n"
+                f"Причина: {escape_html('; '.join(filter_notes))}.\n"
+                "Исправьте объявление и попробуйте снова."
             )
+            await send_log(bot, f"Пост от {callback.from_user.full_name} ({user_id}) отклонен фильтром: "
+                                f"`{'; '.join(filter_notes)}`.")
+            await state.clear()
+            return
+
+        signature = minhash_signature(draft.description or '')
+        mod_notes = []
+        duplicate = await async_db_find_similar_ad(signature)
+        if duplicate:
+            mod_notes.append(format_duplicate_note(duplicate))
+        photo_refs = draft.photo_refs
+        # Без очереди — по правилу fasttrack или доверенный автор, если фильтр ничего не отметил
+        trusted_note, audit = None, False
+        if decision is None and not filter_notes:
+            published, rejected = await async_db_get_reputation(user_id)
+            if is_trusted_author(published, rejected):
+                trusted_note = f"доверенный автор (одобрено {published}, отклонено {rejected})"
+                audit = random.random() < SETTINGS.REPUTATION_AUDIT_RATE
+        if decision == 'fasttrack':
+            fast_track_reason = "fast-track по правилам фильтра"
         else:
-            message_info = await bot.send_message(
-                chat_id=SETTINGS.CHANNEL_PREDLOZHKA_ID,
-                text=caption_for_mod,
-                reply_markup=kb_moderation_main(user_id),
-                parse_mode=ParseMode.HTML
-            )
+            fast_track_reason = trusted_note if not audit else None
+        # Fast-track только для чистых объявлений: любая пометка (фильтр или дубликат) — в обычную очередь.
+        # Повтор фото проверяется фоном после отправки; для fast-track точный повтор проверяется сразу
+        fast_track = fast_track_reason is not None and not duplicate and not (
+            photo_refs and await async_db_find_photo_repeats([unique_id for unique_id, _ in photo_refs]))
+        if fast_track:
+            mod_notes.append(f"⚡ Fast-track: {escape_html('; '.join(filter_notes) or trusted_note)}")
+        else:
+            mod_notes.extend(filter_notes)
+            if audit:
+                METRICS['reputation_audits'] += 1
+                mod_notes.append(f"🔍 Выборочная проверка: {trusted_note}")
+            elif trusted_note:
+                mod_notes.append(f"⭐ {trusted_note.capitalize()}")
+
+        caption_for_mod = build_moderation_caption(ad_text, user_id, callback.from_user.username, mod_notes)
+
+        message_info, _ = await send_ad_post(bot, SETTINGS.CHANNEL_PREDLOZHKA_ID, photo_ids, caption_for_mod,
+                                             reply_markup=kb_moderation_main(user_id))
 
+        moderator_id = pick_moderator()
         await async_db_increment_limit(user_id)
-        await async_db_record_pending_post(message_info.message_id, user_id)
+        await async_db_record_pending_post(message_info.message_id, user_id, photo_ids, ad_text,
+                                           callback.from_user.username, callback.from_user.full_name, mod_notes,
+                                           assigned_to=moderator_id)
+        _change_moderator_load(moderator_id, +1)
+        await async_db_store_ad_signature(message_info.message_id, user_id, signature)
+        schedule_photo_check(bot, message_info.message_id, user_id, photo_refs)
+        await async_db_archive_ad(message_info.message_id, user_id, callback.from_user.username,
+                                  callback.from_user.full_name, draft)
 
         await delete_user_draft(bot, callback.message.chat.id, state)
 
+        if fast_track and await fast_track_publish(bot, message_info, photo_ids, ad_text, caption_for_mod, user_id,
+                                                   moderator_id, fast_track_reason):
+            await state.clear()
+            return
+
         await bot.send_message(
             user_id,
             "✅ <b>Объявление отправлено на модерацию!</b>\n\n"
@@ -795,6 +3448,8 @@ async def callback_final_send(callback: CallbackQuery, state: FSMContext, bot: B
 
         await send_log(bot,
                        f"Пост от {callback.from_user.full_name} ({user_id}) отправлен в предложку (Message ID: {message_info.message_id}).")
+        if moderator_id != SETTINGS.OWNER_ID:
+            await notify_moderator_assignment(bot, moderator_id, message_info.message_id)
 
         await state.clear()
 
@@ -823,11 +3478,56 @@ async def cmd_help_owner(message: Message):
         "<code>/stats</code> - <b>Статистика</b>\n"
         "<code>/broadcast</code> - <b>Рассылка</b>\n"
         "<code>/ban</code> <code>[user_id]</code> - <b>Забанить</b>\n"
-        "<code>/unban</code> <code>[user_id]</code> - <b>Разбанить</b>"
+        "<code>/unban</code> <code>[user_id]</code> - <b>Разбанить</b>\n"
+        "<code>/banlist</code> / <code>/unbanlist</code> - <b>Бан/разбан списком</b> (файл или ID построчно)\n"
+        "<code>/search</code> <code>[запрос]</code> - <b>Поиск по архиву объявлений</b>\n"
+        "<code>/user</code> <code>[user_id]</code> - <b>История пользователя: подачи, решения, баны, лимит</b>\n"
+        "<code>/rules_reload</code> - <b>Перечитать правила фильтра объявлений</b>\n"
+        "<code>/backup</code> / <code>/restore</code> <code>[имя]</code> - <b>Резервная копия БД / восстановление</b>\n"
+        "<code>/mod_add</code> <code>[user_id]</code> - <b>Добавить модератора</b>\n"
+        "<code>/mod_del</code> <code>[user_id]</code> - <b>Убрать модератора</b>\n"
+        "<code>/mods</code> - <b>Модераторы и их нагрузка</b>\n"
+        "<code>/online</code> / <code>/offline</code> - <b>Начать/закончить смену модерации</b>\n"
+        "<code>/profile</code> <code>[секунд]</code> - <b>Профилировать бота без перезапуска</b>"
     )
     await message.answer(help_text)
 
 
+def parse_profile_seconds(raw: Optional[str]) -> Optional[int]:
+    """Длительность прогона профилировщика из аргумента; None — если аргумент некорректен."""
+    if not raw:
+        return SETTINGS.PROFILE_DEFAULT_SECONDS
+    if not raw.isdigit() or not 1 <= int(raw) <= SETTINGS.PROFILE_MAX_SECONDS:
+        return None
+    return int(raw)
+
+
+async def cmd_profile(message: Message):
+    if message.from_user.id != SETTINGS.OWNER_ID: return
+
+    parts = message.text.split()
+    seconds = parse_profile_seconds(parts[1] if len(parts) > 1 else None)
+    if seconds is None:
+        await message.answer(
+            "❌ <b>Ошибка:</b> Укажите длительность в секундах "
+            f"(от 1 до {SETTINGS.PROFILE_MAX_SECONDS}).\n\n"
+            "Формат: <code>/profile [секунд]</code>"
+        )
+        return
+    if Profiler.is_running():
+        await message.answer("⏳ Профилирование уже идет, дождитесь результата.")
+        return
+
+    await message.answer(f"⏱️ Профилирую {seconds} с...")
+    try:
+        archive, summary = await Profiler.run(seconds)
+    except ProfileBusyError:
+        await message.answer("⏳ Профилирование уже идет, дождитесь результата.")
+        return
+    filename = f"profile_{datetime.now(TIMEZONE).strftime('%Y%m%d_%H%M%S')}.zip"
+    await message.answer_document(types.BufferedInputFile(archive, filename=filename), caption=summary[:1024])
+
+
 async def cmd_ban(message: Message):
     if message.from_user.id != SETTINGS.OWNER_ID: return
 
@@ -868,13 +3568,168 @@ async def cmd_unban(message: Message):
     user_id_to_unban = int(parts[1])
 
     if await async_db_is_banned(user_id_to_unban):
-        await async_db_unban_user(user_id_to_unban)
+        await async_db_unban_user(user_id_to_unban, message.from_user.id)
         await message.answer(f"✅ <b>Пользователь <code>{user_id_to_unban}</code> разблокирован.</b>")
         await send_log(message.bot, f"Пользователь `{user_id_to_unban}` разблокирован.")
     else:
         await message.answer(f"ℹ️ <b>Пользователь <code>{user_id_to_unban}</code> не был забанен.</b>")
 
 
+async def cmd_rules_reload(message: Message):
+    if message.from_user.id != SETTINGS.OWNER_ID: return
+    try:
+        count = ContentPrefilter.load(SETTINGS.CONTENT_RULES_PATH)
+    except (OSError, ValueError) as e:
+        # json.JSONDecodeError — тоже ValueError; прежний набор правил остается в силе
+        await message.answer(f"❌ <b>Правила не загружены:</b> {escape_html(str(e))}\n\nДействует прежний набор.")
+        return
+    actions = Counter(rule['action'] for rule in ContentPrefilter.rules)
+    await message.answer(
+        f"✅ <b>Правил загружено: {count}</b>\n"
+        f"reject: {actions['reject']}, flag: {actions['flag']}, fasttrack: {actions['fasttrack']}"
+    )
+    await send_log(message.bot, f"Правила фильтра перезагружены: `{count}`.")
+
+
+async def cmd_backup(message: Message):
+    if message.from_user.id != SETTINGS.OWNER_ID: return
+    try:
+        info = await DatabaseBackup.create()
+    except Exception as e:
+        await message.answer(f"❌ <b>Копия не создана:</b> {escape_html(str(e))}")
+        return
+    await message.answer(
+        f"💾 <b>Копия создана:</b> <code>{info['name']}</code>\n"
+        f"{format_size(info['raw_size'])} → {format_size(info['size'])} за {info['seconds']:.1f} с, integrity_check: ok"
+    )
+
+
+async def cmd_restore(message: Message):
+    if message.from_user.id != SETTINGS.OWNER_ID: return
+    parts = message.text.split()
+    if len(parts) < 2:
+        backups = DatabaseBackup.list()[:10]
+        if not backups:
+            await message.answer("ℹ️ Резервных копий пока нет. Создать: <code>/backup</code>")
+            return
+        names = "\n".join(f"<code>{name}</code>" for name in backups)
+        await message.answer(f"💾 <b>Последние копии:</b>\n{names}\n\nВосстановить: <code>/restore [имя]</code>")
+        return
+
+    name = parts[1]
+    await message.answer(f"⏳ Восстанавливаю из <code>{escape_html(name)}</code>...")
+    try:
+        result = await DatabaseBackup.restore(name)
+    except Exception as e:
+        await message.answer(f"❌ <b>Не восстановлено:</b> {escape_html(str(e))}")
+        return
+    await message.answer(
+        f"✅ <b>БД восстановлена</b> из <code>{name}</code>.\n"
+        f"Состояние до восстановления сохранено в <code>{result['safety']}</code>."
+    )
+    await send_log(message.bot, f"БД восстановлена из копии `{name}` (прежнее состояние: `{result['safety']}`).")
+
+
+# --- МАССОВЫЙ БАН/РАЗБАН ---
+# Список — в тексте после команды или в файле (.txt/.csv), отправленном с командой в подписи.
+# Строка: "user_id [причина]" (разделители — пробел, запятая, точка с запятой) или несколько ID подряд.
+# Причина из первой строки команды (/banlist спам) действует для строк без своей причины.
+
+MAX_ID_LIST_FILE_SIZE = 5 * 1024 * 1024
+ID_LIST_LINE_PATTERN = re.compile(r'^\s*(\d+)[\s,;]*(.*?)\s*$')
+ID_LIST_ONLY_IDS_PATTERN = re.compile(r'^[\d\s,;]*$')
+
+
+def parse_id_list(text: str, default_reason: str) -> Tuple[Dict[int, str], int]:
+    """Разбирает список ID с причинами. Возвращает ({user_id: причина}, число нераспознанных строк)."""
+    entries: Dict[int, str] = {}
+    invalid = 0
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        match = ID_LIST_LINE_PATTERN.match(line)
+        if not match:
+            invalid += 1
+            continue
+        user_id, rest = int(match.group(1)), match.group(2)
+        if ID_LIST_ONLY_IDS_PATTERN.match(rest):
+            for extra_id in re.findall(r'\d+', rest):
+                entries[int(extra_id)] = default_reason
+            entries[user_id] = default_reason
+        else:
+            entries[user_id] = rest
+    return entries, invalid
+
+
+async def read_id_list(message: Message) -> Tuple[str, str]:
+    """Текст списка (из файла или из сообщения после первой строки) и причина по умолчанию из первой строки."""
+    command_text = message.caption if message.document else message.text
+    first_line, _, rest = (command_text or "").partition("\n")
+    parts = first_line.split(maxsplit=1)
+    default_reason = parts[1].strip() if len(parts) > 1 else "Не указана"
+
+    if message.document:
+        if message.document.file_size and message.document.file_size > MAX_ID_LIST_FILE_SIZE:
+            raise ValueError(f"файл больше {MAX_ID_LIST_FILE_SIZE // (1024 * 1024)} МБ")
+        data = await message.bot.download(message.document)
+        return data.read().decode('utf-8', errors='replace'), default_reason
+    # Однострочная форма: /banlist 123 спам или /unbanlist 1 2 3
+    if not rest.strip():
+        return parts[1] if len(parts) > 1 else "", "Не указана"
+    return rest, default_reason
+
+
+async def cmd_banlist(message: Message):
+    if message.from_user.id != SETTINGS.OWNER_ID: return
+    try:
+        text, default_reason = await read_id_list(message)
+    except (ValueError, TelegramAPIError) as e:
+        await message.answer(f"❌ <b>Ошибка:</b> Не удалось прочитать список: {escape_html(str(e))}")
+        return
+
+    entries, invalid = parse_id_list(text, default_reason)
+    entries.pop(SETTINGS.OWNER_ID, None)
+    if not entries:
+        await message.answer(
+            "❌ <b>Ошибка:</b> В списке нет ID.\n\n"
+            "Формат: <code>/banlist [причина]</code>, далее по строке <code>user_id [причина]</code> "
+            "или файл .txt/.csv с командой в подписи."
+        )
+        return
+
+    newly_banned = await async_db_ban_users(entries, message.from_user.id)
+    await message.answer(
+        f"✅ <b>Заблокировано: {len(entries)}</b> (новых {newly_banned}, уже были в бане {len(entries) - newly_banned})"
+        + (f"\n⚠️ Нераспознанных строк: {invalid}" if invalid else "")
+    )
+    await send_log(message.bot, f"Массовый бан: `{len(entries)}` пользователей (новых `{newly_banned}`), "
+                                f"нераспознанных строк `{invalid}`.")
+
+
+async def cmd_unbanlist(message: Message):
+    if message.from_user.id != SETTINGS.OWNER_ID: return
+    try:
+        text, _ = await read_id_list(message)
+    except (ValueError, TelegramAPIError) as e:
+        await message.answer(f"❌ <b>Ошибка:</b> Не удалось прочитать список: {escape_html(str(e))}")
+        return
+
+    entries, invalid = parse_id_list(text, "")
+    if not entries:
+        await message.answer(
+            "❌ <b>Ошибка:</b> В списке нет ID.\n\n"
+            "Формат: <code>/unbanlist</code>, далее ID построчно, или файл .txt/.csv с командой в подписи."
+        )
+        return
+
+    was_banned = await async_db_unban_users(set(entries), message.from_user.id)
+    await message.answer(
+        f"✅ <b>Разблокировано: {was_banned}</b> (не были в бане {len(entries) - was_banned})"
+        + (f"\n⚠️ Нераспознанных строк: {invalid}" if invalid else "")
+    )
+    await send_log(message.bot, f"Массовый разбан: `{was_banned}` пользователей, нераспознанных строк `{invalid}`.")
+
+
 async def cmd_broadcast(message: Message, state: FSMContext):
     if message.from_user.id != SETTINGS.OWNER_ID: return
     await state.set_state(Broadcast.waiting_for_message)
@@ -919,8 +3774,6 @@ async def callback_broadcast_confirm(callback: CallbackQuery, state: FSMContext,
         return
 
     user_ids = await async_db_get_all_broadcast_users()
-    success_count = 0
-    fail_count = 0
 
     await callback.message.edit_text(
         f"📤 <b>Начало рассылки</b>\n\n"
@@ -929,22 +3782,24 @@ async def callback_broadcast_confirm(callback: CallbackQuery, state: FSMContext,
         reply_markup=None
     )
 
-    for user_id in user_ids:
-        if user_id == callback.from_user.id:
-            continue
+    # Темп задает планировщик (полоса broadcast уступает всем остальным); здесь только BROADCAST_CONCURRENCY
+    # воркеров, которые разбирают общий список получателей
+    recipients = iter([user_id for user_id in user_ids if user_id != callback.from_user.id])
+    success_count = 0
+    fail_count = 0
 
-        try:
-            await bot.copy_message(
-                chat_id=user_id,
-                from_chat_id=source_chat_id,
-                message_id=source_message_id
-            )
-            success_count += 1
-            await asyncio.sleep(0.05)
-        except (TelegramBadRequest, TelegramAPIError) as e:
-            fail_count += 1
-            logging.warning(f"Failed to send broadcast to user {user_id}: {e}")
-            await asyncio.sleep(0.05)
+    async def deliver():
+        nonlocal success_count, fail_count
+        for user_id in recipients:
+            try:
+                await bot.copy_message(chat_id=user_id, from_chat_id=source_chat_id, message_id=source_message_id)
+                success_count += 1
+            except (TelegramBadRequest, TelegramAPIError) as e:
+                fail_count += 1
+                logging.warning(f"Failed to send broadcast to user {user_id}: {e}")
+
+    with outbound_lane('broadcast'):
+        await asyncio.gather(*(deliver() for _ in range(SETTINGS.BROADCAST_CONCURRENCY)))
 
     await callback.message.answer(
         f"✅ <b>Рассылка завершена</b>\n\n"
@@ -957,6 +3812,261 @@ async def callback_broadcast_confirm(callback: CallbackQuery, state: FSMContext,
     await state.clear()
 
 
+# --- ХЕНДЛЕРЫ ПУЛА МОДЕРАТОРОВ ---
+
+async def cmd_mod_add(message: Message):
+    if message.from_user.id != SETTINGS.OWNER_ID: return
+
+    parts = message.text.split()
+    if len(parts) < 2 or not parts[1].isdigit():
+        await message.answer(
+            "❌ <b>Ошибка:</b> Укажите ID пользователя.\n\n"
+            "Формат: <code>/mod_add [user_id]</code>"
+        )
+        return
+
+    moderator_id = int(parts[1])
+    if moderator_id == SETTINGS.OWNER_ID:
+        await message.answer("ℹ️ Владелец всегда может модерировать.")
+        return
+
+    await async_db_add_moderator(moderator_id, message.from_user.id)
+    await message.answer(
+        f"✅ <b>Пользователь <code>{moderator_id}</code> добавлен в модераторы.</b>\n\n"
+        f"Чтобы получать посты, он должен начать смену командой /online в личке бота."
+    )
+    await send_log(message.bot, f"Пользователь `{moderator_id}` добавлен в модераторы.")
+
+
+async def cmd_mod_del(message: Message, bot: Bot):
+    if message.from_user.id != SETTINGS.OWNER_ID: return
+
+    parts = message.text.split()
+    if len(parts) < 2 or not parts[1].isdigit():
+        await message.answer(
+            "❌ <b>Ошибка:</b> Укажите ID пользователя.\n\n"
+            "Формат: <code>/mod_del [user_id]</code>"
+        )
+        return
+
+    moderator_id = int(parts[1])
+    if moderator_id not in MemoryCache.moderators:
+        await message.answer(f"ℹ️ <b>Пользователь <code>{moderator_id}</code> не модератор.</b>")
+        return
+
+    await async_db_remove_moderator(moderator_id)
+    await reassign_posts(bot, moderator_id)
+    await message.answer(f"✅ <b>Пользователь <code>{moderator_id}</code> больше не модератор.</b>")
+    await send_log(bot, f"Пользователь `{moderator_id}` удален из модераторов.")
+
+
+async def cmd_mods(message: Message):
+    if message.from_user.id != SETTINGS.OWNER_ID: return
+
+    lines = ["👥 <b>Модераторы</b>\n"]
+    for moderator_id in sorted(MemoryCache.moderators | {SETTINGS.OWNER_ID}):
+        status = "🟢" if moderator_id in MemoryCache.online_moderators else "⚪️"
+        role = " (владелец)" if moderator_id == SETTINGS.OWNER_ID else ""
+        lines.append(f"{status} <code>{moderator_id}</code>{role} — постов в работе: "
+                     f"{MemoryCache.moderator_load.get(moderator_id, 0)}")
+    await message.answer("\n".join(lines))
+
+
+async def cmd_online(message: Message):
+    if not is_moderator(message.from_user.id): return
+
+    await async_db_set_moderator_online(message.from_user.id, True)
+    await message.answer("🟢 <b>Смена начата.</b> Новые посты будут назначаться вам.")
+
+
+async def cmd_offline(message: Message, bot: Bot):
+    if not is_moderator(message.from_user.id): return
+
+    await async_db_set_moderator_online(message.from_user.id, False)
+    await reassign_posts(bot, message.from_user.id)
+    await message.answer("⚪️ <b>Смена закончена.</b> Ваши необработанные посты переданы другим модераторам.")
+
+
+# --- ХЕНДЛЕРЫ ПОИСКА ПО АРХИВУ ---
+
+SEARCH_STATUS_LABELS = {
+    'pending': "⏳ На модерации",
+    'published': "✅ Опубликовано",
+    'rejected': "❌ Отклонено",
+}
+
+
+async def async_get_search_text(query: str, page: int) -> Tuple[str, bool]:
+    """Формирует страницу результатов поиска (Асинхронно)."""
+    started = time.perf_counter()
+    rows, has_next = await async_db_search_ads(query, page)
+    elapsed_ms = (time.perf_counter() - started) * 1000
+
+    if not rows:
+        return f"🔎 По запросу <b>{escape_html(query)}</b> ничего не найдено.", False
+
+    lines = [f"🔎 <b>Поиск:</b> {escape_html(query)} (стр. {page + 1}, {elapsed_ms:.0f} мс)\n"]
+    for row in rows:
+        description = row['description'] or ""
+        if len(description) > 150:
+            description = description[:150] + "…"
+        link = moderation_message_link(row['message_id'])
+        title = f'<a href="{link}">#{row["id"]}</a>' if link else f"#{row['id']}"
+        username = f" (@{escape_html(row['author_username'])})" if row['author_username'] else ""
+        lines.append(
+            f"{title} · {SEARCH_STATUS_LABELS.get(row['status'], row['status'])} · "
+            f"{_to_tz_datetime(row['submitted_at']).strftime('%d.%m.%Y %H:%M')}\n"
+            f"💰 {escape_html(row['price'])}\n"
+            f"{escape_html(description)}\n"
+            f"👤 <code>{row['user_id']}</code>{username}\n"
+        )
+    return "\n".join(lines), has_next
+
+
+async def cmd_search(message: Message, state: FSMContext):
+    if message.from_user.id != SETTINGS.OWNER_ID: return
+
+    parts = message.text.split(maxsplit=1)
+    if len(parts) < 2 or build_fts_query(parts[1]) is None:
+        await message.answer(
+            "❌ <b>Ошибка:</b> Укажите запрос.\n\n"
+            "Формат: <code>/search [слова из описания, цены, контакта или имени автора]</code>"
+        )
+        return
+
+    query = parts[1]
+    await state.update_data(search_query=query)
+    text, has_next = await async_get_search_text(query, 0)
+    await message.answer(text, reply_markup=kb_search_pages(0, has_next), disable_web_page_preview=True)
+
+
+async def callback_search_page(callback: CallbackQuery, state: FSMContext):
+    if callback.from_user.id != SETTINGS.OWNER_ID: return
+
+    query = (await state.get_data()).get('search_query')
+    try:
+        page = max(0, int(callback.data.split(':')[1]))
+    except (IndexError, ValueError):
+        page = 0
+
+    if not query:
+        await callback.answer("Запрос устарел, выполните /search заново.", show_alert=True)
+        return
+
+    await callback.answer()
+    text, has_next = await async_get_search_text(query, page)
+    try:
+        await callback.message.edit_text(text, reply_markup=kb_search_pages(page, has_next),
+                                         disable_web_page_preview=True)
+    except TelegramBadRequest:
+        pass
+
+
+# --- ХЕНДЛЕРЫ ИСТОРИИ ПОЛЬЗОВАТЕЛЯ ---
+
+BAN_ACTION_LABELS = {'ban': "🚫 бан", 'unban': "✅ разбан"}
+
+
+async def async_get_user_text(user_id: int, before_id: Optional[int] = None) -> Tuple[str, Optional[int]]:
+    """Сводка /user и страница подач, старее before_id (Асинхронно). -> (текст, before_id следующей страницы)."""
+    started = time.perf_counter()
+    since = datetime.now(pytz.utc) - timedelta(days=USER_RECENT_DAYS)
+    summary = await async_db_get_user_summary(user_id, since.isoformat())
+    items = await async_db_get_user_submissions(user_id, USER_HISTORY_PAGE_SIZE + 1, before_id)
+    published, rejected = await async_db_get_reputation(user_id)
+    used = await async_db_get_current_limit_count(user_id)
+    next_slot = await async_db_get_next_slot_time(user_id)
+    logging.debug(f"/user {user_id}: data loaded in {(time.perf_counter() - started) * 1000:.1f} ms")
+
+    name = "".join(filter(None, [
+        f" {escape_html(summary['full_name'])}" if summary['full_name'] else None,
+        f" (@{escape_html(summary['username'])})" if summary['username'] else None,
+    ]))
+    lines = [f"👤 <b>Пользователь</b> <code>{user_id}</code>{name}"]
+
+    if await async_db_is_banned(user_id):
+        last_ban = next((entry for entry in summary['bans'] if entry['action'] == 'ban'), None)
+        reason = f": <i>{escape_html(last_ban['reason'])}</i>" if last_ban and last_ban['reason'] else ""
+        lines.append(f"🚫 <b>Забанен</b>{reason}")
+
+    totals = summary['totals']
+    outcomes = summary['recent_outcomes']
+    pending = max(0, totals['submitted'] - totals['published'] - totals['rejected'])
+    lines.append(
+        f"📊 <b>Подач всего:</b> {totals['submitted']} — опубликовано {totals['published']}, "
+        f"отклонено {totals['rejected']}, на модерации {pending}\n"
+        f"🗓 <b>За {USER_RECENT_DAYS} дн.:</b> подач {summary['recent_submissions']}, "
+        f"опубликовано {outcomes.get('published', 0)}, отклонено {outcomes.get('rejected', 0)}\n"
+        f"⭐ <b>Репутация:</b> одобрено модераторами {published}, отклонено {rejected}"
+        f"{' (доверенный автор)' if is_trusted_author(published, rejected) else ''}\n"
+        f"📦 <b>Лимит:</b> {used} из {SETTINGS.MAX_POSTS_PER_DAY} за 24 ч"
+        + (f", следующий слот {format_slot_time(next_slot)}" if used >= SETTINGS.MAX_POSTS_PER_DAY else "")
+    )
+
+    if summary['bans']:
+        lines.append("\n🔨 <b>Баны:</b>")
+        for entry in summary['bans']:
+            moderator = f" (<code>{entry['moderator_id']}</code>)" if entry['moderator_id'] else ""
+            reason = f": {escape_html(entry['reason'])}" if entry['reason'] else ""
+            lines.append(f"{_to_tz_datetime(entry['created_at']).strftime('%d.%m.%Y %H:%M')} "
+                         f"{BAN_ACTION_LABELS.get(entry['action'], entry['action'])}{moderator}{reason}")
+
+    page, has_next = items[:USER_HISTORY_PAGE_SIZE], len(items) > USER_HISTORY_PAGE_SIZE
+    if page:
+        lines.append("\n📝 <b>Подачи</b> (от новых):" if before_id is None else "\n📝 <b>Подачи</b> (продолжение):")
+    else:
+        lines.append("\n📝 Подач нет.")
+    for item in page:
+        description = item['description'] or ""
+        if len(description) > 80:
+            description = description[:80] + "…"
+        link = moderation_message_link(item['message_id'])
+        title = f'<a href="{link}">#{item["id"]}</a>' if link else f"#{item['id']}"
+        lines.append(
+            f"{title} · {SEARCH_STATUS_LABELS.get(item['status'], item['status'])} · "
+            f"{_to_tz_datetime(item['submitted_at']).strftime('%d.%m.%Y %H:%M')} · 💰 {escape_html(item['price'])}\n"
+            f"{escape_html(description)}\n"
+        )
+    return "\n".join(lines), page[-1]['id'] if has_next else None
+
+
+async def cmd_user(message: Message):
+    if message.from_user.id != SETTINGS.OWNER_ID: return
+
+    parts = message.text.split()
+    if len(parts) < 2 or not parts[1].isdigit():
+        await message.answer(
+            "❌ <b>Ошибка:</b> Укажите ID пользователя.\n\n"
+            "Формат: <code>/user [user_id]</code>"
+        )
+        return
+
+    user_id = int(parts[1])
+    text, next_before_id = await async_get_user_text(user_id)
+    await message.answer(text, reply_markup=kb_user_history(user_id, None, next_before_id),
+                         disable_web_page_preview=True)
+
+
+async def callback_user_page(callback: CallbackQuery):
+    if callback.from_user.id != SETTINGS.OWNER_ID: return
+
+    try:
+        parts = callback.data.split(':')
+        user_id = int(parts[1])
+        before_id = int(parts[2]) if len(parts) > 2 else None
+    except (IndexError, ValueError):
+        await callback.answer("❌ Некорректный формат данных.", show_alert=True)
+        return
+
+    await callback.answer()
+    text, next_before_id = await async_get_user_text(user_id, before_id)
+    try:
+        await callback.message.edit_text(text, reply_markup=kb_user_history(user_id, before_id, next_before_id),
+                                         disable_web_page_preview=True)
+    except TelegramBadRequest:
+        pass
+
+
 # --- ХЕНДЛЕРЫ РЕДАКТИРОВАНИЯ ---
 
 async def callback_edit_desc(callback: CallbackQuery, state: FSMContext):
@@ -969,7 +4079,7 @@ async def callback_edit_desc(callback: CallbackQuery, state: FSMContext):
         "Введите новое описание (можно с фото).",
         reply_markup=kb_ad_submission_cancel()
     )
-    await state.update_data(instruction_message_id=instruction_message.message_id)
+    await update_draft_data(state, instruction_message_id=instruction_message.message_id)
 
 
 async def callback_edit_price(callback: CallbackQuery, state: FSMContext):
@@ -982,7 +4092,7 @@ async def callback_edit_price(callback: CallbackQuery, state: FSMContext):
         "Введите новую цену.",
         reply_markup=kb_ad_submission_cancel()
     )
-    await state.update_data(instruction_message_id=instruction_message.message_id)
+    await update_draft_data(state, instruction_message_id=instruction_message.message_id)
 
 
 async def callback_edit_contact(callback: CallbackQuery, state: FSMContext):
@@ -995,7 +4105,7 @@ async def callback_edit_contact(callback: CallbackQuery, state: FSMContext):
         "Введите новый контакт для связи.",
         reply_markup=kb_ad_submission_cancel()
     )
-    await state.update_data(instruction_message_id=instruction_message.message_id)
+    await update_draft_data(state, instruction_message_id=instruction_message.message_id)
 
 
 # --- ХЕНДЛЕРЫ СТАТИСТИКИ ---
@@ -1018,8 +4128,33 @@ async def async_get_stats_text(period: str) -> str:
         f"{header}\n\n"
         f"<b>Опубликовано:</b> {pub_count} ({pub_perc})\n"
         f"<b>Отклонено:</b> {rej_count} ({rej_perc})\n"
-        f"<b>Всего обработано:</b> {total}"
+        f"<b>Всего обработано:</b> {total}\n"
+        f"<b>Пользователей бота:</b> {len(MemoryCache.broadcast_last_seen)}\n"
+        f"<b>Отброшено флуда</b> (с запуска): сообщений {METRICS['throttled_messages']}, "
+        f"нажатий {METRICS['throttled_callbacks']}\n"
+        f"<b>Лаг event loop:</b> p99 {PROCESS_METRICS['loop_lag_p99_ms']} мс, max {PROCESS_METRICS['loop_lag_max_ms']} мс, "
+        f"зависаний с запуска {PROCESS_METRICS['loop_stalls']}\n"
+        f"<b>Доверенных авторов:</b> {sum(is_trusted_author(*counts) for counts in MemoryCache.reputation.values())}; "
+        f"с запуска автопубликаций {METRICS['fast_tracked']}, выборочных проверок {METRICS['reputation_audits']}"
     )
+
+    counts = await async_db_get_latency_histogram(period)
+    p50, p90, p99 = histogram_percentiles(counts, [0.5, 0.9, 0.99])
+    if p50 is not None:
+        stats_text += (
+            f"\n\n⏱️ <b>Время модерации:</b>\n"
+            f"p50 ≈ {format_duration(p50)}, p90 ≈ {format_duration(p90)}, p99 ≈ {format_duration(p99)}"
+        )
+
+    depth, oldest = await async_db_get_queue_state()
+    if oldest:
+        waiting = (datetime.now(TIMEZONE) - oldest).total_seconds()
+        stats_text += f"\n\n📥 <b>Очередь сейчас:</b> {depth}, самый старый пост ждет {format_duration(waiting)}"
+    else:
+        stats_text += "\n\n📥 <b>Очередь сейчас:</b> пусто"
+
+    lanes = ", ".join(f"{lane} {depth}" for lane, depth in OUTBOUND.depths().items())
+    stats_text += f"\n📤 <b>Исходящие в ожидании:</b> {lanes}; RetryAfter с запуска: {METRICS['outbound_retry_after']}"
     return stats_text
 
 
@@ -1077,11 +4212,57 @@ async def callback_stats_back(callback: CallbackQuery, state: FSMContext):
 
 # --- ХЕНДЛЕРЫ МОДЕРАЦИИ ---
 
+async def fast_track_publish(bot: Bot, moderation_message: Message, photo_ids: List[str], body_html: str,
+                             moderation_caption: str, author_id: int, assigned_to: int, reason: str) -> bool:
+    """
+    Публикует только что поданный пост без ручной модерации. Пост уже записан в предложку, поэтому при
+    ошибке до отправки в канал он просто остается в очереди назначенного модератора (возвращает False).
+    """
+    message_id = moderation_message.message_id
+    if not await async_db_claim_pending_post(message_id, SETTINGS.OWNER_ID):
+        return False
+    try:
+        await send_ad_post(bot, SETTINGS.CHANNEL_FINAL_ID, photo_ids, body_html)
+    except Exception as e:
+        logging.error(f"Fast-track publish failed for post {message_id}: {e}")
+        await async_db_release_pending_post(message_id)
+        return False
+
+    METRICS['fast_tracked'] += 1
+    # manual=False: автопубликация — не решение модератора: не наращивает репутацию и не попадает в гистограмму задержек
+    await async_db_add_stat('published', datetime.now(TIMEZONE), message_id, author_id, manual=False)
+    _change_moderator_load(assigned_to, -1)
+    status_text = f"\n\n✅ <b>ОПУБЛИКОВАНО АВТОМАТИЧЕСКИ</b> ({escape_html(reason)})"
+    try:
+        if moderation_message.photo:
+            await moderation_message.edit_caption(caption=moderation_caption + status_text, reply_markup=None)
+        else:
+            await moderation_message.edit_text(text=moderation_caption + status_text, reply_markup=None)
+    except Exception as e:
+        logging.warning(f"Could not update moderation message: {e}")
+
+    await notify_author(bot, author_id,
+                        "🎉 <b>Ваше объявление опубликовано!</b>\n\n"
+                        "Спасибо за ваш вклад в наше сообщество!")
+    await send_log(bot, f"Пост от {author_id} ОПУБЛИКОВАН автоматически ({reason}).")
+    return True
+
+
+async def notify_author(bot: Bot, author_id: int, text: str):
+    """Уведомление автора о решении модерации (полоса notifications: не обгоняет ответы пользователям)."""
+    try:
+        with outbound_lane('notifications'):
+            await bot.send_message(author_id, text)
+    except Exception as e:
+        logging.warning(f"Could not notify author {author_id}: {e}")
+
+
 async def callback_moderation(callback: CallbackQuery, bot: Bot):
     """
     Обработчик кнопок модерации (ОПУБЛИКОВАТЬ/ОТКЛОНИТЬ).
     """
-    if callback.from_user.id != SETTINGS.OWNER_ID:
+    moderator_id = callback.from_user.id
+    if not is_moderator(moderator_id):
         await callback.answer("❌ У вас нет прав на модерацию.", show_alert=True)
         return
 
@@ -1095,10 +4276,9 @@ async def callback_moderation(callback: CallbackQuery, bot: Bot):
     message_id_in_predlozhka = callback.message.message_id
     is_published = action == "mod_pub"
 
-    await callback.answer("⏳ Обработка...")
-
     post_data = await async_db_get_pending_post_data(message_id_in_predlozhka)
     if not post_data:
+        await callback.answer()
         try:
             await callback.message.edit_reply_markup(reply_markup=None)
             await callback.message.reply("❌ Ошибка: данные поста не найдены в БД.")
@@ -1106,10 +4286,23 @@ async def callback_moderation(callback: CallbackQuery, bot: Bot):
             pass
         return
 
-    fetched_author_id, submitted_at = post_data
-    if fetched_author_id != author_id:
-        author_id = fetched_author_id
+    assigned_to = post_data['assigned_to']
+    if (assigned_to not in (None, moderator_id) and moderator_id != SETTINGS.OWNER_ID
+            and not is_assignment_stale(post_data['assigned_at'])):
+        await callback.answer("⏳ Этот пост назначен другому модератору.", show_alert=True)
+        return
+
+    if not await async_db_claim_pending_post(message_id_in_predlozhka, moderator_id):
+        await callback.answer("ℹ️ Пост уже обрабатывается другим модератором.", show_alert=True)
+        return
+
+    await callback.answer("⏳ Обработка...")
+
+    author_id = post_data['user_id']
+    submitted_at = post_data['submitted_at']
+    photo_ids = post_data['photo_ids']
 
+    sent_to_channel = False
     try:
         # Убираем кнопки сразу
         try:
@@ -1117,71 +4310,63 @@ async def callback_moderation(callback: CallbackQuery, bot: Bot):
         except Exception:
             pass
 
-        original_content = callback.message.caption if callback.message.caption else callback.message.text
+        if post_data['body_html'] is not None:
+            final_content = post_data['body_html']
+            moderation_content = build_moderation_caption(final_content, author_id, post_data['author_username'],
+                                                          post_data['mod_notes'])
+        else:
+            # Пост отправлен до миграции 4: восстанавливаем текст из сообщения в предложке
+            original_content = callback.message.caption if callback.message.caption else callback.message.text
+            final_content = escape_html(AUTHOR_SIG_PATTERN.sub('', original_content).strip())
+            moderation_content = escape_html(original_content)
+            if not photo_ids and callback.message.photo:
+                photo_ids = [callback.message.photo[-1].file_id]
 
         if is_published:
-            # ПУБЛИКАЦИЯ
-            final_content = AUTHOR_SIG_PATTERN.sub('', original_content).strip()
-
-            # Отправка в финальный канал
-            if callback.message.photo:
-                await bot.send_photo(
-                    chat_id=SETTINGS.CHANNEL_FINAL_ID,
-                    photo=callback.message.photo[-1].file_id,
-                    caption=final_content,
-                    parse_mode=ParseMode.HTML
-                )
-            else:
-                await bot.send_message(
-                    chat_id=SETTINGS.CHANNEL_FINAL_ID,
-                    text=final_content,
-                    parse_mode=ParseMode.HTML
-                )
+            # ПУБЛИКАЦИЯ: отправляем сохраненный пост как есть (альбом уходит одной группой)
+            await send_ad_post(bot, SETTINGS.CHANNEL_FINAL_ID, photo_ids, final_content)
+            sent_to_channel = True
 
             # Обновление сообщения в предложке
             status_text = "\n\n✅ <b>ОПУБЛИКОВАНО</b>"
 
             # Уведомление автора и статистика
-            try:
-                await bot.send_message(
-                    author_id,
-                    "🎉 <b>Ваше объявление опубликовано!</b>\n\n"
-                    "Спасибо за ваш вклад в наше сообщество!"
-                )
-            except Exception as e:
-                logging.warning(f"Could not notify author {author_id}: {e}")
+            await notify_author(
+                bot, author_id,
+                "🎉 <b>Ваше объявление опубликовано!</b>\n\n"
+                "Спасибо за ваш вклад в наше сообщество!"
+            )
 
-            await async_db_add_stat('published', submitted_at, message_id_in_predlozhka)
-            await send_log(bot, f"Пост от {author_id} ОПУБЛИКОВАН.")
+            await async_db_add_stat('published', submitted_at, message_id_in_predlozhka, author_id)
+            _change_moderator_load(assigned_to, -1)
+            await send_log(bot, f"Пост от {author_id} ОПУБЛИКОВАН (модератор {moderator_id}).")
 
         else:
             # ОТКЛОНЕНИЕ
             status_text = "\n\n❌ <b>ОТКЛОНЕНО</b>"
 
             # Откат лимита и уведомление автора
-            await async_db_decrement_limit(author_id)
-            try:
-                await bot.send_message(
-                    author_id,
-                    "❌ <b>Ваше объявление отклонено.</b>\n\n"
-                    "Пожалуйста, ознакомьтесь с правилами и попробуйте снова."
-                )
-            except Exception as e:
-                logging.warning(f"Could not notify author {author_id}: {e}")
+            await async_db_decrement_limit(author_id, submitted_at)
+            await notify_author(
+                bot, author_id,
+                "❌ <b>Ваше объявление отклонено.</b>\n\n"
+                "Пожалуйста, ознакомьтесь с правилами и попробуйте снова."
+            )
 
-            await async_db_add_stat('rejected', submitted_at, message_id_in_predlozhka)
-            await send_log(bot, f"Пост от {author_id} ОТКЛОНЕН.")
+            await async_db_add_stat('rejected', submitted_at, message_id_in_predlozhka, author_id)
+            _change_moderator_load(assigned_to, -1)
+            await send_log(bot, f"Пост от {author_id} ОТКЛОНЕН (модератор {moderator_id}).")
 
         # Финальное обновление сообщения в предложке
         try:
             if callback.message.photo:
                 await callback.message.edit_caption(
-                    caption=original_content + status_text,
+                    caption=moderation_content + status_text,
                     reply_markup=None
                 )
             else:
                 await callback.message.edit_text(
-                    text=original_content + status_text,
+                    text=moderation_content + status_text,
                     reply_markup=None
                 )
         except Exception as e:
@@ -1192,12 +4377,232 @@ async def callback_moderation(callback: CallbackQuery, bot: Bot):
         try:
             # Откатываем лимит на случай ошибки после публикации, но до статистики
             if not is_published and author_id:
-                await async_db_decrement_limit(author_id)
+                await async_db_decrement_limit(author_id, submitted_at)
+
+            # Пока пост не ушел в канал, его можно обработать повторно: снимаем захват и возвращаем кнопки
+            if not sent_to_channel:
+                await async_db_release_pending_post(message_id_in_predlozhka)
+                await callback.message.edit_reply_markup(reply_markup=kb_moderation_main(author_id))
 
             await callback.message.reply(f"❌ Ошибка при обработке: {e}")
         except Exception:
             pass
 
+# --- HTTP API (ТОЛЬКО ЧТЕНИЕ) ---
+# Включается, если задан SETTINGS.API_TOKEN. Доступ: заголовок "Authorization: Bearer <token>" или ?token=<token>.
+# При нескольких тенантах тенант выбирается ?tenant=<name> или заголовком X-Tenant, токен у каждого свой.
+# JSON-ответы кэшируются на API_CACHE_TTL секунд и отдаются с ETag, чтобы частый опрос дашбордов не ходил в SQLite.
+# CSV-выгрузки читаются из курсора порциями и пишутся в StreamResponse — память не зависит от числа строк.
+
+CSV_CHUNK_ROWS = 1000
+
+
+class ResponseCache:
+    """Кэш готовых JSON-ответов: ключ -> (истекает_в, etag, тело). Один пересчет на ключ при одновременных промахах."""
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._entries: Dict[str, Tuple[float, str, bytes]] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+
+    async def get(self, key: str, producer: Callable[[], Awaitable[Any]]) -> Tuple[str, bytes]:
+        entry = self._entries.get(key)
+        if entry and entry[0] > time.monotonic():
+            return entry[1], entry[2]
+
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > time.monotonic():
+                return entry[1], entry[2]
+            body = json.dumps(await producer(), ensure_ascii=False).encode('utf-8')
+            etag = f'"{hashlib.blake2b(body, digest_size=8).hexdigest()}"'
+            self._entries[key] = (time.monotonic() + self.ttl, etag, body)
+            self._evict_expired()
+            return etag, body
+
+    def _evict_expired(self):
+        now = time.monotonic()
+        for key in [key for key, entry in self._entries.items() if entry[0] <= now]:
+            del self._entries[key]
+            self._locks.pop(key, None)
+
+
+API_CACHE = TenantLocal(lambda: ResponseCache(SETTINGS.API_CACHE_TTL))
+
+
+def api_token_is_valid(request: web.Request) -> bool:
+    """Проверяет токен API из заголовка Authorization или параметра token."""
+    if not SETTINGS.API_TOKEN:
+        return False
+    header = request.headers.get('Authorization', '')
+    token = header[7:] if header.startswith('Bearer ') else request.query.get('token', '')
+    return hmac.compare_digest(token.encode(), SETTINGS.API_TOKEN.encode())
+
+
+@web.middleware
+async def api_tenant_middleware(request: web.Request, handler):
+    """Несколько тенантов: запрос к API выполняется в контексте тенанта из ?tenant= или заголовка X-Tenant."""
+    if not request.path.startswith('/api/') or len(TENANTS) <= 1:
+        return await handler(request)
+    tenant = TENANTS.get(request.query.get('tenant') or request.headers.get('X-Tenant', ''))
+    if tenant is None:
+        return web.json_response({'error': 'unknown tenant'}, status=404)
+    with tenant_scope(tenant):
+        return await handler(request)
+
+
+@web.middleware
+async def api_auth_middleware(request: web.Request, handler):
+    if request.path.startswith('/api/') and not api_token_is_valid(request):
+        return web.json_response({'error': 'unauthorized'}, status=401)
+    return await handler(request)
+
+
+async def cached_json_response(request: web.Request, key: str, producer: Callable[[], Awaitable[Any]]):
+    """JSON-ответ из API_CACHE с поддержкой If-None-Match (304)."""
+    etag, body = await API_CACHE.get(key, producer)
+    headers = {'ETag': etag, 'Cache-Control': f'max-age={int(API_CACHE.ttl)}'}
+    if request.headers.get('If-None-Match') == etag:
+        return web.Response(status=304, headers=headers)
+    return web.Response(body=body, content_type='application/json', headers=headers)
+
+
+async def stream_csv_response(request: web.Request, filename: str, header: List[str], query: str,
+                              params: Tuple = ()) -> web.StreamResponse:
+    """Пишет результат запроса в CSV порциями по CSV_CHUNK_ROWS строк."""
+    response = web.StreamResponse(headers={
+        'Content-Type': 'text/csv; charset=utf-8',
+        'Content-Disposition': f'attachment; filename="{filename}"',
+    })
+    await response.prepare(request)
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(header)
+
+    # Клиент может читать медленно: запрос идет через отдельное подключение, чтобы не занимать общее
+    # и не подхватывать строки, записанные во время выгрузки
+    async with DatabaseManager.read_only_connection() as db, db.execute(query, params) as cursor:
+        while True:
+            rows = await cursor.fetchmany(CSV_CHUNK_ROWS)
+            if not rows:
+                break
+            writer.writerows(tuple(row) for row in rows)
+            await response.write(buffer.getvalue().encode('utf-8'))
+            buffer.seek(0)
+            buffer.truncate(0)
+
+    if buffer.tell():
+        await response.write(buffer.getvalue().encode('utf-8'))
+    await response.write_eof()
+    return response
+
+
+async def api_stats(request: web.Request):
+    """GET /api/stats?period=today|all — счетчики модерации и перцентили времени модерации."""
+    period = 'today' if request.query.get('period') == 'today' else 'all'
+
+    async def producer():
+        pub_count, rej_count = await async_db_get_stats_counts(period)
+        counts = await async_db_get_latency_histogram(period)
+        p50, p90, p99 = histogram_percentiles(counts, [0.5, 0.9, 0.99])
+        return {
+            'period': period,
+            'published': pub_count,
+            'rejected': rej_count,
+            'latency_seconds': {'p50': p50, 'p90': p90, 'p99': p99},
+            'latency_histogram': {'bounds': LATENCY_BUCKETS, 'counts': counts},
+        }
+
+    return await cached_json_response(request, f'stats:{period}', producer)
+
+
+async def api_queue(request: web.Request):
+    """GET /api/queue — очередь предложки и нагрузка модераторов."""
+
+    async def producer():
+        depth, oldest = await async_db_get_queue_state()
+        return {
+            'depth': depth,
+            'oldest_submitted_at': oldest.isoformat() if oldest else None,
+            'oldest_wait_seconds': (datetime.now(TIMEZONE) - oldest).total_seconds() if oldest else None,
+            'moderators_online': sorted(MemoryCache.online_moderators),
+            'moderator_load': {str(k): v for k, v in MemoryCache.moderator_load.items()},
+            'tenant': CURRENT_TENANT.get().name,
+            'metrics': {**PROCESS_METRICS, **METRICS},
+            'outbound_lanes': OUTBOUND.depths(),
+        }
+
+    return await cached_json_response(request, 'queue', producer)
+
+
+async def api_user_history(request: web.Request):
+    """GET /api/users/{user_id}/history?limit=&before_id= — подачи пользователя, от новых к старым."""
+    try:
+        user_id = int(request.match_info['user_id'])
+        limit = min(max(int(request.query.get('limit', 20)), 1), 100)
+        before_id = int(request.query['before_id']) if 'before_id' in request.query else None
+    except ValueError:
+        return web.json_response({'error': 'bad request'}, status=400)
+
+    async def producer():
+        items = await async_db_get_user_submissions(user_id, limit, before_id)
+        return {
+            'user_id': user_id,
+            'banned': await async_db_is_banned(user_id),
+            'items': items,
+            'next_before_id': items[-1]['id'] if len(items) == limit else None,
+        }
+
+    return await cached_json_response(request, f'user:{user_id}:{limit}:{before_id}', producer)
+
+
+async def api_export_stats(request: web.Request):
+    """GET /api/export/stats.csv — все события модерации."""
+    return await stream_csv_response(
+        request, 'stats.csv',
+        ['id', 'event_type', 'created_at', 'moderated_at', 'moderated_date_str', 'user_id'],
+        "SELECT id, event_type, created_at, moderated_at, moderated_date_str, user_id FROM stats ORDER BY id"
+    )
+
+
+async def api_export_submissions(request: web.Request):
+    """GET /api/export/submissions.csv — архив поданных объявлений."""
+    columns = ['id', 'message_id', 'user_id', 'author_username', 'author_full_name', 'description', 'price',
+               'contact', 'status', 'submitted_at', 'moderated_at']
+    return await stream_csv_response(
+        request, 'submissions.csv', columns,
+        f"SELECT {', '.join(columns)} FROM ads_archive ORDER BY id"
+    )
+
+
+async def api_profile(request: web.Request):
+    """GET /api/profile?seconds= — прогон профилировщика, ответ — zip с отчетом (запрос держится seconds секунд)."""
+    seconds = parse_profile_seconds(request.query.get('seconds'))
+    if seconds is None:
+        return web.json_response({'error': 'bad request'}, status=400)
+    try:
+        archive, _ = await Profiler.run(seconds)
+    except ProfileBusyError:
+        return web.json_response({'error': 'profiling already in progress'}, status=409)
+    filename = f"profile_{datetime.now(TIMEZONE).strftime('%Y%m%d_%H%M%S')}.zip"
+    return web.Response(body=archive, content_type='application/zip',
+                        headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
+
+def setup_api_routes(app: web.Application):
+    """Регистрирует HTTP API на веб-сервере бота (токен проверяется уже в контексте тенанта)."""
+    app.middlewares.append(api_tenant_middleware)
+    app.middlewares.append(api_auth_middleware)
+    app.router.add_get("/api/stats", api_stats)
+    app.router.add_get("/api/queue", api_queue)
+    app.router.add_get("/api/users/{user_id}/history", api_user_history)
+    app.router.add_get("/api/export/stats.csv", api_export_stats)
+    app.router.add_get("/api/export/submissions.csv", api_export_submissions)
+    app.router.add_get("/api/profile", api_profile)
+
+
 # --- ГЛАВНАЯ ФУНКЦИЯ ---
 
 # Определяем простой обработчик для Web-сервера
@@ -1207,17 +4612,51 @@ async def render_health_check(request):
 
 
 async def bot_start(dp: Dispatcher, bot: Bot):
-    """Задача для запуска самого бота (Polling)."""
+    """Задача для запуска самого бота (Polling). Выполняется в контексте своего тенанта."""
+    started = time.perf_counter()
     await DatabaseManager.init_db()
+    db_ready = time.perf_counter()
     logging.info("🤖 База данных инициализирована.")
-    await dp.start_polling(bot)
 
+    await MemoryCache.warm_up()
+    warmed = time.perf_counter()
+    logging.info(
+        f"🔥 Кэш прогрет: банов {len(MemoryCache.banned_ids)}, окон подач {len(MemoryCache.submission_windows)}, "
+        f"получателей рассылки {len(MemoryCache.broadcast_last_seen)}."
+    )
+    logging.info(
+        f"⏱️ Холодный старт: {(warmed - started) * 1000:.1f} мс "
+        f"(БД {(db_ready - started) * 1000:.1f} мс, прогрев кэша {(warmed - db_ready) * 1000:.1f} мс)."
+    )
+    try:
+        logging.info(f"🧹 Правил фильтра объявлений: {ContentPrefilter.load(SETTINGS.CONTENT_RULES_PATH)}.")
+    except (OSError, ValueError) as e:
+        logging.error(f"Content rules not loaded, prefilter disabled: {e}")
+    # Ссылки на фоновые задачи держим до конца polling, иначе их может собрать GC
+    background_tasks = [
+        asyncio.create_task(broadcast_flush_loop()),
+        asyncio.create_task(moderation_reassign_loop(bot)),
+    ]
+    if SETTINGS.BACKUP_INTERVAL > 0:
+        background_tasks.append(asyncio.create_task(backup_loop(bot)))
+    try:
+        # Сигналы остановки обрабатывает main() — один обработчик на всех тенантов
+        await dp.start_polling(bot, handle_signals=False)
+    finally:
+        for task in background_tasks:
+            task.cancel()
 
-async def main():
-    default_props = DefaultBotProperties(parse_mode=ParseMode.HTML)
-    bot = Bot(SETTINGS.BOT_TOKEN, default=default_props)
+
+def build_dispatcher() -> Dispatcher:
+    """Создает Dispatcher со всеми middleware и хендлерами бота (используется и в replay.py)."""
     dp = Dispatcher()
 
+    # Антифлуд: отдельные лимиты для сообщений и нажатий кнопок
+    dp.message.outer_middleware(ThrottlingMiddleware(
+        'messages', TokenBucketLimiter(SETTINGS.THROTTLE_MESSAGES_RATE, SETTINGS.THROTTLE_MESSAGES_BURST)))
+    dp.callback_query.outer_middleware(ThrottlingMiddleware(
+        'callbacks', TokenBucketLimiter(SETTINGS.THROTTLE_CALLBACKS_RATE, SETTINGS.THROTTLE_CALLBACKS_BURST)))
+
     # --- РЕГИСТРАЦИЯ ХЕНДЛЕРОВ ---
 
     # Основные команды и отмена
@@ -1232,6 +4671,26 @@ async def main():
                         F.chat.type.in_({ChatType.PRIVATE}))
     dp.message.register(cmd_ban, Command("ban"), F.from_user.id == SETTINGS.OWNER_ID)
     dp.message.register(cmd_unban, Command("unban"), F.from_user.id == SETTINGS.OWNER_ID)
+    dp.message.register(cmd_banlist, Command("banlist"), F.from_user.id == SETTINGS.OWNER_ID)
+    dp.message.register(cmd_rules_reload, Command("rules_reload"), F.from_user.id == SETTINGS.OWNER_ID)
+    dp.message.register(cmd_backup, Command("backup"), F.from_user.id == SETTINGS.OWNER_ID,
+                        F.chat.type.in_({ChatType.PRIVATE}))
+    dp.message.register(cmd_restore, Command("restore"), F.from_user.id == SETTINGS.OWNER_ID,
+                        F.chat.type.in_({ChatType.PRIVATE}))
+    dp.message.register(cmd_unbanlist, Command("unbanlist"), F.from_user.id == SETTINGS.OWNER_ID)
+    dp.message.register(cmd_mod_add, Command("mod_add"), F.from_user.id == SETTINGS.OWNER_ID)
+    dp.message.register(cmd_mod_del, Command("mod_del"), F.from_user.id == SETTINGS.OWNER_ID)
+    dp.message.register(cmd_mods, Command("mods"), F.from_user.id == SETTINGS.OWNER_ID)
+    dp.message.register(cmd_profile, Command("profile"), F.from_user.id == SETTINGS.OWNER_ID,
+                        F.chat.type.in_({ChatType.PRIVATE}))
+    dp.message.register(cmd_search, Command("search"), F.from_user.id == SETTINGS.OWNER_ID,
+                        F.chat.type.in_({ChatType.PRIVATE}))
+    dp.callback_query.register(callback_search_page, F.data.startswith("search:"), F.from_user.id == SETTINGS.OWNER_ID,
+                               F.message.chat.type.in_({ChatType.PRIVATE}))
+    dp.message.register(cmd_user, Command("user"), F.from_user.id == SETTINGS.OWNER_ID,
+                        F.chat.type.in_({ChatType.PRIVATE}))
+    dp.callback_query.register(callback_user_page, F.data.startswith("user:"), F.from_user.id == SETTINGS.OWNER_ID,
+                               F.message.chat.type.in_({ChatType.PRIVATE}))
 
     # Хендлеры рассылки
     dp.message.register(cmd_broadcast, Command("broadcast"), F.from_user.id == SETTINGS.OWNER_ID,
@@ -1245,7 +4704,7 @@ async def main():
 
     # Шаги FSM: Подача
     dp.message.register(process_item_description, StateFilter(AdSubmission.waiting_for_item_desc),
-                        F.chat.type.in_({ChatType.PRIVATE}), F.caption | F.text)
+                        F.chat.type.in_({ChatType.PRIVATE}), F.caption | F.text | F.media_group_id)
     dp.message.register(process_price, StateFilter(AdSubmission.waiting_for_price), F.chat.type.in_({ChatType.PRIVATE}),
                         F.text)
     dp.message.register(process_contact, StateFilter(AdSubmission.waiting_for_contact),
@@ -1256,7 +4715,7 @@ async def main():
     dp.message.register(process_single_edit,
                         StateFilter(AdSubmission.waiting_for_edit_desc, AdSubmission.waiting_for_edit_price,
                                     AdSubmission.waiting_for_edit_contact),
-                        F.chat.type.in_({ChatType.PRIVATE}), F.text | F.caption)
+                        F.chat.type.in_({ChatType.PRIVATE}), F.text | F.caption | F.media_group_id)
 
     # Callbacks
     dp.callback_query.register(callback_start_submit, F.data == "start_submit",
@@ -1287,46 +4746,109 @@ async def main():
     dp.callback_query.register(callback_stats_show_menu, F.data == "stats_show_menu",
                                F.from_user.id == SETTINGS.OWNER_ID, F.message.chat.type.in_({ChatType.PRIVATE}))
 
-    # Хендлер модерации
-    dp.callback_query.register(callback_moderation, F.data.startswith("mod_"), F.from_user.id == SETTINGS.OWNER_ID)
+    # Хендлеры модерации (права проверяются внутри: пул модераторов меняется на лету)
+    dp.message.register(cmd_online, Command("online"), F.chat.type.in_({ChatType.PRIVATE}))
+    dp.message.register(cmd_offline, Command("offline"), F.chat.type.in_({ChatType.PRIVATE}))
+    dp.callback_query.register(callback_moderation, F.data.startswith("mod_"))
+
+    return dp
+
+
+async def run_tenant(tenant: Tenant, dp: Dispatcher):
+    """Polling тенанта; его падение (например, отозванный токен) не останавливает остальных."""
+    try:
+        await bot_start(dp, tenant.bot)
+    except Exception as e:
+        logging.error(f"Tenant {tenant.name} stopped: {e}")
+        if len(TENANTS) == 1:
+            raise
+
 
-    # --- ЗАПУСК БОТА И WEB-СЕРВЕРА ---
+def stop_on_signals(task: asyncio.Task):
+    """SIGINT/SIGTERM отменяют task (main): polling всех тенантов останавливается, затем выполняется очистка."""
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        with suppress(NotImplementedError):  # Windows
+            loop.add_signal_handler(sig, task.cancel)
+
+
+async def main():
+    tenants = load_tenants(SETTINGS.TENANTS_PATH) if SETTINGS.TENANTS_PATH else [DEFAULT_TENANT]
+    TENANTS.update((tenant.name, tenant) for tenant in tenants)
+    default_props = DefaultBotProperties(parse_mode=ParseMode.HTML)
+    logging.info(f"⚡ Режим выполнения: {describe_runtime(SETTINGS.FAST_RUNTIME)}.")
+
+    # --- ЗАПУСК БОТОВ И WEB-СЕРВЕРА ---
+
+    # 1. Запускаем polling каждого тенанта в фоновом режиме; задача наследует контекст тенанта
+    tenant_tasks = []
+    for tenant in tenants:
+        with tenant_scope(tenant):
+            tenant.bot = Bot(SETTINGS.BOT_TOKEN, session=create_bot_session(SETTINGS.FAST_RUNTIME),
+                             default=default_props)
+            dp = build_dispatcher()
+            if SETTINGS.RECORD_UPDATES_PATH:
+                tenant.recorder = UpdateRecorder(SETTINGS.RECORD_UPDATES_PATH, SETTINGS.RECORD_MAX_BYTES,
+                                                 SETTINGS.RECORD_BACKUPS)
+                dp.update.outer_middleware(tenant.recorder)
+                logging.info(f"📼 Запись апдейтов включена: {SETTINGS.RECORD_UPDATES_PATH}")
+            tenant_tasks.append(asyncio.create_task(run_tenant(tenant, dp), name=f"tenant:{tenant.name}"))
+    if len(tenants) > 1:
+        logging.info(f"🏢 Тенантов в процессе: {len(tenants)} ({', '.join(TENANTS)}).")
+
+    # Event loop один на всех — и мониторинг тоже; о зависаниях сообщается в лог-канал первого тенанта
+    with tenant_scope(tenants[0]):
+        loop_monitor = asyncio.create_task(
+            LoopMonitor(SETTINGS.LOOP_LAG_INTERVAL, SETTINGS.LOOP_STALL_THRESHOLD).run(tenants[0].bot))
+    stop_on_signals(asyncio.current_task())
 
-    # 1. Запускаем polling бота в фоновом режиме
-    bot_task = asyncio.create_task(bot_start(dp, bot))
-    
     # 2. Создаем и запускаем Web-сервер-заглушку
     app = web.Application()
     app.router.add_get("/", render_health_check)
-    
+    if any(tenant.settings.API_TOKEN for tenant in tenants):
+        setup_api_routes(app)
+        logging.info("🔌 HTTP API включено (/api/...).")
+
     runner = web.AppRunner(app)
     await runner.setup()
-    
+
     # Render предоставляет порт через переменную окружения PORT, если не указано, берем из config.py
     port = int(os.environ.get('PORT', RENDER_PORT))
-    
+
     site = web.TCPSite(runner, '0.0.0.0', port)
 
     logging.info(f"🤖 Бот запущен (Polling).")
     logging.info(f"🌐 Запуск Web-сервера для Render на 0.0.0.0:{port}")
-    
+
     try:
         # Запускаем Web-сервер
         await site.start()
-        # Ожидаем завершения задачи бота (которая не должна завершиться)
-        await bot_task 
+        # Ожидаем завершения задач ботов (которые не должны завершиться)
+        await asyncio.gather(*tenant_tasks)
     except asyncio.CancelledError:
         logging.info("🤖 Бот остановлен.")
     finally:
-        await DatabaseManager.close_connection()
+        loop_monitor.cancel()
+        for task in tenant_tasks:
+            task.cancel()
+        await asyncio.gather(*tenant_tasks, return_exceptions=True)
+        for tenant in tenants:
+            with tenant_scope(tenant):
+                await DELETIONS.flush_all(tenant.bot)
+                if tenant.recorder:
+                    await tenant.recorder.close()
+                await async_db_flush_broadcast_users()
+                await DatabaseManager.close_connection()
+                await tenant.bot.session.close()
         # Закрываем Web-сервер и runner
         await runner.cleanup()
 
 
 if __name__ == "__main__":
     try:
-        # Используем loop.run_until_complete для запуска асинхронной main
-        asyncio.run(main())
+        # В быстром режиме цикл событий создает uvloop
+        with asyncio.Runner(loop_factory=event_loop_factory(SETTINGS.FAST_RUNTIME)) as runner:
+            runner.run(main())
     except KeyboardInterrupt:
         logging.info("🛑 Бот остановлен.")
     except Exception as e:
@@ -1,5 +1,6 @@
 # config.py
 
+from contextvars import ContextVar
 from pydantic import BaseModel
 from typing import Union
 
@@ -17,7 +18,91 @@ class Config(BaseModel):
     TIMEZONE_NAME: str = "Europe/Moscow"
     DB_NAME: str = "bot_data.db"
     LOG_FILE: str = "bot_log.log"
+    # Сколько секунд ждать остальные части альбома (media group) после последней пришедшей
+    MEDIA_GROUP_DEBOUNCE: float = 1.0
+    # Минимальное оценочное сходство (0..1) текста с прошлым объявлением, чтобы пометить пост как возможный дубликат
+    DUPLICATE_THRESHOLD: float = 0.6
+    # Максимальное расстояние Хэмминга (из 64 бит) между pHash фото, при котором фото считается похожим
+    PHOTO_HASH_DISTANCE: int = 10
+    # Антифлуд: сколько апдейтов в секунду в среднем и сколько подряд (burst) разрешено одному пользователю
+    THROTTLE_MESSAGES_RATE: float = 1.0
+    THROTTLE_MESSAGES_BURST: int = 5
+    THROTTLE_CALLBACKS_RATE: float = 2.0
+    THROTTLE_CALLBACKS_BURST: int = 8
+    # Новые пользователи рассылки пишутся в БД пачками: по размеру пачки или раз в интервал (сек)
+    BROADCAST_FLUSH_BATCH: int = 200
+    BROADCAST_FLUSH_INTERVAL: float = 30.0
+    # Через сколько секунд необработанный пост переназначается другому модератору на смене
+    MODERATION_ASSIGN_TIMEOUT: int = 900
+    # Токен HTTP API (/api/...). Пустая строка — API выключено. Задавайте через os.environ в реальном проекте
+    API_TOKEN: str = ""
+    # Сколько секунд JSON-ответы API отдаются из кэша
+    API_CACHE_TTL: float = 15.0
+    # Запись входящих апдейтов для replay.py (обезличенный JSONL в gzip). Пустая строка — запись выключена
+    RECORD_UPDATES_PATH: str = ""
+    RECORD_MAX_BYTES: int = 50 * 1024 * 1024
+    RECORD_BACKUPS: int = 5
+    # Профилирование по запросу (/profile, /api/profile): длительность по умолчанию и максимум (сек),
+    # период сэмплирования стека loop и точек ожидания задач (сек)
+    PROFILE_DEFAULT_SECONDS: int = 30
+    PROFILE_MAX_SECONDS: int = 300
+    PROFILE_SAMPLE_INTERVAL: float = 0.005
+    PROFILE_AWAIT_INTERVAL: float = 0.25
+    # Мониторинг event loop: период замера лага, порог зависания, период сводок и пауза между алертами (сек)
+    LOOP_LAG_INTERVAL: float = 0.5
+    LOOP_STALL_THRESHOLD: float = 0.5
+    LOOP_REPORT_INTERVAL: float = 300.0
+    LOOP_ALERT_COOLDOWN: float = 900.0
+    # Через сколько секунд удалять накопленные служебные сообщения чата одним запросом deleteMessages
+    DELETE_BATCH_DELAY: float = 1.0
+    # Планировщик исходящих запросов: общий бюджет бота (запросов/сек и запас) и бюджет сообщений на чат —
+    # личный (Telegram: ~1 сообщение в секунду) и группу/канал (Telegram: ~20 сообщений в минуту)
+    OUTBOUND_GLOBAL_RATE: float = 25.0
+    OUTBOUND_GLOBAL_BURST: int = 25
+    OUTBOUND_PRIVATE_RATE: float = 1.0
+    OUTBOUND_PRIVATE_BURST: int = 3
+    OUTBOUND_GROUP_RATE: float = 20 / 60
+    OUTBOUND_GROUP_BURST: int = 10
+    # Сколько сообщений рассылки держать в полете одновременно (темп задает планировщик)
+    BROADCAST_CONCURRENCY: int = 20
+    # Правила префильтра объявлений (JSON, формат — content_rules.example.json). Нет файла — фильтр выключен
+    CONTENT_RULES_PATH: str = "content_rules.json"
+    # Репутация авторов по решениям модераторов: не меньше REPUTATION_MIN_PUBLISHED одобренных постов (0 — выключено)
+    # и доля отклоненных не выше REPUTATION_MAX_REJECT_RATE — публикация без очереди; доля REPUTATION_AUDIT_RATE
+    # постов таких авторов все равно идет модераторам на выборочную проверку
+    REPUTATION_MIN_PUBLISHED: int = 20
+    REPUTATION_MAX_REJECT_RATE: float = 0.05
+    REPUTATION_AUDIT_RATE: float = 0.1
+    # Быстрый режим: uvloop вместо стандартного цикла asyncio и orjson для JSON сессии Bot API.
+    # Если пакеты не установлены, бот работает в стандартном режиме
+    FAST_RUNTIME: bool = False
+    # Резервные копии БД (online backup API SQLite): каталог, период (сек, 0 — только по /backup) и сколько копий хранить;
+    # копирование идет шагами по BACKUP_PAGES_PER_STEP страниц с паузой BACKUP_STEP_SLEEP (сек) между шагами
+    BACKUP_DIR: str = "backups"
+    BACKUP_INTERVAL: float = 6 * 60 * 60
+    BACKUP_KEEP: int = 14
+    BACKUP_PAGES_PER_STEP: int = 64
+    BACKUP_STEP_SLEEP: float = 0.005
+    BACKUP_MAX_SECONDS: float = 600.0
+    # Реестр тенантов (JSON, формат — tenants.example.json): несколько ботов/каналов в одном процессе.
+    # Пустая строка — один бот с настройками выше
+    TENANTS_PATH: str = ""
 
-SETTINGS = Config()
+BASE_SETTINGS = Config()
+# Настройки тенанта, в контексте которого выполняется код (см. bot.tenant_scope); вне тенанта — BASE_SETTINGS
+CURRENT_SETTINGS: ContextVar[Config] = ContextVar('current_settings', default=BASE_SETTINGS)
+
+
+class SettingsProxy:
+    """SETTINGS.X — поле настроек текущего тенанта, поэтому остальной код о тенантах не знает."""
+
+    def __getattr__(self, name: str):
+        return getattr(CURRENT_SETTINGS.get(), name)
+
+    def __setattr__(self, name: str, value):
+        setattr(CURRENT_SETTINGS.get(), name, value)
+
+
+SETTINGS = SettingsProxy()
 # В Render переменная окружения PORT будет автоматически предоставлена.
 RENDER_PORT = 8080 # Вы можете использовать любой порт, например 8080.
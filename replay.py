@@ -0,0 +1,269 @@
+# replay.py
+# Воспроизведение записанных апдейтов (см. SETTINGS.RECORD_UPDATES_PATH) через Dispatcher бота
+# против локального фейкового Bot API — для сравнения задержек и пропускной способности двух сборок.
+#
+#   python replay.py run updates.jsonl.gz [updates.jsonl.gz.1 ...] --speed 1 --report before.json
+#   python replay.py run updates.jsonl.gz --speed 0 --report after.json      # без пауз, максимально быстро
+#   python replay.py compare before.json after.json
+
+import argparse
+import asyncio
+import gzip
+import json
+import os
+import tempfile
+import time
+from collections import Counter, defaultdict
+from typing import Any, Dict, List, Optional
+
+from aiohttp import web
+from aiogram import Bot
+from aiogram.client.default import DefaultBotProperties
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.enums import ParseMode
+from aiogram.types import Update
+
+from config import SETTINGS
+
+import bot as bot_module
+
+
+REPLAY_BOT_TOKEN = "123456:REPLAY"
+REPLAY_BOT_ID = 123456
+
+
+# --- ФЕЙКОВЫЙ BOT API ---
+
+class FakeBotAPI:
+    """
+    Минимальный Bot API: отвечает на любой метод правдоподобным результатом и считает вызовы.
+    latency — искусственная задержка ответа (сек), чтобы приблизить сетевые условия к боевым.
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls: Counter = Counter()
+        self._message_id = 1_000_000
+        self.app = web.Application(client_max_size=64 * 1024 * 1024)
+        self.app.router.add_post("/bot{token}/{method}", self.handle)
+
+    def _message(self, chat_id: Any) -> Dict[str, Any]:
+        self._message_id += 1
+        try:
+            chat_id = int(chat_id)
+        except (TypeError, ValueError):
+            chat_id = -1
+        return {
+            'message_id': self._message_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private' if chat_id > 0 else 'channel'},
+            'text': "",
+        }
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info['method'].lower()
+        self.calls[method] += 1
+        if request.content_type == 'application/json':
+            params = await request.json()
+        else:
+            params = dict(await request.post())
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        chat_id = params.get('chat_id')
+        if method == 'getme':
+            result: Any = {'id': REPLAY_BOT_ID, 'is_bot': True, 'first_name': "Replay", 'username': "replay_bot"}
+        elif method == 'sendmediagroup':
+            media = params.get('media')
+            media = json.loads(media) if isinstance(media, str) else media or []
+            result = [self._message(chat_id) for _ in media]
+        elif method == 'copymessage':
+            result = {'message_id': self._message(chat_id)['message_id']}
+        elif method.startswith('send') or method in ('editmessagetext', 'editmessagecaption', 'editmessagemedia'):
+            result = self._message(chat_id)
+        else:
+            result = True
+        return web.json_response({'ok': True, 'result': result})
+
+
+# --- ВОСПРОИЗВЕДЕНИЕ ---
+
+def load_records(paths: List[str]) -> List[Dict[str, Any]]:
+    records = []
+    for path in paths:
+        opener = gzip.open if path.endswith('.gz') or '.gz.' in path else open
+        with opener(path, 'rt', encoding='utf-8') as f:
+            records.extend(json.loads(line) for line in f if line.strip())
+    records.sort(key=lambda record: record['t'])
+    return records
+
+
+def update_kind(payload: Dict[str, Any]) -> str:
+    return next((key for key in payload if key != 'update_id'), 'unknown')
+
+
+def percentile(samples: List[float], q: float) -> Optional[float]:
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def latency_summary(samples: List[float]) -> Dict[str, Optional[float]]:
+    to_ms = lambda value: None if value is None else round(value * 1000, 3)
+    return {
+        'count': len(samples),
+        'mean': to_ms(sum(samples) / len(samples)) if samples else None,
+        'p50': to_ms(percentile(samples, 0.5)),
+        'p90': to_ms(percentile(samples, 0.9)),
+        'p99': to_ms(percentile(samples, 0.99)),
+        'max': to_ms(max(samples)) if samples else None,
+    }
+
+
+async def run_replay(args) -> Dict[str, Any]:
+    records = load_records(args.logs)
+    if not records:
+        raise SystemExit("Нет апдейтов для воспроизведения.")
+
+    tmp = tempfile.TemporaryDirectory()
+    SETTINGS.DB_NAME = os.path.join(tmp.name, "replay.db")
+    SETTINGS.OWNER_ID = bot_module.REPLAY_OWNER_ID
+    if args.no_throttle:
+        SETTINGS.THROTTLE_MESSAGES_RATE = SETTINGS.THROTTLE_CALLBACKS_RATE = 1e9
+        SETTINGS.THROTTLE_MESSAGES_BURST = SETTINGS.THROTTLE_CALLBACKS_BURST = 10 ** 9
+
+    fake_api = FakeBotAPI(latency=args.api_latency / 1000)
+    runner = web.AppRunner(fake_api.app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+
+    session = bot_module.create_bot_session(args.fast, api=TelegramAPIServer.from_base(f"http://127.0.0.1:{port}"))
+    bot = Bot(REPLAY_BOT_TOKEN, session=session, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+    dp = bot_module.build_dispatcher()
+
+    await bot_module.DatabaseManager.init_db()
+    await bot_module.MemoryCache.warm_up()
+
+    latencies: List[float] = []
+    queue_waits: List[float] = []
+    by_kind: Dict[str, List[float]] = defaultdict(list)
+    errors = 0
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def process(payload: Dict[str, Any]):
+        nonlocal errors
+        # Задержка считается от поступления апдейта: ожидание свободного слота --concurrency в нее входит
+        # (как очередь апдейтов у живого бота) и отдельно попадает в queue_wait_ms
+        arrived = time.perf_counter()
+        async with semaphore:
+            queue_waits.append(time.perf_counter() - arrived)
+            update = Update.model_validate(payload, context={'bot': bot})
+            try:
+                await dp.feed_update(bot, update)
+            except Exception as e:
+                errors += 1
+                print(f"Ошибка на апдейте {payload.get('update_id')}: {e}")
+            elapsed = time.perf_counter() - arrived
+            latencies.append(elapsed)
+            by_kind[update_kind(payload)].append(elapsed)
+
+    first_t = records[0]['t']
+    started = time.perf_counter()
+    tasks = []
+    for record in records:
+        if args.speed > 0:
+            delay = (record['t'] - first_t) / args.speed - (time.perf_counter() - started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(process(record['update'])))
+    await asyncio.gather(*tasks)
+    duration = time.perf_counter() - started
+
+    await bot.session.close()
+    await bot_module.DatabaseManager.close_connection()
+    await runner.cleanup()
+    tmp.cleanup()
+
+    return {
+        'label': args.label,
+        'runtime': bot_module.describe_runtime(args.fast),
+        'speed': args.speed,
+        'api_latency_ms': args.api_latency,
+        'updates': len(records),
+        'errors': errors,
+        'duration_s': round(duration, 3),
+        'throughput_ups': round(len(records) / duration, 2) if duration else None,
+        'latency_ms': latency_summary(latencies),
+        'queue_wait_ms': latency_summary(queue_waits),
+        'latency_ms_by_kind': {kind: latency_summary(samples) for kind, samples in sorted(by_kind.items())},
+        'api_calls': dict(fake_api.calls.most_common()),
+        'api_calls_per_update': round(sum(fake_api.calls.values()) / len(records), 3),
+    }
+
+
+# --- СРАВНЕНИЕ ОТЧЕТОВ ---
+
+def compare_reports(path_a: str, path_b: str):
+    with open(path_a, encoding='utf-8') as f:
+        a = json.load(f)
+    with open(path_b, encoding='utf-8') as f:
+        b = json.load(f)
+
+    rows = [
+        ("Пропускная способность, апд/с", a['throughput_ups'], b['throughput_ups']),
+        ("Вызовов API на апдейт", a['api_calls_per_update'], b['api_calls_per_update']),
+        ("Ошибок", a['errors'], b['errors']),
+    ]
+    for key in ('mean', 'p50', 'p90', 'p99', 'max'):
+        rows.append((f"Задержка {key}, мс", a['latency_ms'][key], b['latency_ms'][key]))
+    if 'queue_wait_ms' in a and 'queue_wait_ms' in b:
+        rows.append(("Ожидание слота p90, мс", a['queue_wait_ms']['p90'], b['queue_wait_ms']['p90']))
+    for kind in sorted(set(a['latency_ms_by_kind']) | set(b['latency_ms_by_kind'])):
+        rows.append((f"{kind} p90, мс", a['latency_ms_by_kind'].get(kind, {}).get('p90'),
+                     b['latency_ms_by_kind'].get(kind, {}).get('p90')))
+
+    print(f"{'Метрика':<36} {a.get('label') or 'A':>12} {b.get('label') or 'B':>12} {'Δ':>9}")
+    for name, value_a, value_b in rows:
+        if isinstance(value_a, (int, float)) and isinstance(value_b, (int, float)) and value_a:
+            delta = f"{(value_b - value_a) / value_a * 100:+.1f}%"
+        else:
+            delta = "—"
+        print(f"{name:<36} {str(value_a):>12} {str(value_b):>12} {delta:>9}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay записанных апдейтов бота")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run = commands.add_parser('run', help="Воспроизвести лог и сохранить отчет")
+    run.add_argument('logs', nargs='+', help="Файлы записи (.jsonl или .jsonl.gz, включая ротированные)")
+    run.add_argument('--speed', type=float, default=1.0, help="Множитель скорости; 0 — без пауз")
+    run.add_argument('--concurrency', type=int, default=100, help="Максимум апдейтов в обработке одновременно")
+    run.add_argument('--api-latency', type=float, default=0.0, help="Задержка ответа фейкового API, мс")
+    run.add_argument('--no-throttle', action='store_true', help="Отключить антифлуд (для ускоренного replay)")
+    run.add_argument('--fast', action='store_true', help="Быстрый режим: uvloop + orjson (см. FAST_RUNTIME)")
+    run.add_argument('--label', default="", help="Подпись сборки в отчете")
+    run.add_argument('--report', help="Куда сохранить JSON-отчет")
+
+    compare = commands.add_parser('compare', help="Сравнить два отчета")
+    compare.add_argument('report_a')
+    compare.add_argument('report_b')
+
+    args = parser.parse_args()
+    if args.command == 'compare':
+        compare_reports(args.report_a, args.report_b)
+        return
+
+    with asyncio.Runner(loop_factory=bot_module.event_loop_factory(args.fast)) as runner:
+        report = runner.run(run_replay(args))
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()